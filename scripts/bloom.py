@@ -0,0 +1,153 @@
+"""
+File: bloom.py
+
+A Bloom filter of Reddit full-names, stored in a memory-mapped file
+
+The filter is used to skip looking up comments that aren't in the {comment --> submission} map.
+It is built by many worker processes at once, each adding the comments of the tables that it
+loads into the same file, and is then memory-mapped (read-only) by each of the split workers so that
+the OS page cache is shared among them.
+"""
+
+import os
+import json
+import numpy as np
+
+from codec import encode_fullnames
+
+
+def _mix(x):
+    """
+    Scrambles the bits of 64 bit integers (the "splitmix64" finalizer)
+
+    :param x: Array of uint64
+    :return: Array of uint64 with well distributed bits
+    """
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return x ^ (x >> np.uint64(31))
+
+
+class BloomFilter(object):
+    """
+    Memory-mapped Bloom filter of full-names
+    """
+
+    def __init__(self, path, mode='r'):
+        """
+        Opens a Bloom filter that was made with BloomFilter.create
+
+        :param path: Path to the file of the filter
+        :param mode: "r" to open it read-only or "r+" to add to it
+        """
+        with open(path + ".json") as f:
+            info = json.load(f)
+        self.path = path
+        self.num_hashes = info['num_hashes']
+        self.bits = np.load(path, mmap_mode=mode)
+        self.num_bits = 8 * len(self.bits)
+
+    @staticmethod
+    def create(path, capacity, error_rate=0.01):
+        """
+        Creates an empty Bloom filter
+
+        :param path: Path to the file to store the filter in
+        :param capacity: The number of full-names that will be added to the filter
+        :param error_rate: The rate of false positives once the filter holds capacity full-names
+        :return: The BloomFilter, opened for adding to it
+        """
+        num_bits = int(np.ceil(-max(capacity, 1) * np.log(error_rate) / np.log(2) ** 2))
+        num_hashes = max(1, int(round(num_bits / max(capacity, 1) * np.log(2))))
+        bits = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=((num_bits + 7) // 8,))
+        bits.flush()
+        del bits
+        with open(path + ".json", 'w') as f:
+            json.dump({'num_hashes': num_hashes, 'capacity': capacity, 'error_rate': error_rate}, f)
+        return BloomFilter(path, mode='r+')
+
+    def _positions(self, codes):
+        """
+        Finds the bits of each of an array of codes (see codec.py) of full-names
+
+        :param codes: Array of int64 codes
+        :return: A (num_hashes, len(codes)) array of the positions of the bits
+        """
+        h1 = _mix(codes.astype(np.uint64))
+        h2 = _mix(h1) | np.uint64(1)
+        steps = np.arange(self.num_hashes, dtype=np.uint64)[:, np.newaxis]
+        with np.errstate(over='ignore'):
+            return (h1 + steps * h2) % np.uint64(self.num_bits)
+
+    def add(self, fullnames, lock=None):
+        """
+        Adds a column of full-names to the filter
+
+        :param fullnames: Column of full-names (values that aren't full-names are ignored)
+        :param lock: Lock to hold while setting the bits, if other processes are adding to the filter too
+        :return: None
+        """
+        self.add_codes(encode_fullnames(fullnames), lock=lock)
+
+    def add_codes(self, codes, lock=None):
+        """
+        Adds an array of codes of full-names (see codec.py) to the filter
+
+        :param codes: Array of int64 codes (negative codes are ignored)
+        :param lock: Lock to hold while setting the bits, if other processes are adding to the filter too
+        :return: None
+        """
+        codes = np.asarray(codes, dtype=np.int64)
+        positions = self._positions(codes[codes >= 0]).ravel()
+        masks = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+        offsets = (positions >> np.uint64(3)).astype(np.int64)
+        if lock is not None:
+            lock.acquire()
+        try:
+            np.bitwise_or.at(self.bits, offsets, masks)
+            self.bits.flush()
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def contains(self, fullnames):
+        """
+        Checks which of a column of full-names may have been added to the filter
+
+        :param fullnames: Column of full-names
+        :return: Boolean array which is False for each full-name that was definitely not added
+        """
+        codes = encode_fullnames(fullnames)
+        found = codes >= 0
+        positions = self._positions(codes[found])
+        masks = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+        bits = self.bits[(positions >> np.uint64(3)).astype(np.int64)] & masks
+        found[found] = (bits != 0).all(axis=0)
+        return found
+
+
+_open_filters = {}
+
+
+def open_bloom_filter(path, mode='r'):
+    """
+    Opens a Bloom filter, re-using the filter if it was already opened by this process
+
+    :param path: Path to the file of the filter
+    :param mode: "r" to open it read-only or "r+" to add to it
+    :return: The BloomFilter
+    """
+    if (path, mode) not in _open_filters:
+        _open_filters[(path, mode)] = BloomFilter(path, mode=mode)
+    return _open_filters[(path, mode)]
+
+
+def bloom_filter_exists(path):
+    """
+    Checks whether a Bloom filter has been made
+
+    :param path: Path to the file of the filter
+    :return: True if the filter exists
+    """
+    return os.path.isfile(path) and os.path.isfile(path + ".json")
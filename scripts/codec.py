@@ -0,0 +1,279 @@
+"""
+File: codec.py
+
+Compact integer and binary encodings of the keys of the Reddit data-set
+
+Full-names such as "t1_dg07wre" (a type tag and a base 36 id) are encoded as int64 and the
+28 character base64 user ids (hashed with SHA1) as 20 bytes. Both encodings preserve order:
+sorting the codes sorts the keys exactly as sorting the strings would, so that the keys can be
+sorted, grouped and looked up by their codes and decoded only when writing output.
+
+Timestamps such as "2017-04-09 04:57:59.276 UTC" (and dates such as "2014-03-06") are encoded
+as int64 milliseconds since the epoch.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Full-names: "t<tag>_<id>" with an id of up to fullname_width characters from [0-9a-z]. Each id
+# character is encoded as 1-36 and the end of the id as 0, in base 37, so that shorter ids sort first.
+fullname_width = 11
+fullname_pattern = "t[0-9]_[0-9a-z]{1,%d}" % fullname_width
+fullname_digits = np.zeros(256, dtype=np.int64)
+fullname_digits[ord('0'):ord('9') + 1] = np.arange(1, 11)
+fullname_digits[ord('a'):ord('z') + 1] = np.arange(11, 37)
+fullname_chars = np.frombuffer(b"\x000123456789abcdefghijklmnopqrstuvwxyz", dtype=np.uint8)
+
+# User ids: base64 encoded SHA1 digests, i.e. 26 characters from the base64 alphabet, a 27th
+# character that only carries 4 bits, and "=". Characters are encoded by their rank in ASCII order.
+user_id_length = 28
+user_id_size = 20
+user_id_chars = np.frombuffer(b"+/0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz", dtype=np.uint8)
+user_id_last_chars = np.frombuffer(b"048AEIMQUYcgkosw", dtype=np.uint8)
+user_id_pattern = "[A-Za-z0-9+/]{26}[AEIMQUYcgkosw048]="
+user_id_ranks = np.zeros(256, dtype=np.uint32)
+user_id_ranks[user_id_chars] = np.arange(64)
+user_id_last_ranks = np.zeros(256, dtype=np.uint32)
+user_id_last_ranks[user_id_last_chars] = np.arange(16)
+
+# Timestamps: "YYYY-MM-DD HH:MM:SS[.fff] UTC", with up to 3 digits of the seconds' fraction (without
+# trailing zeros), or just the date. Missing timestamps are encoded as the largest int64, so that
+# they sort after all of the others (as missing values do when sorting strings).
+timestamp_length = 27
+timestamp_pattern = r"\d{4}-\d{2}-\d{2}( \d{2}:\d{2}:\d{2}(\.\d{1,3})? UTC)?"
+missing_timestamp = np.iinfo(np.int64).max
+
+# The code of a missing full-name key (see encode_keys), which is larger than the code of any full-name
+missing_key = np.iinfo(np.int64).max
+
+
+def _char_matrix(strings, width):
+    """
+    Converts a column of ASCII strings into a matrix of their characters, padded with zeros
+
+    :param strings: Column of strings no longer than width
+    :param width: Number of columns of the matrix
+    :return: A (len(strings), width) uint8 array
+    """
+    chars = np.asarray(strings, dtype="S%d" % width)
+    return np.frombuffer(chars.tobytes(), dtype=np.uint8).reshape(len(chars), width)
+
+
+def encode_fullnames(fullnames):
+    """
+    Encodes a column of full-names as int64
+
+    :param fullnames: Column (Series or array-like) of full-names, e.g. "t3_54tr0w"
+    :return: An int64 array of the codes, with -1 for missing values or anything else
+    that isn't a full-name
+    """
+    fullnames = pd.Series(fullnames, dtype=object)
+    valid = fullnames.str.fullmatch(fullname_pattern, na=False).to_numpy(dtype=bool)
+    fullnames = fullnames.where(valid, "t0_")
+
+    chars = _char_matrix(fullnames.str[3:], fullname_width)
+    codes = _char_matrix(fullnames.str[1], 1)[:, 0].astype(np.int64) - ord('0')
+    for i in range(fullname_width):
+        codes = codes * 37 + fullname_digits[chars[:, i]]
+    codes[~valid] = -1
+    return codes
+
+
+def decode_fullnames(codes):
+    """
+    Decodes int64 codes into full-names
+
+    :param codes: Array of codes made by encode_fullnames
+    :return: An object array of the full-names, with None for codes of -1
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    missing = codes < 0
+    remaining = np.where(missing, 0, codes)
+
+    chars = np.empty((len(codes), fullname_width + 3), dtype=np.uint8)
+    for i in reversed(range(fullname_width)):
+        remaining, digits = np.divmod(remaining, 37)
+        chars[:, i + 3] = fullname_chars[digits]
+    chars[:, 0] = ord('t')
+    chars[:, 1] = ord('0') + remaining
+    chars[:, 2] = ord('_')
+
+    fullnames = chars.view("S%d" % (fullname_width + 3)).ravel().astype(str).astype(object)
+    fullnames[missing] = None
+    return fullnames
+
+
+def encode_fullname_numbers(fullnames):
+    """
+    Encodes a column of full-names as their type tag and the number of their base 36 id
+
+    Unlike encode_fullnames this doesn't preserve the order of the full-names, but consecutive ids
+    have consecutive numbers.
+    :param fullnames: Column (Series or array-like) of full-names, e.g. "t3_54tr0w"
+    :return: A tuple of int64 arrays of the tags and the numbers, with -1 for missing values, anything
+    that isn't a full-name and ids with leading zeros (which would have the same number as another id)
+    """
+    fullnames = pd.Series(fullnames, dtype=object)
+    valid = fullnames.str.fullmatch("t[0-9]_(0|[1-9a-z][0-9a-z]{0,%d})" % (fullname_width - 1),
+                                    na=False).to_numpy(dtype=bool)
+    fullnames = fullnames.where(valid, "t0_0")
+
+    chars = _char_matrix(fullnames.str[3:], fullname_width)
+    tags = _char_matrix(fullnames.str[1], 1)[:, 0].astype(np.int64) - ord('0')
+    numbers = np.zeros(len(chars), dtype=np.int64)
+    for i in range(fullname_width):
+        digits = fullname_digits[chars[:, i]]
+        numbers = np.where(digits > 0, numbers * 36 + digits - 1, numbers)
+    tags[~valid] = -1
+    numbers[~valid] = -1
+    return tags, numbers
+
+
+def encode_user_ids(user_ids):
+    """
+    Encodes a column of (base64 encoded SHA1) user ids as 20 bytes each
+
+    :param user_ids: Column (Series or array-like) of user ids, e.g. "zr8jOCw0n6t/2QIHvwWUy1J1Xy0="
+    :return: An array of dtype "S20" of the codes. Missing values are encoded as 20 zero bytes.
+    :raises ValueError: If any value isn't a base64 encoded SHA1 digest
+    """
+    user_ids = pd.Series(user_ids, dtype=object)
+    missing = user_ids.isnull().to_numpy()
+    valid = user_ids.str.fullmatch(user_id_pattern, na=False).to_numpy(dtype=bool)
+    if not (valid | missing).all():
+        raise ValueError("Not a user id: %s" % user_ids[~(valid | missing)].iloc[0])
+
+    chars = _char_matrix(user_ids.where(valid, ""), user_id_length)
+    ranks = user_id_ranks[chars[:, :26]]
+    codes = np.zeros((len(chars), user_id_size), dtype=np.uint8)
+    for group in range(6):  # 4 characters of 6 bits into 3 bytes
+        r = ranks[:, 4 * group:4 * group + 4]
+        bits = (r[:, 0] << 18) | (r[:, 1] << 12) | (r[:, 2] << 6) | r[:, 3]
+        codes[:, 3 * group:3 * group + 3] = np.stack([bits >> 16, bits >> 8, bits], axis=1) & 0xff
+    bits = (ranks[:, 24] << 10) | (ranks[:, 25] << 4) | user_id_last_ranks[chars[:, 26]]
+    codes[:, 18] = bits >> 8
+    codes[:, 19] = bits & 0xff
+    codes[missing] = 0
+    return codes.view("S%d" % user_id_size).ravel()
+
+
+def decode_user_ids(codes):
+    """
+    Decodes 20 byte codes into user ids
+
+    :param codes: Array of codes made by encode_user_ids
+    :return: An object array of the user ids, with None for codes of 20 zero bytes
+    """
+    codes = np.frombuffer(np.asarray(codes, dtype="S%d" % user_id_size).tobytes(), dtype=np.uint8)
+    codes = codes.reshape(-1, user_id_size).astype(np.uint32)
+
+    chars = np.empty((len(codes), user_id_length), dtype=np.uint8)
+    for group in range(6):
+        b = codes[:, 3 * group:3 * group + 3]
+        bits = (b[:, 0] << 16) | (b[:, 1] << 8) | b[:, 2]
+        for i in range(4):
+            chars[:, 4 * group + i] = user_id_chars[(bits >> (18 - 6 * i)) & 0x3f]
+    bits = (codes[:, 18] << 8) | codes[:, 19]
+    chars[:, 24] = user_id_chars[bits >> 10]
+    chars[:, 25] = user_id_chars[(bits >> 4) & 0x3f]
+    chars[:, 26] = user_id_last_chars[bits & 0xf]
+    chars[:, 27] = ord('=')
+
+    user_ids = chars.view("S%d" % user_id_length).ravel().astype(str).astype(object)
+    user_ids[(codes == 0).all(axis=1)] = None
+    return user_ids
+
+
+def encode_keys(values, column):
+    """
+    Encodes a column of keys by the codec for that column
+
+    Missing keys are encoded after all of the others, so that they sort last (as missing values do
+    when sorting strings): full-names as missing_key, and user ids with a first byte of 1 where the
+    20 bytes of every other user id follow a 0.
+    :param values: Column of keys to encode
+    :param column: Name of the column, e.g. "user_id" or "post_fullname"
+    :return: An array of the encoded keys
+    :raises ValueError: If any value can't be encoded
+    """
+    missing = pd.isnull(np.asarray(values, dtype=object))
+    if column == "user_id":
+        codes = np.frombuffer(encode_user_ids(values).tobytes(), dtype=np.uint8).reshape(-1, user_id_size)
+        codes = np.hstack((missing.astype(np.uint8)[:, None], codes))
+        return codes.view("S%d" % (user_id_size + 1)).ravel()
+
+    codes = encode_fullnames(values)
+    invalid = (codes < 0) & ~missing
+    if invalid.any():
+        raise ValueError("Not a full-name: %s" % np.asarray(values, dtype=object)[invalid][0])
+    codes[missing] = missing_key
+    return codes
+
+
+def decode_keys(codes, column):
+    """
+    Decodes a column of keys that were encoded with encode_keys
+
+    :param codes: Array of encoded keys
+    :param column: Name of the column that the keys were encoded for
+    :return: An object array of the keys
+    """
+    if column == "user_id":
+        codes = np.frombuffer(np.asarray(codes, dtype="S%d" % (user_id_size + 1)).tobytes(), dtype=np.uint8)
+        return decode_user_ids(codes.reshape(-1, user_id_size + 1)[:, 1:].copy().view("S%d" % user_id_size).ravel())
+    codes = np.asarray(codes, dtype=np.int64)
+    return decode_fullnames(np.where(codes == missing_key, -1, codes))
+
+
+def encode_timestamps(timestamps):
+    """
+    Encodes a column of timestamps (or dates) as int64 milliseconds since the epoch
+
+    :param timestamps: Column (Series or array-like) of timestamps, e.g. "2017-04-09 04:57:59.276 UTC"
+    :return: An int64 array of the codes, with missing_timestamp for missing values
+    :raises ValueError: If any value isn't a timestamp or a date
+    """
+    timestamps = pd.Series(timestamps, dtype=object)
+    missing = timestamps.isnull().to_numpy()
+    valid = timestamps.str.fullmatch(timestamp_pattern, na=False).to_numpy(dtype=bool)
+    if not (valid | missing).all():
+        raise ValueError("Not a timestamp: %s" % timestamps[~(valid | missing)].iloc[0])
+
+    timestamps = timestamps.where(valid, "1970-01-01")
+    days = np.asarray(timestamps.str[:10].to_numpy(dtype=str), dtype="datetime64[D]")
+    digits = _char_matrix(timestamps, timestamp_length).astype(np.int64) - ord('0')
+    seconds = (digits[:, 11] * 10 + digits[:, 12]) * 3600 + (digits[:, 14] * 10 + digits[:, 15]) * 60 + \
+        digits[:, 17] * 10 + digits[:, 18]
+    fraction = digits[:, 20:23]
+    milliseconds = (np.where((fraction >= 0) & (fraction <= 9), fraction, 0) * [100, 10, 1]).sum(axis=1)
+
+    codes = days.astype(np.int64) * 86400000
+    codes += np.where(timestamps.str.len().to_numpy() > 10, seconds * 1000 + milliseconds, 0)
+    codes[missing] = missing_timestamp
+    return codes
+
+
+def decode_timestamps(codes):
+    """
+    Decodes int64 codes into timestamps
+
+    Dates are decoded as timestamps of midnight, e.g. "2014-03-06 00:00:00 UTC".
+    :param codes: Array of codes made by encode_timestamps
+    :return: An object array of the timestamps, with None for codes of missing_timestamp
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    missing = codes == missing_timestamp
+    times = np.where(missing, 0, codes)
+
+    # "YYYY-MM-DDTHH:MM:SS.fff", without the trailing zeros of the fraction (or the fraction if it's 0)
+    milliseconds = times % 1000
+    lengths = 23 - np.select([milliseconds == 0, milliseconds % 100 == 0, milliseconds % 10 == 0], [4, 2, 1], 0)
+    chars = np.zeros((len(codes), timestamp_length), dtype=np.uint8)
+    chars[:, :23] = _char_matrix(np.datetime_as_string(times.astype("datetime64[ms]"), unit='ms'), 23)
+    chars[:, 10] = ord(' ')
+    chars[np.arange(timestamp_length) >= lengths[:, None]] = 0
+    chars[np.arange(len(codes))[:, None], lengths[:, None] + np.arange(4)] = np.frombuffer(b" UTC", dtype=np.uint8)
+
+    timestamps = chars.view("S%d" % timestamp_length).ravel().astype(str).astype(object)
+    timestamps[missing] = None
+    return timestamps
@@ -0,0 +1,207 @@
+"""
+File: columnar.py
+
+A typed, columnar binary format for the intermediate files between the split and the merge
+
+A data frame is stored as a zip archive (the NumPy ".npz" format) holding ".npy" arrays for each
+of its columns, so that reading it back needs no parsing and keeps the types that the columns were
+split with. The columns are stored separately, so the merge reads only the ones that it needs.
+Each chunk of a file that is split in chunks is appended to the archive as its own part:
+
+    00000/endpoint_ts.npy
+    00000/user_id.utf8.npy
+    00000/user_id.offsets.npy
+    ...
+    00001/endpoint_ts.npy
+    ...
+
+Numeric and boolean columns are stored as their arrays. String columns are stored as the UTF-8
+text of all of their values and the int64 offsets (in characters) of each value in it, so that
+no column is pickled and every array is loaded with allow_pickle=False. The missing values of
+string (and nullable) columns are marked by a "<column>.mask.npy" array.
+"""
+
+import io
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+
+from collections import OrderedDict
+from compressors import get_file_codec, codec_extensions, compressed_file_name
+
+intermediate_formats = ["csv", "npz"]
+
+
+def intermediate_file_name(file_name, file_format="csv", compression=None):
+    """
+    Names an intermediate file that an input file is split into
+
+    :param file_name: Name of the input file (which may have the extension of a compression codec)
+    :param file_format: One of intermediate_formats
+    :param compression: The codec that CSV files are compressed with (see compressors.py). Files in
+    the columnar format are zip archives that are appended to, so they aren't compressed.
+    :return: The name of the input file, with the extension of the format if it isn't CSV, or else
+    with the extension of the codec
+    """
+    codec = get_file_codec(file_name)
+    if codec is not None:
+        file_name = file_name[:-len(codec_extensions[codec])]
+    if file_format == "csv":
+        return compressed_file_name(file_name, compression)
+    return "%s.%s" % (os.path.splitext(file_name)[0], file_format)
+
+
+def write_columnar(df, destination, append=False):
+    """
+    Writes a data frame in the columnar format
+
+    :param df: The data frame to write
+    :param destination: Path to (or binary file object of) the file to write to
+    :param append: Append the data frame to the file as a new part, instead of overwriting it
+    :return: None
+    """
+    with zipfile.ZipFile(destination, 'a' if append else 'w') as archive:
+        part = len(set(name.split("/")[0] for name in archive.namelist()))
+        for column in df.columns:
+            for suffix, array in encode_column(df[column]):
+                buffer = io.BytesIO()
+                np.save(buffer, array, allow_pickle=False)
+                archive.writestr("%05d/%s%s.npy" % (part, column, suffix), buffer.getvalue())
+
+
+# The suffixes of the names of the arrays that a column is stored as (see encode_column)
+array_suffixes = [".utf8", ".offsets", ".mask", ""]
+
+
+def encode_column(column):
+    """
+    Encodes a column as the arrays that it's stored as, none of which holds objects
+
+    :param column: The column (a Series)
+    :return: List of (suffix, array) tuples: the column's array (suffix ""), or the UTF-8 text (".utf8")
+    and offsets (".offsets") of a string column, and the missing values (".mask") of a column that has them
+    :raises TypeError: If the column holds objects other than strings
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        column = column.astype(object)
+    if isinstance(column.array, (pd.arrays.BooleanArray, pd.arrays.IntegerArray, pd.arrays.FloatingArray)):
+        dtype = column.dtype.numpy_dtype
+        return [("", column.to_numpy(dtype=dtype, na_value=dtype.type(0))), (".mask", column.isnull().to_numpy())]
+    if not (pd.api.types.is_object_dtype(column.dtype) or pd.api.types.is_string_dtype(column.dtype)):
+        return [("", column.to_numpy())]
+
+    missing = column.isnull().to_numpy(dtype=bool)
+    values = column.to_numpy(dtype=object)[~missing]
+    if not all(isinstance(value, str) for value in values):
+        raise TypeError("Column \"%s\" holds values that are not strings" % column.name)
+    offsets = np.zeros(len(column) + 1, dtype=np.int64)
+    offsets[1:][~missing] = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+    arrays = [(".utf8", np.frombuffer("".join(values).encode(), dtype=np.uint8)), (".offsets", np.cumsum(offsets))]
+    return arrays + [(".mask", missing)] if missing.any() else arrays
+
+
+def decode_column(arrays):
+    """
+    Decodes a column from the arrays that it was stored as (see encode_column)
+
+    :param arrays: Map from each suffix of the column's arrays to the array
+    :return: The column's values: a NumPy array, a nullable pandas array, or an object array of strings
+    (with NaN for missing values)
+    """
+    mask = arrays.get(".mask")
+    if ".utf8" not in arrays:
+        values = arrays[""]
+        if mask is None:
+            return values
+        if values.dtype.kind == 'b':
+            return pd.arrays.BooleanArray(values, mask)
+        if values.dtype.kind == 'f':
+            return pd.arrays.FloatingArray(values, mask)
+        return pd.arrays.IntegerArray(values, mask)
+
+    text = arrays[".utf8"].tobytes().decode()
+    offsets = arrays[".offsets"]
+    values = np.empty(len(offsets) - 1, dtype=object)
+    values[:] = [text[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+    if mask is not None:
+        values[mask] = np.nan
+    return values
+
+
+def split_array_name(array_name):
+    # The column and suffix of an array of a part, e.g. "user_id.utf8.npy" -> ("user_id", ".utf8")
+    name = array_name[:-len(".npy")]
+    suffix = next(suffix for suffix in array_suffixes if name.endswith(suffix))
+    return name[:len(name) - len(suffix)], suffix
+
+
+def data_frame_to_columnar(df):
+    """
+    Stores a data frame in the columnar format in memory
+
+    :param df: The data frame to store
+    :return: The bytes of the stored data frame
+    """
+    buffer = io.BytesIO()
+    write_columnar(df, buffer)
+    return buffer.getvalue()
+
+
+def is_columnar(data):
+    """
+    Checks whether some bytes are a data frame in the columnar format (rather than CSV)
+
+    :param data: Bytes, starting from the beginning of the data frame
+    :return: True if the bytes are a zip archive
+    """
+    return data[:4] == b'PK\x03\x04'
+
+
+def list_columnar_parts(source):
+    """
+    Lists the parts of a file in the columnar format
+
+    :param source: Path to (or binary file object of) the file
+    :return: List of the names of the parts, in the order that they were written
+    """
+    with zipfile.ZipFile(source) as archive:
+        return list(OrderedDict((name.split("/")[0], None) for name in archive.namelist()))
+
+
+def read_columnar_parts(source, columns=None, parts=None):
+    """
+    Reads the parts of a file in the columnar format one at a time
+
+    :param source: Path to (or binary file object of) the file to read
+    :param columns: The columns to read. If None, all columns are read.
+    :param parts: Names of the parts to read (see list_columnar_parts). If None, all parts are read.
+    :return: A generator yielding a data frame for each part of the file
+    """
+    with zipfile.ZipFile(source) as archive:
+        part_names = OrderedDict()
+        for name in archive.namelist():
+            part, array_name = name.split("/", 1)
+            column, suffix = split_array_name(array_name)
+            if (columns is None or column in columns) and (parts is None or part in parts):
+                part_names.setdefault(part, OrderedDict()).setdefault(column, {})[suffix] = name
+
+        for part_columns in part_names.values():
+            yield pd.DataFrame(OrderedDict(
+                (column, decode_column({suffix: np.load(io.BytesIO(archive.read(name)), allow_pickle=False)
+                                        for suffix, name in names.items()}))
+                for column, names in part_columns.items()))
+
+
+def read_columnar(source, columns=None):
+    """
+    Reads a data frame that was written in the columnar format
+
+    :param source: Path to (or binary file object of) the file to read
+    :param columns: The columns to read. If None, all columns are read.
+    :return: The data frame of all of the parts of the file
+    """
+    parts = list(read_columnar_parts(source, columns))
+    if not parts:
+        return pd.DataFrame(columns=[] if columns is None else list(columns))
+    return pd.concat(parts, ignore_index=True)
@@ -0,0 +1,211 @@
+"""
+File: comment_index.py
+
+An on-disk sorted index of the {comment --> submission} map
+
+The index is a pair of NumPy arrays: the sorted codes (see codec.py) of every comment
+full-name and the codes of their base submissions. Split workers memory-map the arrays and look up a
+whole column of comment full-names at once with a vectorized binary search, so there is
+no database server to query and the OS page cache is shared among all of the workers.
+
+The codes include the type tag of the full-names, so a submission's full-name is never found
+as a comment with the same id. An index is only used if its "format.json" marker has the current
+format version, so indices with an older encoding of the keys are rebuilt.
+"""
+
+import os
+import json
+import shutil
+import logging
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+
+from reddit import read_csv_chunks
+from codec import encode_fullnames, decode_fullnames
+
+logger = logging.getLogger('root')
+
+keys_file_name = "keys.npy"
+values_file_name = "values.npy"
+format_file_name = "format.json"
+
+# The version of the format of the index, which changes whenever the encoding of its keys or values does
+index_format_version = 2
+
+
+def index_exists(index_directory):
+    """
+    Checks whether a comment index has been built in a directory in the current format
+
+    :param index_directory: Directory to check for the index
+    :return: True if the index exists and has the current format version
+    """
+    if not all(os.path.isfile(os.path.join(index_directory, f)) for f in [keys_file_name, values_file_name]):
+        return False
+    try:
+        with open(os.path.join(index_directory, format_file_name), 'r') as f:
+            return json.load(f).get("version") == index_format_version
+    except (IOError, ValueError):
+        return False
+
+
+def build_comment_index(comment_files, index_directory, pool_size=16, memory_budget=2 ** 32):
+    """
+    Builds the index of the {comment --> submission} map from the comment tables
+
+    Each comment table is first read, encoded and sorted into a "run" by a pool of workers.
+    The runs are then merged into the final sorted arrays one key range at a time,
+    so that no more than about memory_budget bytes are ever held in memory.
+    :param comment_files: Paths to the comment tables
+    :param index_directory: Directory to write the index to
+    :param pool_size: Number of worker processes to make the runs with
+    :param memory_budget: Number of bytes of memory to use for each key range of the merge
+    :return: None
+    """
+    format_file = os.path.join(index_directory, format_file_name)
+    if os.path.isfile(format_file):
+        os.remove(format_file)  # the index is only marked as built once it's complete
+    runs_directory = os.path.join(index_directory, "runs")
+    os.makedirs(runs_directory, exist_ok=True)
+
+    logger.info("Sorting %d comment tables into runs..." % len(comment_files))
+    args_list = [(f, runs_directory) for f in comment_files]
+    pool = mp.Pool(pool_size)
+    try:
+        runs = pool.map(_unpack_make_run, args_list)
+    finally:
+        pool.close()
+        pool.join()
+
+    _merge_runs(runs, index_directory, memory_budget)
+    shutil.rmtree(runs_directory)
+    with open(format_file, 'w') as f:
+        json.dump({"version": index_format_version, "keys": "codec.encode_fullnames"}, f)
+    logger.info("Built comment index: %s" % index_directory)
+
+
+def _unpack_make_run(args):
+    return _make_run(*args)
+
+
+def _make_run(comment_file, runs_directory):
+    """
+    Encodes the {comment --> submission} pairs of one comment table as a sorted run
+
+    :param comment_file: Path to the comment table
+    :param runs_directory: Directory to write the run into
+    :return: A tuple of the paths to the keys and values of the run
+    """
+    name = os.path.splitext(os.path.split(comment_file)[1])[0]
+    logger.debug("Making run: %s" % name)
+
+    keys, values = [], []
+    for df in read_csv_chunks(comment_file, 2 ** 28, usecols=['comment_fullname', 'post_fullname']):
+        keys.append(encode_fullnames(df.comment_fullname))
+        values.append(encode_fullnames(df.post_fullname))
+    keys = np.concatenate(keys) if keys else np.empty(0, dtype=np.int64)
+    values = np.concatenate(values) if values else np.empty(0, dtype=np.int64)
+
+    found = keys >= 0
+    keys, values = keys[found], values[found]
+    order = np.argsort(keys, kind='stable')
+
+    keys_file = os.path.join(runs_directory, "%s.keys.npy" % name)
+    values_file = os.path.join(runs_directory, "%s.values.npy" % name)
+    np.save(keys_file, keys[order])
+    np.save(values_file, values[order])
+    return keys_file, values_file
+
+
+def _merge_runs(runs, index_directory, memory_budget, samples_per_run=1024):
+    """
+    Merges sorted runs into a single sorted index
+
+    :param runs: List of (keys file, values file) tuples of the sorted runs
+    :param index_directory: Directory to write the index to
+    :param memory_budget: Number of bytes of memory to use for each key range
+    :param samples_per_run: Number of keys to sample from each run to choose the key ranges
+    :return: None
+    """
+    runs = [(np.load(k, mmap_mode='r'), np.load(v, mmap_mode='r')) for k, v in runs]
+    total = sum(len(keys) for keys, _ in runs)
+
+    # Choose boundaries between the key ranges from a sample of the keys,
+    # so that each range holds about the same number of keys
+    bytes_per_key = 40  # keys, values, sort order and the copies made of them
+    num_ranges = max(1, int(np.ceil(total * bytes_per_key / memory_budget)))
+    sample = np.sort(np.concatenate([np.asarray(keys[np.linspace(0, len(keys) - 1, samples_per_run).astype(int)])
+                                     for keys, _ in runs if len(keys)] + [np.empty(0, dtype=np.int64)]))
+    quantiles = np.linspace(0, len(sample), num_ranges + 1)[1:-1].astype(int)
+    boundaries = np.concatenate(([np.iinfo(np.int64).min], np.unique(sample[quantiles]), [np.iinfo(np.int64).max]))
+
+    logger.info("Merging %d runs (%d comments) in %d key ranges..." % (len(runs), total, len(boundaries) - 1))
+    # Written under temporary names so that a partially built index is never used
+    keys_file = os.path.join(index_directory, keys_file_name)
+    values_file = os.path.join(index_directory, values_file_name)
+    index_keys = np.lib.format.open_memmap(keys_file + ".tmp", mode='w+', dtype=np.int64, shape=(total,))
+    index_values = np.lib.format.open_memmap(values_file + ".tmp", mode='w+', dtype=np.int64, shape=(total,))
+    position = 0
+    for low, high in zip(boundaries[:-1], boundaries[1:]):
+        keys, values = [], []
+        for run_keys, run_values in runs:
+            start, stop = np.searchsorted(run_keys, [low, high])
+            keys.append(run_keys[start:stop])
+            values.append(run_values[start:stop])
+        keys = np.concatenate(keys)
+        values = np.concatenate(values)
+        order = np.argsort(keys, kind='stable')
+        index_keys[position:position + len(keys)] = keys[order]
+        index_values[position:position + len(keys)] = values[order]
+        position += len(keys)
+
+    index_keys.flush()
+    index_values.flush()
+    os.replace(keys_file + ".tmp", keys_file)
+    os.replace(values_file + ".tmp", values_file)
+
+
+class CommentIndex(object):
+    """
+    Memory-mapped {comment --> submission} map
+    """
+
+    def __init__(self, index_directory):
+        self.keys = np.load(os.path.join(index_directory, keys_file_name), mmap_mode='r')
+        self.values = np.load(os.path.join(index_directory, values_file_name), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_many(self, fullnames):
+        """
+        Looks up the submission full-name of each of a column of comment full-names
+
+        :param fullnames: Column of comment full-names
+        :return: List of the submission full-name of each comment, or None for comments
+        that aren't in the index
+        """
+        codes = encode_fullnames(fullnames)
+        positions = np.minimum(np.searchsorted(self.keys, codes), max(len(self.keys) - 1, 0))
+        found = (codes >= 0) & (len(self.keys) > 0)
+        found[found] = self.keys[positions[found]] == codes[found]
+
+        result = np.full(len(codes), None, dtype=object)
+        result[found] = decode_fullnames(self.values[positions[found]])
+        return list(result)
+
+
+_open_indices = {}
+
+
+def open_comment_index(index_directory):
+    """
+    Opens a comment index, re-using the index if it was already opened by this process
+
+    :param index_directory: Directory containing the index
+    :return: The CommentIndex stored in the directory
+    """
+    if index_directory not in _open_indices:
+        _open_indices[index_directory] = CommentIndex(index_directory)
+    return _open_indices[index_directory]
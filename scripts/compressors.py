@@ -0,0 +1,159 @@
+"""
+File: compressors.py
+
+Compression codecs of the files that the split and the merge write
+
+    - none: uncompressed
+    - gzip: ".gz" files
+    - zstd: Zstandard, ".zst" files (if the zstandard module is installed)
+    - lz4: LZ4 frames, ".lz4" files (if the lz4 module is installed)
+
+A compressed file's name ends with the extension of its codec, which is how its readers tell how
+to decompress it. A file that is written in chunks is compressed a chunk at a time, as a sequence
+of compressed frames (or gzip members), which each codec reads as one stream. The segments of
+spill files have no names of their own, so they're told apart by the magic number of their codec.
+"""
+
+import io
+import gzip
+
+compression_codecs = ["none", "gzip", "zstd", "lz4"]
+
+codec_extensions = {"gzip": ".gz", "zstd": ".zst", "lz4": ".lz4"}
+
+# The bytes that the data compressed with each codec starts with
+codec_magic = {"gzip": b'\x1f\x8b', "zstd": b'\x28\xb5\x2f\xfd', "lz4": b'\x04\x22\x4d\x18'}
+
+# The gzip compression level. Higher levels are much slower, and make the files only a little smaller.
+gzip_level = 6
+
+
+def codec_installed(codec):
+    try:
+        if codec == "zstd":
+            import zstandard
+        elif codec == "lz4":
+            import lz4.frame
+    except ImportError:
+        return False
+    return True
+
+
+def installed_codecs():
+    """
+    Lists the compression codecs that can be used here
+
+    :return: The elements of compression_codecs whose modules are installed
+    """
+    return [codec for codec in compression_codecs if codec_installed(codec)]
+
+
+def fastest_codec():
+    """
+    Chooses the fastest compression codec that is installed
+
+    :return: "zstd" or "lz4" if either is installed, otherwise "gzip"
+    """
+    return next(codec for codec in ["zstd", "lz4", "gzip"] if codec_installed(codec))
+
+
+def get_codec(compression):
+    # The codec of a compression option: None for none, otherwise its name
+    return None if compression in (None, "none") else compression
+
+
+def compressed_file_name(file_name, compression=None):
+    """
+    Names a file that is compressed with a codec
+
+    :param file_name: Name of the uncompressed file
+    :param compression: One of compression_codecs, or None
+    :return: The name, with the extension of the codec if it's compressed
+    """
+    codec = get_codec(compression)
+    return file_name if codec is None else file_name + codec_extensions[codec]
+
+
+def get_file_codec(file_path):
+    """
+    Tells the codec that a file was compressed with from its name
+
+    :param file_path: Path to the file
+    :return: The codec of the file's extension, or None if it isn't compressed
+    """
+    for codec, extension in codec_extensions.items():
+        if file_path.endswith(extension):
+            return codec
+    return None
+
+
+def compress(data, compression=None):
+    """
+    Compresses a block of data as one frame (or gzip member)
+
+    :param data: The bytes to compress
+    :param compression: One of compression_codecs, or None
+    :return: The compressed bytes
+    """
+    codec = get_codec(compression)
+    if codec is None:
+        return data
+    if codec == "gzip":
+        return gzip.compress(data, compresslevel=gzip_level)
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    if codec == "lz4":
+        import lz4.frame
+        return lz4.frame.compress(data)
+    raise ValueError("Unknown compression codec: %s" % codec)
+
+
+def decompress(data):
+    """
+    Decompresses a block of data that was compressed with compress, telling its codec from its magic number
+
+    :param data: The (possibly compressed) bytes
+    :return: The decompressed bytes, or the bytes as they are if they aren't compressed
+    """
+    for codec, magic in codec_magic.items():
+        if data[:len(magic)] == magic:
+            with open_stream(io.BytesIO(data), codec) as f:
+                return f.read()
+    return data
+
+
+def open_stream(stream, codec, mode='rb'):
+    # Wraps a binary stream in a stream that (de)compresses it with a codec
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=stream, mode=mode, compresslevel=gzip_level)
+    if codec == "zstd":
+        import zstandard
+        if 'r' in mode:
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True))
+        return zstandard.ZstdCompressor().stream_writer(stream)
+    if codec == "lz4":
+        import lz4.frame
+        return lz4.frame.LZ4FrameFile(stream, mode=mode)
+    raise ValueError("Unknown compression codec: %s" % codec)
+
+
+def open_file(file_path, mode='rb', compression='infer', buffering=-1):
+    """
+    Opens a (possibly compressed) file as a binary file object
+
+    :param file_path: Path to the file
+    :param mode: "rb" to read the file, or "wb" to write it
+    :param compression: One of compression_codecs, None, or "infer" to tell it from the file's name
+    :param buffering: Size of the buffer of the (compressed) file, as for open
+    :return: The file object, which (de)compresses the data that's read from or written to it
+    """
+    codec = get_file_codec(file_path) if compression == 'infer' else get_codec(compression)
+    f = open(file_path, mode, buffering=buffering)
+    if codec is None:
+        return f
+    try:
+        return open_stream(f, codec, mode)
+    except:
+        f.close()
+        raise
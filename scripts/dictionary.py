@@ -0,0 +1,132 @@
+"""
+File: dictionary.py
+
+Dictionary encoding of the low-cardinality string columns of the Reddit data-set
+
+Columns such as "sr_name" or "vote_direction" only take a small number of distinct values, which
+are repeated in billions of rows. The split replaces each of their values with a stable integer
+id, from a table of the values of that column that is shared by all of the split's workers and
+data sets (so that, for instance, every data set's subreddit names have the same ids). The table
+of each column is a file in the output directory of the split, "dictionary-<column>.jsonl", of one
+value per line (in JSON), in which the line number of a value is its id. Values are only ever
+appended, under a lock, so that an id never changes once it's assigned.
+
+The merge reads the ids back as categoricals of the values (see ValueDictionary.decode), which are
+written out as the values themselves.
+"""
+
+import os
+import json
+import fcntl
+import functools
+import numpy as np
+import pandas as pd
+
+from schema import dictionary_columns
+
+
+class ValueDictionary(object):
+    """
+    Tables of stable integer ids for the values of the dictionary encoded columns
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: Directory of the tables (the output directory of the split)
+        """
+        self.directory = directory
+        self.columns = dictionary_columns
+        self.values = {column: [] for column in self.columns}
+        self.ids = {column: {} for column in self.columns}
+        self.offsets = {column: 0 for column in self.columns}  # bytes of each table read so far
+
+    def __reduce__(self):
+        # Workers that are passed the dictionary share one copy of it per process
+        return open_value_dictionary, (self.directory,)
+
+    def table_file(self, column):
+        return os.path.join(self.directory, "dictionary-%s.jsonl" % column)
+
+    def _read_table(self, column):
+        # Reads the values that have been added to a column's table since it was last read
+        try:
+            with open(self.table_file(column), 'rb') as f:
+                f.seek(self.offsets[column])
+                data = f.read()
+        except FileNotFoundError:
+            return
+        data = data[:data.rfind(b"\n") + 1]  # only complete lines
+        for line in data.splitlines():
+            value = json.loads(line.decode())
+            self.ids[column][value] = len(self.values[column])
+            self.values[column].append(value)
+        self.offsets[column] += len(data)
+
+    def _add_values(self, column, values):
+        # Appends new values to a column's table. The table is locked while it's brought up to date
+        # and appended to, so that each value gets exactly one id however many workers add it.
+        with open(self.table_file(column), 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self._read_table(column)
+                new_values = [v for v in values if v not in self.ids[column]]
+                f.write(b"".join(json.dumps(v).encode() + b"\n" for v in new_values))
+                f.flush()
+                self._read_table(column)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def categories(self, column):
+        """
+        Gets the values of a column, in the order of their ids
+
+        :param column: One of the dictionary encoded columns
+        :return: List of the values of the column that have been given ids
+        """
+        self._read_table(column)
+        return self.values[column]
+
+    def encode(self, df):
+        """
+        Replaces the values of the dictionary encoded columns of a data frame with their ids
+
+        Values that aren't in the tables yet are added to them.
+        :param df: The data frame to encode
+        :return: The data frame, with int32 ids (-1 for missing values) in place of each encoded column
+        """
+        encoded = {}
+        for column in self.columns:
+            if column not in df.columns or pd.api.types.is_integer_dtype(df[column]):
+                continue
+            missing = df[column].isnull().to_numpy()
+            values = df[column].astype(str).where(~missing)
+            new_values = [v for v in values.dropna().unique() if v not in self.ids[column]]
+            if new_values:
+                self._add_values(column, new_values)
+            codes = pd.Categorical(values, categories=self.values[column]).codes.astype(np.int32)
+            encoded[column] = np.where(missing, -1, codes).astype(np.int32)
+        return df.assign(**encoded) if encoded else df
+
+    def decode(self, df):
+        """
+        Replaces the ids of the dictionary encoded columns of a data frame with categoricals of their values
+
+        :param df: The data frame to decode
+        :return: The data frame, with categoricals (missing values for ids of -1) in place of each encoded column
+        """
+        decoded = {}
+        for column in self.columns:
+            if column in df.columns and pd.api.types.is_integer_dtype(df[column]):
+                decoded[column] = pd.Categorical.from_codes(df[column].to_numpy(), self.categories(column))
+        return df.assign(**decoded) if decoded else df
+
+
+@functools.lru_cache(maxsize=None)
+def open_value_dictionary(directory):
+    """
+    Opens the tables of a split's dictionary encoded columns, once per process
+
+    :param directory: Directory of the tables
+    :return: The ValueDictionary
+    """
+    return ValueDictionary(directory)
@@ -4,7 +4,8 @@ import logging, argparse
 import hashlib
 import multiprocessing as mp
 import pandas as pd
-from enum import Enum
+from schema import schemas, get_data_type, get_merge_columns
+from readers import read_csv
 
 input_directory = ""
 output_directory = ""
@@ -12,35 +13,13 @@ pool_size = 64
 target_directories = {}
 sequential = False
 
-final_columns = ['user_id', 'endpoint_ts', 'event_type'] + ['param_%d' % i for i in range(6)]
-
-
-class DataType(Enum):
-    users = 1
-    votes = 2
-    comments = 3
-    submissions = 4
-    subscriptions = 5
-    removals = 6
-    reports = 7
-    unknown = 8
+final_columns = ['post_fullname', 'endpoint_ts', 'event_type'] + ['param_%d' % i for i in range(6)]
 
 
 def get_aggregate_file(split_directory):
     return os.path.join(output_directory, os.path.split(split_directory)[1] + ".csv")
 
 
-def get_data_type(directory):
-    if "user" in directory: return DataType.users
-    if "vote" in directory: return DataType.votes
-    if "comment" in directory: return DataType.comments
-    if "submission" in directory: return DataType.submissions
-    if "subscription" in directory: return DataType.subscriptions
-    if "removal" in directory: return DataType.removals
-    if "report" in directory: return DataType.reports
-    return DataType.unknown
-
-
 def listdir(directory):
     return list(map(lambda d: os.path.join(directory, d), os.listdir(directory)))
 
@@ -66,7 +45,7 @@ def join_dir(dir):
         df = df.append(next)
 
     logger.debug("Sorting: %s" % dir)
-    df.sort_values(by=['user_id', 'endpoint_ts'], inplace=True)
+    df.sort_values(by=['post_fullname', 'endpoint_ts'], inplace=True)
     df = df[final_columns]  # rearrange columns...
 
     final_output = get_aggregate_file(dir)
@@ -78,7 +57,7 @@ def aggregate(directory):
     files = listdir(directory)
     df = pd.DataFrame()
     for file in files:
-        next = pd.read_csv(file, compression='gzip')
+        next = read_csv(file)  # decompressed with the codec of the file's extension, if it has one
         if 'bucket' in next.columns:
             next.drop('bucket', axis=1, inplace=True)
         df = df.append(next)
@@ -86,37 +65,15 @@ def aggregate(directory):
 
 
 def rearrange(df, data_type, event_type='event_type'):
-    if data_type in [DataType.unknown, DataType.subscriptions, DataType.users]:
+    if get_merge_columns(data_type, 'post_fullname') is None:
         logger.error("Invalid data type")
         return
+    schema = schemas[data_type]
 
     base_cols = ['post_fullname', 'endpoint_ts', event_type]
-
-    if data_type == DataType.votes:
-        # endpoint_ts,user_id,sr_name,target_fullname,target_type,vote_direction
-        df[event_type] = 'vote'
-        param_cols = ['sr_name', 'target_fullname', 'target_type', 'vote_direction']
-
-    if data_type == DataType.comments:
-        # endpoint_ts,user_id,sr_name,comment_fullname,comment_body,parent_fullname,post_fullname
-        df[event_type] = 'comment'
-        param_cols = ['sr_name', 'comment_fullname', 'comment_body', 'parent_fullname', 'post_fullname']
-
-    if data_type == DataType.submissions:
-        # endpoint_ts,user_id,sr_name,post_fullname,post_type,post_title,post_target_url,post_body
-        df[event_type] = 'submission'
-        param_cols = ['sr_name', 'post_fullname', 'post_type', 'post_title', 'post_target_url', 'post_body']
-
-
-    if data_type == DataType.removals:
-        # endpoint_ts,user_id,sr_name,event_type,target_fullname,target_type,user_type
-        # event_type is already present here
-        param_cols = ['sr_name', 'target_fullname', 'target_type', 'user_type']
-
-    if data_type == DataType.reports:
-        # endpoint_ts,user_id,sr_name,target_fullname,target_type,process_notes,details_text
-        df[event_type] = 'report'
-        param_cols = ['sr_name', 'target_fullname', 'target_type', 'process_notes', 'details_text']
+    if schema.event_type is not None:
+        df[event_type] = schema.event_type
+    param_cols = schema.params['post_fullname']
 
     df = df[base_cols + param_cols]  # reorder columns
     new_columns = base_cols + ['param_%d' % i for i in range(len(param_cols))]
@@ -0,0 +1,333 @@
+"""
+File: mapstore.py
+
+Stores for the {comment --> submission} map that is shared by the workers of split-submissions.py
+
+Each store has the same small interface: put_many and get_many to store and look up a whole
+column of comments at once, and len to count them. A store is made by the main process before
+it starts its pool of workers, which inherit it and each make their own connections to it.
+
+    - redis: one or more Redis servers (see reddit.dump_dict_to_redis)
+    - dbm: a dbm database file, written to by one worker at a time
+    - sqlite: a SQLite database file
+    - shm: an open-addressing hash table of the codes of the full-names in shared memory
+    - shmht: a shared memory hash table from the shmht extension (see pyshmht.py)
+"""
+
+import os
+import abc
+import dbm
+import fcntl
+import ctypes
+import sqlite3
+import contextlib
+import multiprocessing as mp
+import numpy as np
+
+from reddit import get_redis_pools, get_redis_db, count_redis_keys, dump_dict_to_redis, get_values_from_redis, \
+    iter_batches
+from codec import encode_fullnames, decode_fullnames
+
+map_store_types = ["redis", "dbm", "sqlite", "shm", "shmht"]
+
+
+class MapStore(abc.ABC):
+    """
+    A {comment --> submission} map shared among processes
+    """
+
+    @abc.abstractmethod
+    def put_many(self, keys, values):
+        """
+        Stores a number of key-value pairs
+
+        :param keys: Column of keys
+        :param values: Column of the value of each key
+        :return: None
+        """
+
+    @abc.abstractmethod
+    def get_many(self, keys):
+        """
+        Looks up the values of a number of keys
+
+        :param keys: Column of keys
+        :return: List of the value of each key, or None for keys that aren't in the store
+        """
+
+    @abc.abstractmethod
+    def __len__(self):
+        pass
+
+
+class RedisStore(MapStore):
+    """
+    Map stored in Redis, possibly sharded over several instances
+    """
+
+    def __init__(self, addresses, compact=False):
+        """
+        :param addresses: Addresses of the Redis instances (see reddit.get_redis_pools)
+        :param compact: Store the map in the compact layout (see reddit.compact_map_entries)
+        """
+        self.pools = get_redis_pools(addresses)
+        self.compact = compact
+
+    def put_many(self, keys, values):
+        dump_dict_to_redis(get_redis_db(self.pools), list(zip(keys, values)), compact=self.compact)
+
+    def get_many(self, keys):
+        return get_values_from_redis(get_redis_db(self.pools), keys, compact=self.compact)
+
+    def __len__(self):
+        return count_redis_keys(get_redis_db(self.pools), compact=self.compact)
+
+
+class DbmStore(MapStore):
+    """
+    Map stored in a dbm database file
+
+    The dbm modules don't support concurrent writers, so the writers take turns holding a lock on the file
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path to the database file
+        """
+        self.path = path
+        self._reader = None
+        self._reader_pid = None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self.path + ".lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def put_many(self, keys, values):
+        with self._locked():
+            db = dbm.open(self.path, 'c')
+            try:
+                for key, value in zip(keys, values):
+                    if isinstance(key, str) and isinstance(value, str):
+                        db[key] = value
+            finally:
+                db.close()
+
+    def _open_reader(self):
+        # Each process opens the database once, after the map has been stored
+        if self._reader_pid != os.getpid():
+            with self._locked():
+                self._reader = dbm.open(self.path, 'r')
+            self._reader_pid = os.getpid()
+        return self._reader
+
+    def get_many(self, keys):
+        db = self._open_reader()
+        values = [db.get(key) if isinstance(key, str) else None for key in keys]
+        return [None if value is None else value.decode() for value in values]
+
+    def __len__(self):
+        with self._locked():
+            db = dbm.open(self.path, 'c')
+            try:
+                return len(db)
+            finally:
+                db.close()
+
+
+class SqliteStore(MapStore):
+    """
+    Map stored in a SQLite database file
+    """
+
+    batch_size = 500  # keys per SELECT, within SQLite's limit on the number of parameters
+
+    def __init__(self, path):
+        """
+        :param path: Path to the database file
+        """
+        self.path = path
+        self._connection = None
+        self._connection_pid = None
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS map (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+
+    def _connect(self):
+        # Connections can't be shared with forked processes, so each process makes its own
+        # (which may be used by any one of the process' threads at a time)
+        if self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=600, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def put_many(self, keys, values):
+        pairs = [(k, v) for k, v in zip(keys, values) if isinstance(k, str) and isinstance(v, str)]
+        with self._connect() as connection:
+            connection.executemany("INSERT OR REPLACE INTO map VALUES (?, ?)", pairs)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        connection = self._connect()
+        found = {}
+        for batch in iter_batches(set(k for k in keys if isinstance(k, str)), self.batch_size):
+            query = "SELECT key, value FROM map WHERE key IN (%s)" % ",".join("?" * len(batch))
+            found.update(connection.execute(query, batch).fetchall())
+        return [found.get(key) for key in keys]
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM map").fetchone()[0]
+
+
+class SharedMemoryStore(MapStore):
+    """
+    Map stored in a hash table in shared memory
+
+    The comments and submissions are stored as their codes (see codec.py) in two arrays of shared
+    memory, with linear probing. Whole columns of keys are stored and looked up at once with NumPy:
+    each round of probing moves every key that hasn't been resolved yet on to its next slot. The
+    table must be made large enough for the whole map when the store is made, before the workers
+    are started (which inherit its memory).
+    """
+
+    empty = -1  # the key of an empty slot (which no code is)
+    multiplier = np.uint64(0x9E3779B97F4A7C15)  # of the multiplicative hash of the codes
+
+    def __init__(self, capacity):
+        """
+        :param capacity: The number of comments that will be stored
+        """
+        self.capacity = 1 << max(1, int(1.3 * capacity)).bit_length()  # a power of two, at least 1.3x
+        self.keys = np.frombuffer(mp.RawArray(ctypes.c_int64, self.capacity), dtype=np.int64)
+        self.values = np.frombuffer(mp.RawArray(ctypes.c_int64, self.capacity), dtype=np.int64)
+        self.keys[:] = self.empty
+        self.size = mp.RawValue(ctypes.c_int64, 0)
+        self.lock = mp.Lock()
+
+    def _slots(self, codes):
+        # The slot that each code is hashed to: the top bits of its product with the multiplier
+        shift = np.uint64(65 - self.capacity.bit_length())
+        return ((codes.astype(np.uint64) * self.multiplier) >> shift).astype(np.int64)
+
+    def _next(self, slots):
+        return (slots + 1) & (self.capacity - 1)
+
+    def put_many(self, keys, values):
+        keys, values = encode_fullnames(keys), encode_fullnames(values)
+        found = (keys >= 0) & (values >= 0)
+        keys, values = keys[found], values[found]
+        # The last value of each key, as though they were stored one at a time
+        keys, last = np.unique(keys[::-1], return_index=True)
+        values = values[::-1][last]
+
+        with self.lock:
+            slots = self._slots(keys)
+            for _ in range(self.capacity + 1):
+                if len(keys) == 0:
+                    return
+                slot_keys = self.keys[slots]
+                stored = slot_keys == keys
+                self.values[slots[stored]] = values[stored]
+
+                # Of the keys that probe the same empty slot, the first is stored there and the rest move on
+                empty = np.flatnonzero(slot_keys == self.empty)
+                _, first = np.unique(slots[empty], return_index=True)
+                claimed = empty[first]
+                self.keys[slots[claimed]] = keys[claimed]
+                self.values[slots[claimed]] = values[claimed]
+                self.size.value += len(claimed)
+                stored[claimed] = True
+
+                keys, values, slots = keys[~stored], values[~stored], slots[~stored]
+                moving = self.keys[slots] != self.empty
+                slots[moving] = self._next(slots[moving])
+            raise MemoryError("The shared memory map store is full")
+
+    def get_many(self, keys):
+        codes = encode_fullnames(keys)
+        values = np.full(len(codes), -1, dtype=np.int64)
+        pending = np.flatnonzero(codes >= 0)
+        slots = self._slots(codes[pending])
+        for _ in range(self.capacity):
+            if len(pending) == 0:
+                break
+            slot_keys = self.keys[slots]
+            hit = slot_keys == codes[pending]
+            values[pending[hit]] = self.values[slots[hit]]
+            probing = ~hit & (slot_keys != self.empty)
+            pending, slots = pending[probing], self._next(slots[probing])
+        return list(decode_fullnames(values))
+
+    def __len__(self):
+        return self.size.value
+
+
+class ShmhtStore(MapStore):
+    """
+    Map stored in a shared memory hash table from the shmht extension (see pyshmht.py)
+    """
+
+    def __init__(self, name, capacity):
+        """
+        :param name: Name (path) of the shared memory hash table
+        :param capacity: The number of comments that will be stored
+        """
+        import pyshmht  # only required for this store
+        self.name = name
+        self.capacity = max(1, int(1.3 * capacity))
+        pyshmht.HashTable(self.name, self.capacity, force_init=True).close()
+        self._table = None
+        self._table_pid = None
+
+    def _open(self):
+        if self._table_pid != os.getpid():
+            import pyshmht
+            self._table = pyshmht.HashTable(self.name, self.capacity)
+            self._table_pid = os.getpid()
+        return self._table
+
+    def put_many(self, keys, values):
+        table = self._open()
+        for key, value in zip(keys, values):
+            if isinstance(key, str) and isinstance(value, str):
+                table[key] = value
+
+    def get_many(self, keys):
+        table = self._open()
+        return [table.get(key) if isinstance(key, str) else None for key in keys]
+
+    def __len__(self):
+        count = [0]
+
+        def increment(key, value):
+            count[0] += 1
+        self._open().foreach(increment)
+        return count[0]
+
+
+def create_map_store(store_type, path=None, capacity=0, redis_addresses=("localhost:6379",), compact=False):
+    """
+    Makes a store for the {comment --> submission} map
+
+    :param store_type: One of map_store_types
+    :param path: Path to the file of the dbm, sqlite or shmht store
+    :param capacity: The number of comments that will be stored (for the shm and shmht stores)
+    :param redis_addresses: Addresses of the Redis instances of the redis store
+    :param compact: Use the compact layout of the redis store
+    :return: The MapStore
+    """
+    if store_type == "redis":
+        return RedisStore(list(redis_addresses), compact=compact)
+    if store_type == "dbm":
+        return DbmStore(path)
+    if store_type == "sqlite":
+        return SqliteStore(path)
+    if store_type == "shm":
+        return SharedMemoryStore(capacity)
+    if store_type == "shmht":
+        return ShmhtStore(path, capacity)
+    raise ValueError("Unknown map store: %s" % store_type)
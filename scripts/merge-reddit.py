@@ -13,8 +13,18 @@ Date: March, 2018
 """
 
 from reddit import *
+from codec import decode_timestamps
+from columnar import read_columnar_parts, list_columnar_parts
+from dictionary import ValueDictionary
+from schema import schemas, get_dtypes, get_merge_columns
+from readers import installed_csv_readers, default_csv_reader
+from writers import TableWriter, format_csv, write_data
+from compressors import installed_codecs, fastest_codec, compressed_file_name
 
 import os
+import shutil
+import tempfile
+import itertools
 import log
 import argparse
 import multiprocessing as mp
@@ -22,6 +32,8 @@ import pandas as pd
 import numpy as np
 
 from enum import Enum
+from collections import OrderedDict
+from pandas.api.types import union_categoricals
 
 
 class MergeType(Enum):
@@ -29,17 +41,20 @@ class MergeType(Enum):
     submission = 1  # Merge a data set that was split by submission ID
 
 
-def get_aggregate_file(output_directory, split_directory):
+def get_aggregate_file(output_directory, split_directory, compression=None):
     """
     Determine the proper output file name for a data subset
     :param output_directory: Output directory where the file should go
     :param split_directory: Direstory containing the reddit subset
+    :param compression: The codec that the file is compressed with (see compressors.py), which names its extension
     :return: A name to use to write the result of merging the split_directory
     """
-    return os.path.join(output_directory, "%05d.tsv" % get_split_number(split_directory))
+    return os.path.join(output_directory,
+                        compressed_file_name("%05d.tsv" % get_split_number(split_directory), compression))
 
 
-def merge_dataset(input_directory, output_directory, strategy, split_set=None, pool_size=16, sequential=False):
+def merge_dataset(input_directory, output_directory, strategy, split_set=None, pool_size=16, sequential=False,
+                  resume=False, memory_budget=None, scratch_directory=None, reader="pandas", compression=None):
     """
     Merges a reddit data-set that has been split up into independent subsets
 
@@ -48,29 +63,91 @@ def merge_dataset(input_directory, output_directory, strategy, split_set=None, p
     :param output_directory: Output directory to place the merged subsets
     :param pool_size: Size of the worker pool to use to process
     :param sequential: Set to true if you'd like your program to take a month
+    :param resume: Only merge the splits that the manifest of the output doesn't record as complete
+    :param memory_budget: Per-worker memory budget (bytes). If given, each split is sorted in runs that
+    fit within it, which are spilled to the scratch directory and then merged (see SortedRuns).
+    :param scratch_directory: Directory to spill the sorted runs to. If None, the system's temporary directory.
+    :param reader: The CSV reader to parse the split files with, one of readers.csv_readers
+    :param compression: The codec to compress the output files with, one of compressors.compression_codecs or None
     :return: None
     """
 
-    directories = listdir(input_directory)  # get the split directories to process
+    split_info = load_split_info(input_directory)
+    key = 'user_id' if strategy == MergeType.user else 'post_fullname'
+    sorted_runs = bool(split_info.get('sorted_runs')) and split_info.get('on') == key
+    dictionary = ValueDictionary(input_directory) if split_info.get('dictionary') else None
+    parsed_times = split_info.get('times') == 'epoch_ms'
+    if sorted_runs:
+        logger.info("Merging the sorted runs of the split as they are read.")
+
+    if split_info.get('layout') == 'spill':
+        args_list = get_spill_merge_args(input_directory, output_directory, strategy, split_info['num_splits'])
+    else:
+        directories = [d for d in listdir(input_directory) if os.path.isdir(d)]  # get the split directories
+        args_list = [(sub_dir, output_directory, strategy, None) for sub_dir in directories]
+
     if split_set is not None:
-        directories = [d for d in directories if get_split_number(d) in split_set]
+        args_list = [args for args in args_list if get_split_number(args[0]) in split_set]
+
+    if resume:
+        args_list = unfinished_tasks(output_directory, args_list, lambda args: get_merge_task_name(args[0]))
+    args_list = [args + (memory_budget, scratch_directory, sorted_runs, dictionary, parsed_times, reader,
+                         compression) for args in args_list]
 
-    logger.info("Merging a total of %d independent sub-directories." % len(directories))
+    logger.info("Merging a total of %d independent sub-directories." % len(args_list))
+    if scratch_directory is not None:
+        os.makedirs(scratch_directory, exist_ok=True)  # each worker makes its own directory in it
 
     if sequential:
-        for sub_dir in directories:
-            merge_data_subset(sub_dir, output_directory, strategy)
+        for args in args_list:
+            merge_data_subset(*args)
     else:
         pool = mp.Pool(pool_size)
-        args_list = [(sub_dir, output_directory, strategy) for sub_dir in directories]
         pool.map(unpack_merge_data_subset, args_list)
 
 
+def get_spill_merge_args(input_directory, output_directory, strategy, num_splits):
+    """
+    Gets the arguments to merge_data_subset for each split of a data set that was split into spill files
+
+    The indices of all the spill files are read once here so that each merge only has to read
+    the byte ranges of the spill files that belong to its split.
+    :param input_directory: Input directory containing a sub-directory of spill files for each data set
+    :param output_directory: Output directory to place the merged subsets
+    :param strategy: An instance of MergeType
+    :param num_splits: The number of splits that the data set was split into
+    :return: List of argument tuples for merge_data_subset, one for each split
+    """
+    data_set_dirs = [d for d in listdir(input_directory) if os.path.isdir(d)]
+    manifest = load_manifest(input_directory)
+    segments = {d: get_spill_segments(d, manifest) for d in data_set_dirs}
+
+    args_list = []
+    for i in range(num_splits):
+        # The split directory doesn't exist, its name just identifies the split
+        split_directory = os.path.join(input_directory, "%05d" % i)
+        split_segments = {d: segments[d][i] for d in data_set_dirs if i in segments[d]}
+        args_list.append((split_directory, output_directory, strategy, split_segments))
+    return args_list
+
+
+def get_merge_task_name(split_directory):
+    """
+    Names the task of merging a split, for the manifest of the output
+
+    :param split_directory: The split directory
+    :return: The name of the task: "merge:<split number>"
+    """
+    return "merge:%05d" % get_split_number(split_directory)
+
+
 def unpack_merge_data_subset(args):
     merge_data_subset(*args)
 
 
-def merge_data_subset(split_directory, output_directory, strategy):
+def merge_data_subset(split_directory, output_directory, strategy, spill_segments=None, memory_budget=None,
+                      scratch_directory=None, sorted_runs=False, dictionary=None, parsed_times=False,
+                      reader="pandas", compression=None):
     """
     Merge one independent subset of reddit data
 
@@ -82,100 +159,641 @@ def merge_data_subset(split_directory, output_directory, strategy):
     :param output_directory: The output directory to write all the stuff to
     :param strategy: An instance of MergeType specifying whether to merge based on user ids
     or based on submission ids
+    :param spill_segments: If the data set was split into spill files, a map from each data set's
+    directory to the columns and spill file segments of this split (see get_spill_segments)
+    :param memory_budget: Memory budget (bytes). If given, the subset is read in chunks and sorted in runs
+    that fit within it, which are spilled to the scratch directory and then merged.
+    :param scratch_directory: Directory to spill the sorted runs to
+    :param sorted_runs: The rows of each split file (or spill segment) were sorted by the split (see
+    split-users.py --sorted-runs), so they are merged as they are read without sorting them
+    :param dictionary: The ValueDictionary that the split encoded the low-cardinality string columns with, if any.
+    The columns are decoded into categoricals, which are only written out as strings.
+    :param parsed_times: The split stored the times as milliseconds since the epoch (see reddit.parse_time_column)
+    :param reader: The CSV reader to parse the split files with, one of readers.csv_readers
+    :param compression: The codec to compress the output files with, one of compressors.compression_codecs or None
     :return: None
     """
     logger.info("Merging directory: %s" % split_directory)
 
-    def get_data_set_df(data_subset_dir, drop_cols=['bucket', 'bkt']):
+    key = 'user_id' if strategy == MergeType.user else 'post_fullname'
+    final_columns = [key, 'endpoint_ts', 'event_type'] + ['param_%d' % i for i in range(6)]
+
+    def rearrange(chunks, data_subset_dir, drop_cols=['bucket', 'bkt']):
+        for df in chunks:
+            if dictionary is not None:
+                df = dictionary.decode(df)
+
+            # remove the specified columns
+            for col in drop_cols:
+                if col in df.columns:
+                    df.drop(col, axis=1, inplace=True)
+
+            if strategy == MergeType.user:
+                df = rearrange_for_user_join(df, get_data_type(data_subset_dir))
+            else:
+                df = rearrange_for_submission_join(df, get_data_type(data_subset_dir))
+            if df is None:
+                continue  # not a data set that is merged
+            yield df if memory_budget is None and not sorted_runs else df.reindex(columns=final_columns)
+
+    def get_read_options(data_subset_dir):
+        # Only the columns that the merge uses are read, with the dtypes that they were split with
+        data_type = get_data_type(data_subset_dir)
+        return get_merge_columns(data_type, key), get_dtypes(data_type, parsed_times, dictionary is not None)
+
+    def get_data_set_chunks(data_subset_dir):
         logger.debug("Loading data from: %s" % data_subset_dir)
-        df = aggregate_dataframes(data_subset_dir)
+        columns, dtype = get_read_options(data_subset_dir)
+        if spill_segments is None:
+            chunks = iter_dataframes(data_subset_dir, usecols=columns, memory_budget=memory_budget, dtype=dtype,
+                                     reader=reader)
+        else:
+            chunks = iter_spill_dataframes(*spill_segments[data_subset_dir], usecols=columns,
+                                           memory_budget=memory_budget, dtype=dtype)
+        for df in rearrange(chunks, data_subset_dir):
+            yield df
         logger.debug("Finished loading: %s" % data_subset_dir)
 
-        # remove the specified columns
-        for col in drop_cols:
-            if col in df.columns:
-                df.drop(col, axis=1, inplace=True)
+    data_set_dirs = listdir(split_directory) if spill_segments is None else sorted(spill_segments)
+    for d in [d for d in data_set_dirs if get_merge_columns(get_data_type(d), key) is None]:
+        logger.warning("Not merging data set on %s: %s" % (key, d))
+        data_set_dirs.remove(d)
+
+    if memory_budget is None and not sorted_runs:
+        logger.debug("Aggregating subset directory: %s" % split_directory)
+        df = concat_data_frames(itertools.chain.from_iterable(map(get_data_set_chunks, data_set_dirs)))
+        logger.debug("Finished aggregating: %s" % split_directory)
+
+        # rearrange columns, which the split may be missing (e.g. a spill split with no rows of a data set)
+        df = df.reindex(columns=final_columns)
+        logger.debug("Sorting: %s" % split_directory)
+        df = sort_by_key(df, key)
 
-        logger.debug("Modifying columns: %s" % data_subset_dir)
-        if strategy == MergeType.user:
-            df = rearrange_for_user_join(df, get_data_type(data_subset_dir))
+        # Safe the data frame as it's final output
+        save_final_merge(df, output_directory, split_directory, strategy, compression)
+        return
+
+    memory_budget = memory_budget or default_memory_budget
+    scratch = tempfile.mkdtemp(prefix="merge-%05d-" % get_split_number(split_directory), dir=scratch_directory)
+    try:
+        if sorted_runs:
+            # Each sorted run is read a block at a time, as a stream
+            sources = [(d, source) for d in data_set_dirs
+                       for source in get_run_sources(d, None if spill_segments is None else spill_segments[d])]
+            block_budget = memory_budget // (min(len(sources), max_merge_streams) + 1)
+            streams = []
+            for n, (d, source) in enumerate(sources):
+                usecols, dtype = get_read_options(d)
+
+                def read(d=d, source=source, usecols=usecols, dtype=dtype):
+                    return rearrange(read_run_source(source, usecols, block_budget, dtype, reader), d)
+
+                if isinstance(source, str):
+                    # The sorted chunks of a CSV file were appended to it one after the other
+                    streams.extend(get_appended_runs(read, key, final_columns, scratch, "file-%05d" % n,
+                                                     block_budget))
+                else:
+                    streams.append(read())
+            logger.debug("Merging %d sorted runs: %s" % (len(streams), split_directory))
+
+            def merge(write):
+                merge_streams(streams, key, final_columns, write, memory_budget, scratch)
         else:
-            df = rearrange_for_submission_join(df, get_data_type(data_subset_dir))
-        logger.debug("Finished modifying columns: %s" % data_subset_dir)
-        return df
+            runs = SortedRuns(scratch, key, final_columns, memory_budget)
+            for df in itertools.chain.from_iterable(map(get_data_set_chunks, data_set_dirs)):
+                runs.add(df)
+            merge = runs.merge
 
-    logger.debug("Aggregating subset directory: %s" % split_directory)
-    df = pd.concat(map(get_data_set_df, listdir(split_directory)))
-    logger.debug("Finished aggregating: %s" % split_directory)
+        save_merged_blocks(merge, final_columns, output_directory, split_directory, strategy, compression)
+    finally:
+        shutil.rmtree(scratch)
+
+
+def concat_data_frames(frames):
+    """
+    Concatenates data frames, keeping the columns that are categorical in all of them categorical
+
+    The categories of each categorical column are combined, where pandas.concat would store the
+    values of categoricals with different categories as objects.
+    :param frames: Iterable of data frames
+    :return: The concatenated data frame
+    """
+    frames = list(frames)
+    columns = list(OrderedDict((column, None) for df in frames for column in df.columns))
+    concatenated = OrderedDict()
+    for column in columns:
+        parts = [df[column] if column in df.columns else pd.Series(np.nan, index=range(len(df)), dtype=object)
+                 for df in frames]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            concatenated[column] = union_categoricals(parts, ignore_order=True)
+        else:
+            concatenated[column] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(concatenated)
+
+
+def get_run_sources(data_subset_dir, spill_segments=None):
+    """
+    Lists the sources of the sorted runs of a data set in a split, in the order that they're aggregated
+
+    :param data_subset_dir: The data set's directory in the split (or its spill directory)
+    :param spill_segments: If the data set was split into spill files, the columns and spill file
+    segments of the data set in this split (see get_spill_segments)
+    :return: List of the sources: a (columns, [segment]) tuple for each spill file segment, a
+    (file, part) tuple for each part of a file in the columnar format, or otherwise the file itself
+    """
+    if spill_segments is not None:
+        columns, segments = spill_segments
+        return [(columns, [segment]) for segment in sorted(segments)]
+
+    sources = []
+    for file in listdir(data_subset_dir):
+        if file.endswith(".tmp"):
+            continue  # left over from a split that didn't finish
+        if file.endswith(".npz"):
+            sources.extend((file, part) for part in list_columnar_parts(file))
+        else:
+            sources.append(file)
+    return sources
+
+
+def read_run_source(source, usecols, memory_budget, dtype=None, reader="pandas"):
+    """
+    Reads a source of sorted runs (see get_run_sources) a block at a time
+
+    :param source: A source from get_run_sources
+    :param usecols: The columns to read
+    :param memory_budget: Number of bytes that each block may use
+    :param dtype: Map from columns to the dtypes to read CSV with (see schema.get_dtypes)
+    :param reader: The CSV reader to parse CSV with, one of readers.csv_readers
+    :return: A generator yielding data frames of consecutive rows of the source
+    """
+    if not isinstance(source, tuple):
+        return read_csv_chunks(source, memory_budget, reader, usecols=lambda c: c in usecols, dtype=dtype)
+    if isinstance(source[1], list):
+        return iter_spill_dataframes(*source, usecols=usecols, memory_budget=memory_budget, dtype=dtype)
+    return read_columnar_parts(source[0], usecols, parts=[source[1]])
+
+
+def get_run_lengths(blocks, key, time_col='endpoint_ts'):
+    """
+    Finds the lengths of the sorted runs that a sequence of rows is made of
+
+    A new run starts wherever the order of the rows descends.
+    :param blocks: Iterable of data frames of consecutive rows
+    :param key: The key column that the runs are sorted by
+    :param time_col: The time column that the runs are sorted by within each key
+    :return: List of the number of rows in each run
+    """
+    run_lengths, length, last = [], 0, None
+    for block in blocks:
+        if block.empty:
+            continue
+        codes, times = get_sort_keys(block, key, time_col)
+        previous_codes, previous_times = last if last is not None else (codes[:1], times[:1])
+        previous_codes = np.concatenate((previous_codes, codes[:-1]))
+        previous_times = np.concatenate((previous_times, times[:-1]))
+        descents = (codes < previous_codes) | ((codes == previous_codes) & (times < previous_times))
+        for position in np.flatnonzero(descents):
+            run_lengths.append(length + position)
+            length = -position
+        length += len(block)
+        last = (codes[-1:], times[-1:])
+    if length > 0:
+        run_lengths.append(length)
+    return run_lengths
+
+
+def get_appended_runs(read, key, columns, scratch_directory, name, memory_budget):
+    """
+    Gets a stream of each of the sorted runs of a file whose runs were appended one after the other
+
+    A file that is one sorted run is streamed as it is. Otherwise its runs are copied to their own
+    files in the scratch directory, so that each of them can be read at the same time.
+    :param read: Function that reads the rows of the file a block at a time
+    :param key: The key column that the runs are sorted by
+    :param columns: The columns of the rows
+    :param scratch_directory: Directory to copy the runs to
+    :param name: Name of the file, for the names of the copies of its runs
+    :param memory_budget: Number of bytes that each block may use
+    :return: List of iterables of data frames of the rows of each run
+    """
+    run_lengths = get_run_lengths(read(), key)
+    if len(run_lengths) <= 1:
+        return [read()]
+
+    run_files = [os.path.join(scratch_directory, "%s-%05d.tsv" % (name, i)) for i in range(len(run_lengths))]
+    runs = iter(zip(run_lengths, run_files))
+    writer, remaining = None, 0
+    try:
+        for block in read():
+            while not block.empty:
+                if remaining == 0:
+                    if writer is not None:
+                        writer.close()
+                    remaining, run_file = next(runs)
+                    writer = BlockWriter(run_file, columns)
+                rows = block.iloc[:remaining]
+                writer.write(rows)
+                remaining -= len(rows)
+                block = block.iloc[len(rows):]
+    finally:
+        if writer is not None:
+            writer.close()
+    return [read_run_file(f, columns, memory_budget) for f in run_files]
+
+
+# Memory budget (bytes) of a worker that merges streams of sorted runs without a budget of its own
+default_memory_budget = 2 ** 30
+
+# The most streams that are merged at once. More are merged in several passes.
+max_merge_streams = 64
+
+
+class BlockWriter(TableWriter):
+    """
+    Writes rows to a TSV file one block at a time (see writers.TableWriter)
+    """
+
+    def __init__(self, path, columns, threaded=False, compression=None):
+        """
+        :param path: Path to the file to write
+        :param columns: The columns of the rows
+        :param threaded: Write the blocks from a thread of their own, while the next ones are merged
+        :param compression: The codec to compress the file with, one of compressors.compression_codecs or None
+        """
+        super(BlockWriter, self).__init__(path, columns, sep="\t", threaded=threaded, compression=compression)
+
+
+class SortedRuns(object):
+    """
+    Rows sorted by key and time in runs of bounded size, which are spilled to scratch files and merged
+
+    Rows are added in chunks and buffered until they fill the memory budget, at which point they're
+    sorted into a run and written to a TSV file in the scratch directory. The runs are then merged by
+    reading a block of each at a time (see merge_streams). The result is the same as a stable sort
+    of all of the rows at once. If all of the rows fit in one run, they're just sorted in memory.
+    """
+
+    def __init__(self, scratch_directory, key, columns, memory_budget, overhead=4):
+        """
+        :param scratch_directory: Directory to write the runs to
+        :param key: The key column to sort by
+        :param columns: The columns of the rows
+        :param memory_budget: Memory budget (bytes) for sorting runs and merging them
+        :param overhead: Multiple of the size of a run that is used while sorting it
+        """
+        self.scratch_directory = scratch_directory
+        self.key = key
+        self.columns = columns
+        self.memory_budget = memory_budget
+        self.run_size = memory_budget / overhead
+        self.buffer = []
+        self.buffer_size = 0
+        self.run_files = []
+
+    def add(self, df):
+        """
+        Adds rows, which are sorted into a run once the buffered rows fill the memory budget
+
+        :param df: Data frame of the rows to add
+        :return: None
+        """
+        self.buffer.append(df)
+        self.buffer_size += df.memory_usage(deep=True, index=False).sum()
+        if self.buffer_size >= self.run_size:
+            self.spill()
+
+    def sorted_buffer(self):
+        buffered = pd.concat(self.buffer) if self.buffer else pd.DataFrame(columns=self.columns)
+        return sort_by_key(buffered, self.key)
+
+    def spill(self):
+        """
+        Sorts the buffered rows and writes them to a run file
+
+        :return: None
+        """
+        if not self.buffer:
+            return
+        run_file = os.path.join(self.scratch_directory, "run-%05d.tsv" % len(self.run_files))
+        logger.debug("Spilling sorted run of %d rows: %s" % (sum(map(len, self.buffer)), run_file))
+        self.sorted_buffer().to_csv(run_file, index=False, sep="\t")
+        self.run_files.append(run_file)
+        self.buffer = []
+        self.buffer_size = 0
+
+    def merge(self, write):
+        """
+        Merges all of the rows into sorted order
+
+        :param write: Function to call with each block of sorted rows, in order
+        :return: None
+        """
+        if not self.run_files:
+            write(self.sorted_buffer())
+            return
+        self.spill()
+        logger.debug("Merging %d sorted runs" % len(self.run_files))
+        merge_streams(read_run_files(self.run_files, self.columns, self.memory_budget), self.key, self.columns,
+                      write, self.memory_budget, self.scratch_directory)
+
+
+def read_run_file(run_file, columns, memory_budget, time_col='endpoint_ts'):
+    """
+    Reads a TSV file of a sorted run a block at a time
+
+    The values are read as strings, so that they're written exactly as they were in the run, except
+    for the times, which are read as integers if they were split as milliseconds since the epoch.
+    Only empty values are read as missing, since that's how missing values are written, so that
+    missing keys are sorted last again as they were when the run was sorted (see codec.encode_keys).
+    :param run_file: Path to the run file
+    :param columns: The columns of the run
+    :param memory_budget: Number of bytes that each block may use
+    :param time_col: The time column
+    :return: A generator yielding the blocks of the run
+    """
+    dtype = {column: str for column in columns if column != time_col}
+    return read_csv_chunks(run_file, memory_budget, sep="\t", dtype=dtype, keep_default_na=False, na_values=[''])
 
-    logger.debug("Sorting: %s" % split_directory)
-    if strategy == MergeType.user:
-        df.sort_values(by=['user_id', 'endpoint_ts'], inplace=True)
-        final_columns = ['user_id', 'endpoint_ts', 'event_type'] + ['param_%d' % i for i in range(6)]
-    else:
-        df.sort_values(by=['post_fullname', 'endpoint_ts'], inplace=True)
-        final_columns = ['post_fullname', 'endpoint_ts', 'event_type'] + ['param_%d' % i for i in range(6)]
-    df = df[final_columns]  # rearrange columns...
 
-    # Safe the data frame as it's final output
-    save_final_merge(df, output_directory, split_directory, strategy)
+def read_run_files(run_files, columns, memory_budget):
+    """
+    Reads TSV files of sorted runs a block at a time, within a memory budget for all of them
+
+    :param run_files: Paths to the run files
+    :param columns: The columns of the runs
+    :param memory_budget: Memory budget (bytes) for the blocks of all of the runs
+    :return: List of generators yielding the blocks of each run
+    """
+    block_budget = memory_budget // (min(len(run_files), max_merge_streams) + 1)
+    return [read_run_file(f, columns, block_budget) for f in run_files]
+
+
+def merge_streams(streams, key, columns, write, memory_budget, scratch_directory, time_col='endpoint_ts'):
+    """
+    Merges any number of streams of sorted runs (see merge_sorted_streams)
+
+    If there are more than max_merge_streams streams, consecutive groups of them are first merged into
+    runs in the scratch directory, so that no more than max_merge_streams files are read at once.
+    :param streams: List of iterables of data frames of sorted runs
+    :param key: The key column that the runs are sorted by
+    :param columns: The columns of the rows
+    :param write: Function to call with each block of merged rows, in order
+    :param memory_budget: Memory budget (bytes) for the blocks of the runs
+    :param scratch_directory: Directory to write the runs of the passes to
+    :param time_col: The time column that the runs are sorted by within each key
+    :return: None
+    """
+    merge_pass = 0
+    while len(streams) > max_merge_streams:
+        run_files = []
+        for group in iter_batches(streams, max_merge_streams):
+            run_file = os.path.join(scratch_directory, "pass-%d-%05d.tsv" % (merge_pass, len(run_files)))
+            writer = BlockWriter(run_file, columns)
+            try:
+                merge_sorted_streams(group, key, writer.write, time_col=time_col)
+            finally:
+                writer.close()
+            run_files.append(run_file)
+        logger.debug("Merged %d streams into %d runs" % (len(streams), len(run_files)))
+        streams = read_run_files(run_files, columns, memory_budget)
+        merge_pass += 1
+    merge_sorted_streams(streams, key, write, time_col=time_col)
+
+
+def _next_block(blocks):
+    for block in blocks:
+        if not block.empty:
+            return block
+    return None  # the stream has ended
+
+
+def merge_sorted_streams(streams, key, write, time_col='endpoint_ts'):
+    """
+    Merges streams of sorted rows into sorted order, holding one block of each stream at a time
+
+    Each stream is a sequence of blocks of rows sorted by key and then by time, e.g. a sorted run
+    that is read a chunk at a time. In each round, the buffered rows of all the streams are sorted
+    together and written up to the first row that is the last buffered row of one of the streams:
+    every row that is yet to be read sorts after it. The rest are kept for the next round, in which
+    the streams whose buffers were written read their next block. Ties are broken by the order of
+    the streams and of the rows in them, so that the result is the same as a stable sort of all of
+    the rows, one stream after the other.
+    :param streams: List of iterables of data frames
+    :param key: The key column that the rows are sorted by
+    :param write: Function to call with each block of merged rows, in order
+    :param time_col: The time column that the rows are sorted by within each key
+    :return: None
+    """
+    streams = [iter(blocks) for blocks in streams]
+    buffers = [_next_block(blocks) for blocks in streams]
+    while True:
+        active = [i for i, buffer in enumerate(buffers) if buffer is not None]
+        if not active:
+            return
+
+        merged = pd.concat([buffers[i] for i in active], ignore_index=True)
+        order = get_sort_order(merged, key, time_col)
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order))
+
+        ends = np.cumsum([len(buffers[i]) for i in active])
+        bound = ranks[ends - 1].min()
+        write(merged.iloc[order[:bound + 1]])
+
+        for i, start, end in zip(active, np.concatenate(([0], ends[:-1])), ends):
+            rest = ranks[start:end] > bound
+            buffers[i] = buffers[i].iloc[rest] if rest.any() else _next_block(streams[i])
 
 
-def save_final_merge(df, output_directory, split_directory, strategy):
+def save_final_merge(df, output_directory, split_directory, strategy, compression=None):
     """
     Saves the final, merged data frame to the output directory
 
+    The files are written under temporary names and only moved into place (and the merge
+    recorded in the manifest of the output directory) once they've been written completely.
     :param df: The DataFrame containing the final, merged
     :param output_directory: The output directory to store the saved data frame
     :param split_directory: The split directory from which the aggregated DataFrame was made
     :param strategy: Whether the DataFrame was generated for submission or user merge
+    :param compression: The codec to compress the files with, one of compressors.compression_codecs or None
     :return: None
     """
-
+    df = render_times(df)
+    outputs = []
     if strategy == MergeType.submission:
         # Filter out comments that were not found in the map
         unknown_comments = df['post_fullname'].str.startswith('t1')
         logger.info("Filtering out %d unknown comments..." % np.sum(unknown_comments))
         missing_comments = df[unknown_comments]
 
-        missing_dir = os.path.join(output_directory, "missing")
-        mkdir(missing_dir)
-        missing_comments_filename = os.path.join(missing_dir,  "%05d.tsv" % get_split_number(split_directory))
-
+        missing_comments_filename = get_missing_file(output_directory, split_directory, compression)
         logger.info("Saving filtered comments: %s" % missing_comments_filename)
-        missing_comments.to_csv(missing_comments_filename, index=False, sep="\t")
+        write_data(missing_comments_filename + ".tmp", format_csv(missing_comments, sep="\t"),
+                   compression=compression)
+        outputs.append(missing_comments_filename)
 
         # Keep just the ones that were able to be looked up
         df = df[~unknown_comments]
 
-    final_output_file = get_aggregate_file(output_directory, split_directory)
+    final_output_file = get_aggregate_file(output_directory, split_directory, compression)
     logger.info("Writing output: %s" % final_output_file)
+    outputs.append(final_output_file)
     try:
-        df.to_csv(final_output_file, index=False, sep="\t")
+        write_data(final_output_file + ".tmp", format_csv(df, sep="\t"), compression=compression)
         logger.info("Finished writing: %s" % final_output_file)
     except:
         logger.error("Could not write output file: %s" % final_output_file)
+        discard_outputs(outputs)
+        return
+
+    record_task(output_directory, get_merge_task_name(split_directory), len(df), commit_outputs(outputs))
+
+
+def save_merged_blocks(merge, columns, output_directory, split_directory, strategy, compression=None):
+    """
+    Saves the final output of a merge that is written a block at a time to the output directory
+
+    :param merge: Function that merges the split, calling the function that it's passed with each
+    block of merged rows, in order (e.g. SortedRuns.merge)
+    :param columns: The columns of the output
+    :param output_directory: The output directory to store the output in
+    :param split_directory: The split directory that is merged
+    :param strategy: Whether the split is merged by submission or by user
+    :param compression: The codec to compress the files with, one of compressors.compression_codecs or None
+    :return: None
+    """
+    final_output_file = get_aggregate_file(output_directory, split_directory, compression)
+    outputs = [final_output_file]
+    writer = BlockWriter(final_output_file + ".tmp", columns, threaded=True, compression=compression)
+    missing_writer = None
+    if strategy == MergeType.submission:
+        missing_comments_filename = get_missing_file(output_directory, split_directory, compression)
+        outputs.append(missing_comments_filename)
+        missing_writer = BlockWriter(missing_comments_filename + ".tmp", columns, threaded=True,
+                                     compression=compression)
+
+    def write(df):
+        df = render_times(df)
+        if missing_writer is not None:
+            # Filter out comments that were not found in the map
+            unknown_comments = df['post_fullname'].str.startswith('t1').fillna(False).to_numpy(dtype=bool)
+            missing_writer.write(df[unknown_comments])
+            df = df[~unknown_comments]
+        writer.write(df)
+
+    logger.info("Writing output: %s" % final_output_file)
+    try:
+        merge(write)
+    finally:
+        writer.close()
+        if missing_writer is not None:
+            missing_writer.close()
+    logger.info("Finished writing: %s" % final_output_file)
+    if missing_writer is not None:
+        logger.info("Filtered out %d unknown comments" % missing_writer.num_rows)
+
+    record_task(output_directory, get_merge_task_name(split_directory), writer.num_rows, commit_outputs(outputs))
+
 
+def render_times(df, time_col='endpoint_ts'):
+    """
+    Renders the times of merged rows as strings, if they were split as milliseconds since the epoch
 
-def aggregate_dataframes(directory):
+    :param df: Data frame of merged rows
+    :param time_col: The time column
+    :return: The data frame, with its times as strings such as "2017-04-09 04:57:59.276 UTC"
+    """
+    if not pd.api.types.is_integer_dtype(df[time_col]):
+        return df
+    return df.assign(**{time_col: decode_timestamps(df[time_col])})
+
+
+def get_missing_file(output_directory, split_directory, compression=None):
+    """
+    Determine the file to write the comments of a split that were not found in the map to
+
+    :param output_directory: Output directory of the merge
+    :param split_directory: The split directory that is merged
+    :param compression: The codec that the file is compressed with (see compressors.py), which names its extension
+    :return: Path to the split's file in the "missing" sub-directory of the output directory
+    """
+    missing_dir = os.path.join(output_directory, "missing")
+    mkdir(missing_dir)
+    return os.path.join(missing_dir, compressed_file_name("%05d.tsv" % get_split_number(split_directory), compression))
+
+
+def aggregate_dataframes(directory, usecols=None, dtype=None, reader="pandas"):
     """
     Reads every file from a directory into a single data frame
 
     All data frames from all files in the specified directory are
     read and concatenated together into a single data frame
-    :param directory: Directory containing files with pandas data frames
+    :param directory: Directory containing files with pandas data frames (CSV,
+    or the columnar format of columnar.py)
+    :param usecols: The columns to read. If None, all columns are read.
+    :param dtype: Map from columns to the dtypes to read CSV with (see schema.get_dtypes). If None, they're inferred.
+    :param reader: The CSV reader to parse CSV with, one of readers.csv_readers
     :return: A single data frame made by concatenating all dataframes together
     """
+    return pd.concat(iter_dataframes(directory, usecols=usecols, dtype=dtype, reader=reader))
+
+
+def iter_dataframes(directory, usecols=None, memory_budget=None, dtype=None, reader="pandas"):
+    """
+    Reads every file from a directory as a sequence of data frames
+
+    :param directory: Directory containing files with pandas data frames (CSV,
+    or the columnar format of columnar.py)
+    :param usecols: The columns to read. If None, all columns are read.
+    :param memory_budget: Number of bytes that each data frame may use. If None, each file is read at once.
+    :param dtype: Map from columns to the dtypes to read CSV with (see schema.get_dtypes). If None, they're inferred.
+    :param reader: The CSV reader to parse CSV with, one of readers.csv_readers
+    :return: A generator yielding data frames of the rows of each file, in chunks
+    """
+    selected = None if usecols is None else lambda c: c in usecols
+
     def read(file):
+        if file.endswith(".npz"):
+            return read_columnar_parts(file, usecols)
+        return read_csv_chunks(file, memory_budget, reader, usecols=selected, dtype=dtype)
+
+    # Files with temporary names are left over from splits that didn't finish
+    for file in listdir(directory):
+        if file.endswith(".tmp"):
+            continue
         try:
-            return pd.read_csv(file, compression='infer')
-        except UnicodeDecodeError:
-            return pd.read_csv(file, compression='gzip')
+            for df in read(file):
+                yield df
         except:
             logger.error("COULD NOT READ: %s" % file)
-            return pd.DataFrame()  # return an empty data frame...
+            yield pd.DataFrame()  # return an empty data frame...
 
-    return pd.concat(map(read, listdir(directory)))
+
+def iter_spill_dataframes(columns, segments, usecols=None, memory_budget=None, overhead=4, dtype=None):
+    """
+    Reads the segments of spill files that belong to one split as a sequence of data frames
+
+    :param columns: The columns of the data set stored in the segments
+    :param segments: List of (spill file, offset, length) tuples to read
+    :param usecols: The columns to read. If None, all columns are read.
+    :param memory_budget: Number of bytes that each data frame may use. If None, all segments are read at once.
+    :param overhead: Multiple of the size of the segments that is used once they're read
+    :param dtype: Map from columns to the dtypes to read the CSV segments with (see schema.get_dtypes)
+    :return: A generator yielding data frames of the rows of consecutive segments
+    """
+    if memory_budget is None:
+        yield read_spill_segments(columns, segments, usecols=usecols, dtype=dtype)
+        return
+
+    batch, batch_size = [], 0
+    for segment in sorted(segments):
+        if batch and batch_size + segment[2] > memory_budget / overhead:
+            yield read_spill_segments(columns, batch, usecols=usecols, dtype=dtype)
+            batch, batch_size = [], 0
+        batch.append(segment)
+        batch_size += segment[2]
+    yield read_spill_segments(columns, batch, usecols=usecols, dtype=dtype)
 
 
 def rearrange_for_user_join(df, data_type, event_type='event_type'):
@@ -189,45 +807,14 @@ def rearrange_for_user_join(df, data_type, event_type='event_type'):
     :param event_type: The name specifying what kind of event is stored in the data frame
     :return: The modified data frame
     """
-    if data_type == DataType.unknown: return
+    if data_type not in schemas: return
+    schema = schemas[data_type]
 
     base_cols = ['user_id', 'endpoint_ts', event_type]
-
-    if data_type == DataType.users:
-        # registration_dt,user_id,registration_country_code,is_suspended
-        df[event_type] = 'create'
-        df.rename(columns={"registration_dt": "endpoint_ts"}, inplace=True)
-        param_cols = ['registration_country_code', 'is_suspended']
-
-    if data_type == DataType.votes:
-        # endpoint_ts,user_id,sr_name,target_fullname,target_type,vote_direction
-        df[event_type] = 'vote'
-        param_cols = ['sr_name', 'target_fullname', 'target_type', 'vote_direction']
-
-    if data_type == DataType.comments:
-        # endpoint_ts,user_id,sr_name,comment_fullname,comment_body,parent_fullname,post_fullname
-        df[event_type] = 'comment'
-        param_cols = ['sr_name', 'comment_fullname', 'comment_body', 'parent_fullname', 'post_fullname']
-
-    if data_type == DataType.submissions:
-        # endpoint_ts,user_id,sr_name,post_fullname,post_type,post_title,post_target_url,post_body
-        df[event_type] = 'submission'
-        param_cols = ['sr_name', 'post_fullname', 'post_type', 'post_title', 'post_target_url', 'post_body']
-
-    if data_type == DataType.subscriptions:
-        # endpoint_ts,user_id,sr_name,event_type
-        # event_type is already present here
-        param_cols = ['sr_name']
-
-    if data_type == DataType.removals:
-        # endpoint_ts,user_id,sr_name,event_type,target_fullname,target_type,user_type
-        # event_type is already present here
-        param_cols = ['sr_name', 'target_fullname', 'target_type', 'user_type']
-
-    if data_type == DataType.reports:
-        # endpoint_ts,user_id,sr_name,target_fullname,target_type,process_notes,details_text
-        df[event_type] = 'report'
-        param_cols = ['sr_name', 'target_fullname', 'target_type', 'process_notes', 'details_text']
+    df = df.rename(columns={schema.time_column: "endpoint_ts"})
+    if schema.event_type is not None:
+        df[event_type] = pd.Categorical.from_codes(np.zeros(len(df), dtype=np.int8), [schema.event_type])
+    param_cols = schema.params['user_id']
 
     df = df[base_cols + param_cols]  # reorder columns
     new_columns = base_cols + ['param_%d' % i for i in range(len(param_cols))]
@@ -246,36 +833,15 @@ def rearrange_for_submission_join(df, data_type, event_type='event_type'):
     :param event_type: The name specifying what kind of event is stored in the data frame
     :return: The modified data frame
     """
-    if data_type in [DataType.unknown, DataType.subscriptions, DataType.users]:
+    if get_merge_columns(data_type, 'post_fullname') is None:
         logger.error("Invalid data type")
         return
+    schema = schemas[data_type]
 
     base_cols = ['post_fullname', 'endpoint_ts', event_type]
-
-    if data_type == DataType.submissions:
-        # endpoint_ts,user_id,sr_name,post_fullname,post_type,post_title,post_target_url,post_body
-        df[event_type] = 'submission'
-        param_cols = ['user_id', 'sr_name', 'post_type', 'post_title', 'post_target_url', 'post_body']
-
-    if data_type == DataType.comments:
-        # endpoint_ts,user_id,sr_name,comment_fullname,comment_body,parent_fullname,post_fullname
-        df[event_type] = 'comment'
-        param_cols = ['user_id', 'sr_name', 'comment_fullname', 'parent_fullname', 'comment_body']
-
-    if data_type == DataType.votes:
-        # endpoint_ts,user_id,sr_name,target_fullname,target_type,vote_direction
-        df[event_type] = 'vote'
-        param_cols = ['user_id', 'sr_name', 'target_fullname', 'target_type', 'vote_direction']
-
-    if data_type == DataType.removals:
-        # endpoint_ts,user_id,sr_name,event_type,target_fullname,target_type,user_type
-        # event_type is already present here
-        param_cols = ['user_id', 'sr_name', 'target_fullname', 'target_type', 'user_type']
-
-    if data_type == DataType.reports:
-        # endpoint_ts,user_id,sr_name,target_fullname,target_type,process_notes,details_text
-        df[event_type] = 'report'
-        param_cols = ['user_id', 'sr_name', 'target_fullname', 'target_type', 'process_notes', 'details_text']
+    if schema.event_type is not None:
+        df[event_type] = pd.Categorical.from_codes(np.zeros(len(df), dtype=np.int8), [schema.event_type])
+    param_cols = schema.params['post_fullname']
 
     df = df[base_cols + param_cols]  # reorder columns
     new_columns = base_cols + ['param_%d' % i for i in range(len(param_cols))]
@@ -342,15 +908,25 @@ def parse_args():
     io_options_group = parser.add_argument_group("I/O Options")
     io_options_group.add_argument('-i', "--input", help="Input directory")
     io_options_group.add_argument('-o', "--output", help="Output directory")
+    io_options_group.add_argument('--scratch', help="Local scratch directory for the sorted runs of --memory-budget")
+    io_options_group.add_argument('-c', '--compress', nargs='?', choices=installed_codecs(), default="none",
+                                  const=fastest_codec(),
+                                  help="Compress the output files with a codec (the fastest installed one if not given)")
 
     options_group = parser.add_argument_group("Options")
     options_group.add_argument("--users", action="store_true", help="Merge data set split by users")
     options_group.add_argument("--submissions", action="store_true", help="Merge data set split by submission")
     options_group.add_argument('-s', '--sequential', action='store_true', help="Process sequentially")
     options_group.add_argument('-p', '--pool-size', type=int, default=20, help="Thread-pool size")
+    options_group.add_argument('-m', '--memory-budget', type=int,
+                               help="Per-worker memory budget (MB): sort each split in runs that fit within it")
     options_group.add_argument('-r', '--range', type=int, nargs='+', help="Range of splits to process (inclusive)")
     options_group.add_argument('--set', type=int, nargs='+', help="Set of splits numbers to merge")
     options_group.add_argument('--set-file', type=str, help="File containing a set of splits to merge")
+    options_group.add_argument('--reader', choices=installed_csv_readers(), default=default_csv_reader(),
+                               help="CSV reader to parse the split files with: pandas, or pyarrow's multithreaded reader")
+    options_group.add_argument('--resume', action='store_true',
+                               help="Only merge the splits that the manifest of the output doesn't record as complete")
 
     console_options_group = parser.add_argument_group("Console Options")
     console_options_group.add_argument('-v', '--verbose', action='store_true', help='verbose output')
@@ -385,11 +961,15 @@ def main():
         logger.debug("Output directory: %s" % output_directory)
 
     strategy = MergeType.submission if args.submissions else MergeType.user
+    memory_budget = None if args.memory_budget is None else args.memory_budget * 2 ** 20
+    scratch_directory = None if args.scratch is None else os.path.expanduser(args.scratch)
 
     logger.info("Merge type: %s" % strategy)
     merge_dataset(input_directory, output_directory, strategy,
                   split_set=split_set,
-                  pool_size=args.pool_size, sequential=args.sequential)
+                  pool_size=args.pool_size, sequential=args.sequential, resume=args.resume,
+                  memory_budget=memory_budget, scratch_directory=scratch_directory, reader=args.reader,
+                  compression=args.compress)
 
 
 if __name__ == "__main__":
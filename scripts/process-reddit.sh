@@ -14,6 +14,7 @@ REDDIT="/dfs/dataset/infolab/20180122-Reddit/data"
 OUTPUT_DIRECTORY="/dfs/scratch2/jdeaton/reddit/reddit_processed"
 PYTHON=$(which python)
 POOL_SIZE=64
+REDIS_SHARDS=8 # Number of Redis instances to shard the comment map over (Redis runs on one core each)
 
 ##################################################
 
@@ -33,9 +34,29 @@ TIME=$(date +"%Y-%m-%d_%H-%M-%S")
 
 # Database to store comment --> base submission mapping (~100 GB)
 REDIS_DIR="$SCRATCH/redis"
+REDIS_LOAD_DIR="$SCRATCH/redis_load" # Comment map in the Redis protocol, for mass insertion
 
 mkdir -p $REDIS_DIR
 
+# One Redis instance per shard, each listening on a Unix socket and saving to its own directory
+REDIS_SOCKETS=()
+for ((i = 0; i < REDIS_SHARDS; i++)); do
+    REDIS_SOCKETS+=("$REDIS_DIR/shard-$(printf %02d $i)/redis.sock")
+done
+
+start_redis() { # Start the Redis instances (each loads its dump.rdb if it was saved before)
+    for socket in "${REDIS_SOCKETS[@]}"; do
+        mkdir -p "$(dirname "$socket")"
+        redis-server --dir "$(dirname "$socket")" --port 0 --unixsocket "$socket" --daemonize yes
+    done
+}
+
+stop_redis() {
+    for socket in "${REDIS_SOCKETS[@]}"; do
+        redis-cli -s "$socket" shutdown
+    done
+}
+
 : '
 echo
 echo "Running User Splitting"
@@ -55,16 +76,39 @@ echo "Running User Splitting"
 '
 
 : '
+echo
+echo "Bulk loading comment map into Redis"
+start_redis
+if [ ! -f "$(dirname "${REDIS_SOCKETS[0]}")/dump.rdb" ]; then
+    "$PYTHON" ./redis-mass-insert.py \
+        --input "$REDDIT" \
+        --output "$REDIS_LOAD_DIR" \
+        --shards "$REDIS_SHARDS" \
+        --bloom-filter "$REDIS_DIR/comments.bloom" \
+        --pool-size "$POOL_SIZE" \
+        --debug --log "$LOG/mass_insert-$HOSTNAME-$TIME.log"
+    for ((i = 0; i < REDIS_SHARDS; i++)); do
+        if [ "$REDIS_SHARDS" -eq 1 ]; then shard_dir="$REDIS_LOAD_DIR"; else shard_dir="$REDIS_LOAD_DIR/shard-$(printf %02d $i)"; fi
+        cat "$shard_dir"/*.resp | redis-cli -s "${REDIS_SOCKETS[$i]}" --pipe &
+    done
+    wait
+    for socket in "${REDIS_SOCKETS[@]}"; do
+        redis-cli -s "$socket" save # snapshot, so that the next run starts with the map already loaded
+    done
+fi
+
 echo
 echo "Running Submission Splitting"
-redis-server --dir "$REDIS_DIR" --daemonize yes # Start the Redis database
 "$PYTHON" ./split-submissions.py \
     --input "$REDDIT" \
     --output "$SUBMISSIONS_SPLIT_DIR" \
     --pool-size "$POOL_SIZE" \
+    --redis "${REDIS_SOCKETS[@]}" \
+    --map-loaded \
+    --bloom-filter "$REDIS_DIR/comments.bloom" \
     --debug --log "$LOG/split_sub-$HOSTNAME-$TIME.log" || echo "Failed. Redis DB still running..." && exit $?
 
-redis-cli shutdown & # shutdown the Redis database
+stop_redis & # shutdown the Redis databases
 '
 
 echo
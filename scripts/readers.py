@@ -0,0 +1,239 @@
+"""
+File: readers.py
+
+Backends that the CSV files of the Reddit data-set are parsed with
+
+    - pandas: the C engine of pandas.read_csv, which parses each file on one thread
+    - arrow: the CSV reader of pyarrow (if it's installed), which parses blocks of a file on several threads
+
+Both read the same files into the same data frames: quoted values may span lines (as the bodies of
+comments and submissions do), the same values are read as missing, and a compressed file is
+decompressed with the codec of its extension (see compressors.py). The arrow reader is only
+used for reads whose columns all have a declared dtype (see schema.py), since it would infer types
+(such as dates) that pandas leaves as strings. Any other read is passed on to pandas. A file that
+is read in chunks is parsed by the arrow reader in blocks of whole rows, each on several threads.
+"""
+
+import csv
+import numpy as np
+import pandas as pd
+
+from compressors import get_codec, get_file_codec, open_file
+
+csv_readers = ["pandas", "arrow"]
+
+# The keyword arguments of pandas.read_csv that the arrow reader supports
+arrow_arguments = {'sep', 'usecols', 'dtype', 'compression', 'keep_default_na', 'chunksize'}
+
+# Number of bytes of a file that the arrow reader parses at a time when it reads the file in chunks
+arrow_block_size = 2 ** 26
+
+
+def arrow_installed():
+    try:
+        import pyarrow.csv
+    except ImportError:
+        return False
+    return True
+
+
+def installed_csv_readers():
+    """
+    Lists the CSV readers that can be used here
+
+    :return: The elements of csv_readers whose libraries are installed
+    """
+    return [reader for reader in csv_readers if reader != "arrow" or arrow_installed()]
+
+
+def default_csv_reader():
+    """
+    Chooses the fastest CSV reader that is installed
+
+    :return: "arrow" if pyarrow is installed, otherwise "pandas"
+    """
+    return "arrow" if arrow_installed() else "pandas"
+
+
+def read_csv(file_path, reader="pandas", **kwargs):
+    """
+    Reads a CSV file with one of the CSV readers
+
+    :param file_path: Path to the CSV file to read
+    :param reader: One of csv_readers
+    :param kwargs: Keyword arguments of pandas.read_csv. With "chunksize", the file is read in chunks of that many rows.
+    :return: A data frame of the file, or with "chunksize", an iterable of data frames of consecutive rows of it
+    """
+    if reader == "arrow" and set(kwargs) <= arrow_arguments:
+        arguments = dict(kwargs)
+        dtype = arguments.pop('dtype', None) or {}
+        columns = select_columns(read_header(file_path, kwargs.get('sep', ','), kwargs.get('compression', 'infer')),
+                                 arguments.pop('usecols', None))
+        if all(column in dtype for column in columns):
+            return read_csv_arrow(file_path, columns, dtype, **arguments)
+    elif reader not in csv_readers:
+        raise ValueError("Unknown CSV reader: %s" % reader)
+    return read_csv_pandas(file_path, **kwargs)
+
+
+def get_compression(file_path, compression='infer'):
+    # The codec of a file: None if it isn't compressed, told from its name if it's "infer"
+    return get_file_codec(file_path) if compression == 'infer' else get_codec(compression)
+
+
+def read_csv_pandas(file_path, compression='infer', **kwargs):
+    """
+    Reads a CSV file with pandas, decompressing it with the codec of its name (see compressors.py)
+
+    :param file_path: Path to the CSV file to read
+    :param compression: One of compressors.compression_codecs, None, or "infer" to tell it from the file's name
+    :param kwargs: Keyword arguments of pandas.read_csv
+    :return: A data frame of the file, or with "chunksize", an iterable of data frames of consecutive rows of it
+    """
+    codec = get_compression(file_path, compression)
+    if codec is None:
+        return pd.read_csv(file_path, compression=None, **kwargs)
+
+    f = open_file(file_path, 'rb', codec)
+    if kwargs.get('chunksize') is None and kwargs.get('iterator') is not True:
+        with f:
+            return pd.read_csv(f, **kwargs)
+
+    def read_chunks():
+        with f:
+            for chunk in pd.read_csv(f, **kwargs):
+                yield chunk
+
+    return read_chunks()
+
+
+def read_header(file_path, sep=",", compression='infer'):
+    """
+    Reads the names of the columns of a CSV file from its first line
+
+    :param file_path: Path to the CSV file
+    :param sep: The delimiter of the file
+    :param compression: The codec of the file (see compressors.py), or "infer" to tell it from the file's name
+    :return: List of the names of the columns
+    """
+    with open_file(file_path, 'rb', compression) as f:
+        line = f.readline().decode()
+    return next(csv.reader([line], delimiter=sep), [])
+
+
+def select_columns(columns, usecols=None):
+    """
+    Selects the columns of a file that are read, as pandas.read_csv does
+
+    :param columns: The columns of the file
+    :param usecols: The columns to read: a list, a function that is passed each name, or None for all columns
+    :return: List of the columns that are read, in the order of the file
+    """
+    if usecols is None:
+        return list(columns)
+    if callable(usecols):
+        return [column for column in columns if usecols(column)]
+    return [column for column in columns if column in usecols]
+
+
+def is_boolean(dtype):
+    return isinstance(dtype, str) and dtype == 'boolean'
+
+
+def get_arrow_type(dtype):
+    # The arrow type of a dtype of schema.py
+    import pyarrow as pa
+    if dtype is str or isinstance(dtype, str) and dtype == 'str':
+        return pa.string()
+    if is_boolean(dtype):
+        return pa.bool_()
+    return pa.from_numpy_dtype(np.dtype(dtype))
+
+
+def read_csv_arrow(file_path, columns, dtype, sep=",", compression='infer', keep_default_na=True, chunksize=None):
+    """
+    Reads a CSV file with pyarrow
+
+    :param file_path: Path to the CSV file to read
+    :param columns: The columns to read (see select_columns)
+    :param dtype: Map from each of the columns to its dtype
+    :param sep: The delimiter of the file
+    :param compression: The codec of the file (see compressors.py), or "infer" to tell it from the file's name
+    :param keep_default_na: Read the values that pandas reads as missing by default as missing
+    :param chunksize: If given, the file is read in chunks of this many rows
+    :return: A data frame of the file, or a generator of data frames of each chunk of it
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    from pandas._libs.parsers import STR_NA_VALUES
+
+    parse_options = pa_csv.ParseOptions(delimiter=sep, newlines_in_values=True)
+    convert_options = pa_csv.ConvertOptions(
+        column_types={column: get_arrow_type(dtype[column]) for column in columns}, include_columns=columns,
+        null_values=sorted(STR_NA_VALUES) if keep_default_na else [], strings_can_be_null=keep_default_na)
+
+    def to_data_frame(table, start=0):
+        df = table.to_pandas()
+        df.index = pd.RangeIndex(start, start + len(df))  # continuing from the previous chunk, as pandas does
+        booleans = {column: 'boolean' for column in columns if is_boolean(dtype[column])}
+        return df.astype(booleans) if booleans else df
+
+    compression = get_compression(file_path, compression)
+    if chunksize is None:
+        with pa.input_stream(file_path, compression=compression) as f:
+            return to_data_frame(pa_csv.read_csv(f, parse_options=parse_options, convert_options=convert_options))
+
+    def read_chunks():
+        # The file is parsed a block at a time with the multithreaded reader (the streaming
+        # reader of pyarrow, open_csv, parses on one thread), and the blocks are sliced into chunks
+        read_options = pa_csv.ReadOptions(use_threads=True)
+        with pa.input_stream(file_path, compression=compression) as f:
+            header, buffered, num_buffered, start = None, [], 0, 0
+            for rows in read_row_blocks(f, arrow_block_size):
+                if header is None:
+                    header = rows[:rows.find(b'\n') + 1] or rows
+                    rows = rows[len(header):]
+                table = pa_csv.read_csv(pa.py_buffer(header + rows), read_options=read_options,
+                                        parse_options=parse_options, convert_options=convert_options)
+                buffered.append(table)
+                num_buffered += table.num_rows
+                while num_buffered >= chunksize:
+                    table = pa.concat_tables(buffered)
+                    yield to_data_frame(table.slice(0, chunksize), start)
+                    start += chunksize
+                    buffered, num_buffered = [table.slice(chunksize)], table.num_rows - chunksize
+            if num_buffered > 0 or start == 0:
+                if not buffered:  # an empty file
+                    buffered = [pa_csv.read_csv(pa.py_buffer(header or b''), read_options=read_options,
+                                                parse_options=parse_options, convert_options=convert_options)]
+                yield to_data_frame(pa.concat_tables(buffered), start)
+
+    return read_chunks()
+
+
+def read_row_blocks(f, block_size):
+    """
+    Reads a CSV file in blocks of whole rows, which end at line breaks that aren't within quoted values
+
+    :param f: Binary file object of the CSV file
+    :param block_size: Number of bytes to read at a time. Blocks are longer if a row is.
+    :return: A generator yielding the bytes of consecutive blocks of rows of the file
+    """
+    rest, quoted = b'', 0
+    while True:
+        block = f.read(block_size)
+        if not block:
+            if rest:
+                yield rest
+            return
+        data = np.frombuffer(block, dtype=np.uint8)
+        # A line break is the end of a row if it follows an even number of quotes (escaped quotes are doubled)
+        within_quotes = np.bitwise_xor.accumulate((data == ord('"')).view(np.uint8)) ^ quoted
+        row_ends = np.flatnonzero((data == ord('\n')) & (within_quotes == 0))
+        quoted = int(within_quotes[-1])
+        if len(row_ends) == 0:
+            rest += block
+            continue
+        end = int(row_ends[-1]) + 1
+        yield rest + block[:end]
+        rest = block[end:]
@@ -7,54 +7,35 @@ Date: March 2018
 """
 
 import os
+import io
 import sys
+import json
+import fcntl
+import socket
 import hashlib
 import pickle
-from enum import Enum
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import numpy as np
 import pandas as pd
 import psutil
 import redis
 import time
+import queue
+import threading
+
+from codec import encode_fullnames, decode_fullnames, encode_fullname_numbers, encode_keys, encode_timestamps
+from columnar import intermediate_file_name, write_columnar, data_frame_to_columnar, is_columnar, read_columnar
+from schema import DataType, get_data_type, get_dtypes
+from readers import read_csv
+from writers import format_rows, format_header, join_rows, write_data
+from compressors import compress, decompress
 
 logger = logging.getLogger('root')
 python2 = sys.version_info < (3, 0)
 
-class DataType(Enum):
-    """
-    Enumeration for all the types of data found in the reddit data set
-    """
-    users = 1
-    votes = 2
-    comments = 3
-    submissions = 4
-    subscriptions = 5
-    removals = 6
-    reports = 7
-    unknown = 8
-
-
-def get_data_type(directory):
-    """
-    Returns the data type of a reddit data-set subdirectory
-
-    :param directory: Path to some reddit sub-directory
-    :return: The type of data stored in that directory
-    """
-    dir = os.path.split(directory)[1]
-    if not dir:
-        dir = os.path.split(os.path.split(directory)[0])[1]
-
-    if "user" in dir: return DataType.users
-    if "vote" in dir: return DataType.votes
-    if "comment" in dir: return DataType.comments
-    if "submission" in dir: return DataType.submissions
-    if "subscription" in dir: return DataType.subscriptions
-    if "removal" in dir: return DataType.removals
-    if "report" in dir: return DataType.reports
-    return DataType.unknown
-
-
 def get_split_number(directory):
     """
     Determines the "split number" of a directory
@@ -119,25 +100,211 @@ def hash(s):
     return int(hashlib.md5(s.encode()).hexdigest(), 16)
 
 
-def chunk_list(l, num_chunks):
+def hash_buckets(values, num_splits):
     """
-    Chunks a list into contiguous regions
+    Assigns each of a column of values to a bucket in one batch
+
+    Gives exactly the same bucket as hash(s) % num_splits for each value, but only
+    hashes each distinct value once and reduces the 128 bit MD5 digests modulo
+    num_splits with vectorized arithmetic instead of Python integers.
+    :param values: Column (Series or array-like) of values to assign to buckets
+    :param num_splits: The number of buckets
+    :return: A numpy array with the bucket number of each value
+    """
+    codes, uniques = pd.factorize(values)
+    uniques = [str(u) for u in uniques] + ['nan']  # missing values get the last slot
+    codes[codes < 0] = len(uniques) - 1
+
+    if num_splits >= 2 ** 32:  # the product below would overflow 64 bits
+        buckets = np.array([hash(u) % num_splits for u in uniques], dtype=np.int64)
+        return buckets[codes]
+
+    digests = b''.join(hashlib.md5(u.encode()).digest() for u in uniques)
+    words = np.frombuffer(digests, dtype='>u8').reshape(-1, 2).astype(np.uint64)
+    n = np.uint64(num_splits)
+    # (hi * 2^64 + lo) mod n, with each factor reduced first so nothing overflows
+    buckets = ((words[:, 0] % n) * np.uint64(2 ** 64 % num_splits) + words[:, 1] % n) % n
+    return buckets.astype(np.int64)[codes]
 
-    :param l: The list to chunk
-    :param num_chunks: The number of chunks to break the list up into
-    :return: A generator that returns each of the chunks (which are also generators)
+
+def iter_batches(iterable, batch_size):
     """
+    Breaks an iterable up into contiguous batches of a fixed size
 
-    if type(l) is not list:
-        l = list(l)
+    :param iterable: The items to batch
+    :param batch_size: The number of items in each batch (the last batch may be smaller)
+    :return: A generator that returns each of the batches as a list
+    """
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, batch_size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, batch_size))
 
-    def chunker(c):
-        for i, key, in enumerate(l):
-            if int(i * num_chunks / len(l)) == c:
-                yield key
 
-    for c in range(num_chunks):
-        yield chunker(c)
+class LRUCache(object):
+    """
+    Bounded cache of key-value pairs which evicts the least recently used pairs first,
+    and counts its hits and misses
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: The maximum number of key-value pairs to hold
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_many(self, keys):
+        """
+        Gets the values of a number of keys from the cache
+
+        :param keys: The keys to get the values of
+        :return: A tuple of the list of values (None for keys that aren't in the cache) and
+        a boolean array which is True for each key that was in the cache
+        """
+        values = [None] * len(keys)
+        found = np.zeros(len(keys), dtype=bool)
+        for i, key in enumerate(keys):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                values[i] = self.entries[key]
+                found[i] = True
+        num_found = int(found.sum())
+        self.hits += num_found
+        self.misses += len(keys) - num_found
+        return values, found
+
+    def put_many(self, keys, values):
+        """
+        Puts a number of key-value pairs into the cache, evicting the least recently used pairs if it is full
+
+        :param keys: The keys to put into the cache
+        :param values: The value of each of the keys
+        :return: None
+        """
+        if self.capacity <= 0:
+            return
+        for key, value in zip(keys, values):
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+class _PipelineFailure(object):
+    """
+    Passed down a pipeline in place of an item when a stage fails
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+_end_of_pipeline = object()
+
+
+def run_pipeline(source, stages, names=None, queue_size=1):
+    """
+    Runs the stages of processing a stream of items concurrently, each in its own thread
+
+    Each item is taken from the source by one thread and handed from stage to stage through
+    bounded queues, so that e.g. one chunk of a file may be parsed while the previous one is
+    being looked up and the one before it is being written. The last stage runs in the calling
+    thread. If any stage raises an exception, the pipeline is stopped and the exception is
+    re-raised by this function.
+    :param source: Iterable of the items
+    :param stages: List of functions to apply to each item in turn. Each function takes the item
+    returned by the previous one (or the source)
+    :param names: Names of the source and each of the stages, for the returned times
+    :param queue_size: The number of items that may wait between each pair of stages
+    :return: List of (name, busy seconds, idle seconds) of the source and each of the stages.
+    Idle time is time spent waiting for the previous stage or for room in the next one.
+    """
+    names = names or ["source"] + [stage.__name__ for stage in stages]
+    times = [[name, 0.0, 0.0] for name in names]
+    queues = [queue.Queue(queue_size) for _ in stages]
+    stopped = threading.Event()
+
+    def put(q, item, stage_times):
+        start = time.time()
+        while not stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        stage_times[2] += time.time() - start
+
+    def get(q, stage_times):
+        start = time.time()
+        item = _end_of_pipeline
+        while not stopped.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        stage_times[2] += time.time() - start
+        return item
+
+    def produce():
+        item = _end_of_pipeline
+        try:
+            iterator = iter(source)
+            while not stopped.is_set():
+                start = time.time()
+                try:
+                    next_item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    times[0][1] += time.time() - start
+                put(queues[0], next_item, times[0])
+        except BaseException as e:
+            item = _PipelineFailure(e)
+        put(queues[0], item, times[0])
+
+    def process(i):
+        while True:
+            item = get(queues[i], times[i + 1])
+            if item is _end_of_pipeline or isinstance(item, _PipelineFailure):
+                put(queues[i + 1], item, times[i + 1])
+                return
+            start = time.time()
+            try:
+                item = stages[i](item)
+            except BaseException as e:
+                item = _PipelineFailure(e)
+            times[i + 1][1] += time.time() - start
+            put(queues[i + 1], item, times[i + 1])
+            if isinstance(item, _PipelineFailure):
+                return
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads += [threading.Thread(target=process, args=(i,), daemon=True) for i in range(len(stages) - 1)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = get(queues[-1], times[-1])
+            if item is _end_of_pipeline:
+                break
+            if isinstance(item, _PipelineFailure):
+                raise item.error
+            start = time.time()
+            stages[-1](item)
+            times[-1][1] += time.time() - start
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+    return [tuple(t) for t in times]
 
 
 def save_dict(d, fname):
@@ -163,13 +330,36 @@ def load_dict(fname):
         return pickle.load(f)
 
 
+def get_redis_pools(addresses):
+    """
+    Makes a pool of connections to each of a number of Redis instances
+
+    :param addresses: List of the addresses of the instances: "host:port", or the path
+    to a Unix socket
+    :return: List of the connection pools
+    """
+    pools = []
+    for address in addresses:
+        if "/" in address:
+            pools.append(redis.ConnectionPool(connection_class=redis.UnixDomainSocketConnection, path=address, db=0))
+        else:
+            host, _, port = address.rpartition(":")
+            pools.append(redis.ConnectionPool(host=host or "localhost", port=int(port), db=0))
+    return pools
+
+
 def get_redis_db(redis_pool):
     """
     Get a connection to a Redis database
 
-    :param redis_pool: Pool of connections to use to connect to
-    :return: Redis database (fully loaded)
+    :param redis_pool: Pool of connections to use to connect to, or a list of pools to
+    each of the instances (shards) of a sharded database
+    :return: Redis database (fully loaded), or list of the shards of the database if given several pools
     """
+    if isinstance(redis_pool, list):
+        shards = [get_redis_db(pool) for pool in redis_pool]
+        return shards[0] if len(shards) == 1 else shards
+
     redis_db = redis.StrictRedis(connection_pool=redis_pool)
     if redis_db.info()['loading']:
         logger.debug("Waiting for Redis to load database. ETA: %d min" % (redis_db.info()['loading_eta_seconds'] / 60))
@@ -182,101 +372,388 @@ def get_redis_db(redis_pool):
     return redis_db
 
 
-def dump_dict_to_redis(redis_db, d, num_chunks=7, retries=5):
+def count_redis_keys(redis_db, compact=False, batch_size=10000):
     """
-    Stores a dictionary in a redis database
+    Counts the keys in a Redis database
 
-    This function will dump a (potentially large) dictionary or list of key-value pairs into
-    the specified Redis database. This is accomplished by breaking up the dictionary into a
-    number of chunks and using MSET in order to dump many key-value pairs at the same time.
-    If the chunks are too large, then the connection will be reset by the database and
-    this function will re-try while breaking up the dictionary into smaller chunks instead.
-    :param redis_db: The redis database to dump the dictionary into
-    :param d: Dictionary or key-value pair iterator to dump into the Redis database
-    :param num_chunks: The number of chunks to split the dictionary into in order
-    to store it in the database
-    :return: None
+    :param redis_db: Redis database, or list of the shards of a sharded database
+    :param compact: Count the comments stored in the compact layout (see compact_map_entries), i.e.
+    the fields of its hashes, instead of the top-level keys (of which each hash is one)
+    :param batch_size: The number of hashes to scan for and count the fields of at a time
+    :return: The number of keys in the database
     """
+    shards = redis_db if isinstance(redis_db, list) else [redis_db]
+    if not compact:
+        return sum(shard.info().get('db0', {'keys': 0})['keys'] for shard in shards)
 
-    if num_chunks == 1:
-        try:
-            redis_db.mset(d)
-            return 1
-        except redis.exceptions.ConnectionError:
-            return dump_dict_to_redis(redis_db, d, num_chunks=10)
+    count = 0
+    for shard in shards:
+        for hash_keys in iter_batches(shard.scan_iter(match="m[0-9]:*", count=batch_size), batch_size):
+            pipe = shard.pipeline(transaction=False)
+            for hash_key in hash_keys:
+                pipe.hlen(hash_key)
+            count += sum(pipe.execute())
+    return count
 
-    try:
-        for c in range(num_chunks):
-            chunk = {key: value for i, (key, value) in enumerate(d.items()) if i % num_chunks == c}
-            redis_db.mset(chunk)
-        return num_chunks  # return. how many chunks it took... might be useful info for caller
 
-    except redis.exceptions.ConnectionError:
-        if retries == 0:
-            raise
-        logger.debug("Dumping in chunks of %d failed. Trying %d..." % (num_chunks, 2 * num_chunks))
-        return dump_dict_to_redis(redis_db, d, num_chunks=2 * num_chunks, retries=retries - 1)
+def shard_keys(keys, num_shards, compact=False):
+    """
+    Assigns each of a column of keys to a shard of a sharded Redis database
+
+    The shard of a key only depends on the key (and not e.g. on the process), so that
+    every worker stores and looks up each key on the same shard.
+    :param keys: Column of keys
+    :param num_shards: The number of shards
+    :param compact: Assign comment full-names to shards by the hash that they are stored in with
+    the compact layout (see compact_map_entries), so that each hash is stored on a single shard
+    :return: Array of the shard of each key
+    """
+    if compact:
+        tags, numbers = encode_fullname_numbers(keys)
+        return hash_buckets(tags * 2 ** 56 + (numbers >> compact_bucket_bits), num_shards)
+    return hash_buckets(np.asarray(keys, dtype=object), num_shards)
+
 
+def on_shards(function, shards, keys, compact=False):
+    """
+    Calls a function on each shard of a sharded Redis database in parallel, with the keys that belong on it
 
-def get_values_from_redis(redis_db, keys, num_chunks=7, retries=5):
+    :param function: Function taking a (single) Redis database and the positions of the keys on it
+    :param shards: List of the shards of the database
+    :param keys: Column of keys
+    :param compact: Whether the keys are stored in the compact layout (see shard_keys)
+    :return: List of the return value of the function for each shard
+    """
+    shard_of_key = shard_keys(keys, len(shards), compact=compact)
+    with ThreadPoolExecutor(len(shards)) as executor:
+        futures = [executor.submit(function, shard, np.flatnonzero(shard_of_key == i)) for i, shard in enumerate(shards)]
+        return [future.result() for future in futures]
+
+
+# Compact layout of the {comment --> submission} map: the comments are packed into hashes of up to
+# 2^compact_bucket_bits comments with consecutive ids, so that Redis stores each hash in its compact
+# small-hash encoding (within its default limit of 128 entries), instead of paying its overhead for
+# a top-level key per comment
+compact_bucket_bits = 7
+
+
+def compact_map_entries(keys, values):
+    """
+    Converts {comment --> submission} pairs to the entries of the compact Redis layout
+
+    The number of the comment's id is split into the key of its hash ("m<tag>:<prefix>") and its field
+    within the hash. The submission is stored as its code (see codec.py), which Redis stores as a
+    binary integer. Pairs that aren't both full-names are dropped.
+    :param keys: Column of comment full-names
+    :param values: Column of submission full-names
+    :return: Tuple of Series of the hash keys, fields and values of the entries
+    """
+    tags, numbers = encode_fullname_numbers(keys)
+    values = encode_fullnames(values)
+    valid = (numbers >= 0) & (values >= 0)
+    tags, numbers, values = tags[valid], numbers[valid], values[valid]
+    hash_keys = "m" + pd.Series(tags).astype(str) + ":" + pd.Series(numbers >> compact_bucket_bits).astype(str)
+    fields = pd.Series(numbers & (2 ** compact_bucket_bits - 1)).astype(str)
+    return hash_keys, fields, pd.Series(values).astype(str)
+
+
+def compact_map_lookups(keys, offset=0):
+    """
+    Groups comment full-names by the hash that they are stored in with the compact Redis layout
+
+    :param keys: List of comment full-names
+    :param offset: Offset to add to the position of each of the keys
+    :return: List of (hash key, fields, positions of the keys) tuples, one for each hash
+    """
+    tags, numbers = encode_fullname_numbers(keys)
+    positions = np.flatnonzero(numbers >= 0)
+    tags, numbers = tags[positions], numbers[positions]
+    order = np.lexsort((numbers, tags))
+    positions, tags, numbers = positions[order], tags[order], numbers[order]
+    buckets = numbers >> compact_bucket_bits
+    fields = numbers & (2 ** compact_bucket_bits - 1)
+    starts = np.flatnonzero((np.diff(buckets, prepend=-1) != 0) | (np.diff(tags, prepend=-1) != 0))
+    stops = np.append(starts[1:], len(buckets))
+    return [("m%d:%d" % (tags[start], buckets[start]), fields[start:stop].tolist(), positions[start:stop] + offset)
+            for start, stop in zip(starts, stops)]
+
+
+def dump_dict_to_redis(redis_db, d, batch_size=10000, batches_in_flight=8, retries=5, compact=False):
+    """
+    Stores a dictionary in a redis database
+
+    This function will dump a (potentially large) dictionary or list of key-value pairs into
+    the specified Redis database. The pairs are streamed in fixed-size batches, each stored
+    with a single MSET, and several batches are sent at a time through a pipeline so that
+    the round trip to the database is shared between them. If a batch fails, then only
+    that batch is sent again.
+    :param redis_db: The redis database to dump the dictionary into
+    :param d: Dictionary or key-value pair iterator to dump into the Redis database
+    :param batch_size: The number of key-value pairs to store with each MSET
+    :param batches_in_flight: The number of batches to send through the pipeline at a time
+    :param retries: The number of times to re-try each failed batch before giving up
+    :param compact: Store the {comment --> submission} pairs in the compact layout (see compact_map_entries)
+    :return: The number of key-value pairs that were stored
+    """
+    if isinstance(redis_db, list):  # sharded, so store each shard's pairs in parallel
+        items = list(d.items() if isinstance(d, dict) else d)
+        return sum(on_shards(lambda shard, positions: dump_dict_to_redis(
+            shard, [items[i] for i in positions], batch_size=batch_size, batches_in_flight=batches_in_flight,
+            retries=retries, compact=compact), redis_db, [key for key, _ in items], compact=compact))
+
+    def mset(pipe, batch):
+        pipe.mset(dict(batch))
+
+    def hset(pipe, batch):
+        hash_keys, fields, values = compact_map_entries(*zip(*batch))
+        entries = pd.DataFrame({'field': fields, 'value': values}).groupby(hash_keys.to_numpy(), sort=False)
+        for hash_key, group in entries:
+            pipe.hset(hash_key, mapping=dict(zip(group.field, group.value)))
+
+    items = d.items() if isinstance(d, dict) else d
+    start = time.time()
+    num_keys = 0
+    for batches in iter_batches(iter_batches(items, batch_size), batches_in_flight):
+        pipeline_batches(redis_db, batches, hset if compact else mset, retries=retries)
+        num_keys += sum(len(batch) for batch in batches)
+    logger.debug("Stored %d keys in Redis (%.0f keys/sec)" % (num_keys, num_keys / max(time.time() - start, 1e-6)))
+    return num_keys
+
+
+def get_values_from_redis(redis_db, keys, batch_size=10000, batches_in_flight=8, retries=5, compact=False):
     """
     Maps a list of keys to their values from a Redis database
 
+    The keys are looked up in fixed-size batches with MGET, several batches at a time
+    through a pipeline, re-trying only the batches that fail.
     :param redis_db: The Redis database to extract the values from
     :param keys: The keys to get the values for
-    :param num_chunks: The number of chunks to split the key list into
+    :param batch_size: The number of keys to look up with each MGET
+    :param batches_in_flight: The number of batches to send through the pipeline at a time
+    :param retries: The number of times to re-try each failed batch before giving up
+    :param compact: Look up comment full-names stored in the compact layout (see compact_map_entries)
     :return: List of values found in the Redis database
     """
-
-    def transform(v):
-        return list(map(lambda x: str(x, 'utf-8') if x else None, v))
-
-    if type(keys) is not list:
+    if isinstance(redis_db, list):  # sharded, so look up each shard's keys in parallel
+        keys = np.array(list(keys), dtype=object)
+        values = np.full(len(keys), None, dtype=object)
+
+        def get(shard, positions):
+            values[positions] = get_values_from_redis(shard, keys[positions], batch_size=batch_size,
+                                                      batches_in_flight=batches_in_flight, retries=retries,
+                                                      compact=compact)
+        on_shards(get, redis_db, keys, compact=compact)
+        return list(values)
+
+    def mget(pipe, batch):
+        pipe.mget(batch)
+
+    def hmget(pipe, batch):
+        for hash_key, fields, _ in batch:
+            pipe.hmget(hash_key, fields)
+
+    start = time.time()
+    if compact:
         keys = list(keys)
+        codes = np.full(len(keys), -1, dtype=np.int64)
+        lookups = (compact_map_lookups(batch, i * batch_size) for i, batch in enumerate(iter_batches(keys, batch_size)))
+        for batches in iter_batches(lookups, batches_in_flight):
+            for batch, replies in zip(batches, pipeline_batches(redis_db, batches, hmget, retries=retries)):
+                for (_, _, positions), reply in zip(batch, replies):
+                    codes[positions] = [-1 if v is None else int(v) for v in reply]
+        values = list(decode_fullnames(codes))
+    else:
+        values = []
+        for batches in iter_batches(iter_batches(keys, batch_size), batches_in_flight):
+            for replies in pipeline_batches(redis_db, batches, mget, retries=retries):
+                values.extend(str(v, 'utf-8') if v else None for v in replies[0])
+    logger.debug("Got %d values from Redis (%.0f keys/sec)" % (len(values), len(values) / max(time.time() - start, 1e-6)))
+    return values
+
 
-    if num_chunks == 1:
+def pipeline_batches(redis_db, batches, command, retries=5):
+    """
+    Sends the commands for a number of batches through a single Redis pipeline
+
+    If the connection fails or a command returns an error, then each of the batches that
+    didn't succeed is re-tried on its own (the pipeline is not a transaction, so the batches that
+    succeeded are not sent again).
+    :param redis_db: The Redis database to send the commands to
+    :param batches: List of batches
+    :param command: Function that queues the command(s) for a batch onto a pipeline
+    :param retries: The number of times to re-try each failed batch before giving up
+    :return: List of the replies to the command(s) of each batch
+    """
+    replies = [None] * len(batches)
+    failures = [0] * len(batches)  # the number of times that each batch has failed
+    pending = [list(range(len(batches)))]
+    while pending:
+        group = pending.pop()
+        results, counts, error = [], [], None
         try:
-            if len(keys) > 0:
-                values = redis_db.mget(keys)
-                return transform(values)
+            pipe = redis_db.pipeline(transaction=False)
+            for i in group:
+                queued = len(pipe)
+                command(pipe, batches[i])
+                counts.append(len(pipe) - queued)
+            results = pipe.execute(raise_on_error=False)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            error = e
+
+        failed = []
+        for n, i in enumerate(group):
+            if n >= len(counts):
+                failed.append(i)  # the batch was never queued
+                continue
+            batch_results, results = results[:counts[n]], results[counts[n]:]
+            errors = [r for r in batch_results if isinstance(r, Exception)]
+            if len(batch_results) < counts[n] or errors:
+                failed.append(i)
+                error = errors[0] if errors else error
             else:
-                return []
-        except redis.exceptions.ConnectionError:
-            return get_values_from_redis(redis_db, keys)
-    else:
-        try:
-            values = []
-            for chunk in chunk_list(keys, num_chunks):
-                c = list(chunk)
-                if c:
-                    values.extend(redis_db.mget(c))
-            return transform(values)
-        except redis.exceptions.ConnectionError:
-            if retries == 0:
-                raise
-            return get_values_from_redis(redis_db, keys, num_chunks=2 * num_chunks, retries=retries - 1)
+                replies[i] = batch_results
+        if failed:
+            for i in failed:
+                failures[i] += 1
+            most_failures = max(failures[i] for i in failed)
+            if most_failures > retries:
+                raise error
+            logger.debug("%d of %d batches failed (%s). Re-trying..." % (len(failed), len(group), error))
+            time.sleep(min(0.1 * 2 ** most_failures, 10))
+            pending.extend([i] for i in failed)
+    return replies
+
+
+def redis_protocol(command, *args):
+    """
+    Encodes a column of Redis commands in the Redis protocol (RESP)
+
+    This is the format read by "redis-cli --pipe" for mass insertion, e.g.
+    redis_protocol("SET", keys, values) makes one SET command for each key-value pair.
+    The commands are encoded column-wise so that no Python objects are made per command.
+    :param command: Name of the command, e.g. "SET"
+    :param args: Columns (Series) of the arguments of the commands, all of the same length.
+    The arguments must be ASCII strings.
+    :return: The encoded commands as bytes
+    """
+    if not args or len(args[0]) == 0:
+        return b""
+    header = "*%d\r\n$%d\r\n%s\r\n" % (len(args) + 1, len(command), command)
+    commands = header
+    for arg in args:
+        arg = pd.Series(arg).astype(str).reset_index(drop=True)
+        commands = commands + "$" + arg.str.len().astype(str) + "\r\n" + arg + "\r\n"
+    return "".join(commands).encode()
+
+
+def estimate_num_rows(file_paths, sample_rows=10000):
+    """
+    Estimates the total number of rows in a number of CSV files without reading them
+
+    :param file_paths: Paths to the CSV files
+    :param sample_rows: The number of rows to read from the first file to estimate the size of each row
+    :return: The estimated number of rows
+    """
+    total_size = sum(os.path.getsize(f) for f in file_paths)
+    if total_size == 0:
+        return 0
+    with open(file_paths[0], 'rb') as f:
+        sample = list(itertools.islice(f, sample_rows + 1))[1:]  # without the header
+    if not sample:
+        return 0
+    return int(total_size / (sum(len(line) for line in sample) / len(sample)))
 
 
-def split_file(on, file_path, targets, num_splits):
+def get_chunk_size(file_path, memory_budget, sample_rows=10000, overhead=4, **kwargs):
+    """
+    Determines how many rows of a CSV file may be read at once within a memory budget
+
+    The in-memory size of a row is estimated from a sample of rows at the start of the file,
+    and multiplied by an overhead factor to account for the copies that are made while
+    a chunk is being split and written.
+    :param file_path: Path to the CSV file that will be read
+    :param memory_budget: The number of bytes that a chunk of the file may use
+    :param sample_rows: The number of rows to read to estimate the size of each row
+    :param overhead: Multiple of the size of a chunk that is used while processing it
+    :param kwargs: Additional keyword arguments that the file will be read with by pandas.read_csv
+    :return: The number of rows to read in each chunk
+    """
+    sample = read_csv(file_path, nrows=sample_rows, **kwargs)
+    if sample.empty:
+        return sample_rows
+    row_size = sample.memory_usage(deep=True, index=False).sum() / len(sample)
+    return max(1, int(memory_budget / (overhead * row_size)))
+
+
+def read_csv_chunks(file_path, memory_budget=None, reader="pandas", **kwargs):
+    """
+    Reads a CSV file as a sequence of data frames that each fit within a memory budget
+
+    :param file_path: Path to the CSV file to read
+    :param memory_budget: Number of bytes that each chunk may use. If None, the whole
+    file is read as a single chunk.
+    :param reader: The CSV reader to parse the file with, one of readers.csv_readers
+    :param kwargs: Additional keyword arguments to pass to pandas.read_csv
+    :return: A generator yielding data frames of consecutive rows of the file
+    """
+    if memory_budget is None:
+        yield read_csv(file_path, reader, **kwargs)
+        return
+
+    chunk_size = get_chunk_size(file_path, memory_budget, **kwargs)
+    logger.debug("Reading %s in chunks of %d rows" % (os.path.split(file_path)[1], chunk_size))
+    for chunk in read_csv(file_path, reader, chunksize=chunk_size, **kwargs):
+        yield chunk
+
+
+def split_file(on, file_path, targets, num_splits, memory_budget=None, spill=False, usecols=None,
+               manifest_directory=None, file_format="csv", sorted_runs=False, parse_times=False, dictionary=None,
+               reader="pandas", compression=None):
     """
     Splits the rows of a data frame stored in a file on a specified column
 
     :param on: The column of the data frame to split the input on
     :param file_path: Path to the file containing the data frame (in CSV)
-    :param targets:
+    :param targets: A mapping from each bucket number to the directory to write that bucket to,
+    or if spill is True, the directory to write this data set's spill files to
     :param num_splits: The number of buckets to split the data frame up into
-    :param map_columns: A tuple specifying two columns of the data frame that need to be
-    zipped together into a python dictionary and saved to file. Must pass maps_dir as well.
-    :param redis_pool: Pool of redis database connections to dup the mapping into
+    :param memory_budget: Number of bytes of memory to use to stream the file in chunks.
+    If None, the whole file is read at once.
+    :param spill: Append the buckets to this worker's spill file instead of writing a file per bucket
+    :param usecols: The columns of the file to keep. If None, all columns are kept.
+    The columns are read with the dtypes of the schema of the data set in the file's directory (see schema.py).
+    :param manifest_directory: If given, the split files are written under temporary names, renamed
+    once the whole file is split and the split is recorded in this directory's manifest (see record_task)
+    :param file_format: Format of the split files, one of columnar.intermediate_formats
+    :param sorted_runs: Sort the rows of each split by the "on" column and then by time (see sort_by_bucket)
+    :param parse_times: Store the time column as milliseconds since the epoch (see parse_time_column)
+    :param dictionary: If given, the ValueDictionary to encode the low-cardinality string columns with
+    :param reader: The CSV reader to parse the file with, one of readers.csv_readers
+    :param compression: The codec to compress the split files (or spill segments) with, one of
+    compressors.compression_codecs or None. The files are named with the codec's extension.
     :return: None
     """
     file_name = os.path.split(file_path)[1]
-    logger.debug("Reading: %s" % file_name)
-    df = pd.read_csv(file_path)
+    output_name = intermediate_file_name(file_name, file_format, compression)
+    file_targets = None if spill else {i: os.path.join(targets[i], output_name) for i in targets}
+    write_targets = file_targets if spill or manifest_directory is None else temporary_paths(file_targets)
 
     logger.debug("Splitting: %s" % file_name)
-    file_targets = {i: os.path.join(targets[i], file_name) for i in targets}
-    split_data_frame(df, on, lambda x: hash(x) % num_splits, file_targets)
+    num_rows = 0
+    dtype = get_dtypes(get_data_type(os.path.dirname(file_path)))
+    for i, df in enumerate(read_csv_chunks(file_path, memory_budget, reader, usecols=usecols, dtype=dtype)):
+        num_rows += len(df)
+        if spill:
+            spill_data_frame(df, on, num_splits, targets, file_name, chunk_number=i, compression=compression,
+                             file_format=file_format, sorted_runs=sorted_runs, parse_times=parse_times,
+                             dictionary=dictionary)
+        else:
+            split_data_frame(df, on, num_splits, write_targets, compression=compression, append=i > 0,
+                             file_format=file_format, sorted_runs=sorted_runs, parse_times=parse_times,
+                             dictionary=dictionary)
+
+    if manifest_directory is not None:
+        finish_split_task(manifest_directory, file_path, num_rows, targets if spill else file_targets, spill=spill)
 
 
 def unpack_split_file(args):
@@ -285,28 +762,144 @@ def unpack_split_file(args):
 
     Useful if you are doing a multiprocessing.Pool.map for split_file
     :param args: The arguments to pass to split_file in a tuple
-    :return: None
+    :return: The name of the file that was split
     """
     split_file(*args)
+    return os.path.split(args[1])[1]
+
+
+def get_time_column(df):
+    """
+    Finds the column of the time of each event in a data frame of one of the data sets
+
+    :param df: Data frame of one of the data sets
+    :return: "registration_dt" for the users data set, otherwise "endpoint_ts"
+    """
+    return 'registration_dt' if 'registration_dt' in df.columns else 'endpoint_ts'
 
 
-def split_data_frame(df, on, assign_split, output_file_map, temp_col='bkt', compress=False):
+def parse_time_column(df):
+    """
+    Parses the time column of a data frame (see get_time_column) into int64 milliseconds since the epoch
+
+    The times are then sorted and stored as integers, and only rendered as strings again when the
+    output of the merge is written (see codec.decode_timestamps).
+    :param df: Data frame of one of the data sets
+    :return: The data frame, with its time column parsed (if it has one that isn't parsed already)
+    """
+    time_col = get_time_column(df)
+    if time_col not in df.columns or pd.api.types.is_integer_dtype(df[time_col]):
+        return df
+    return df.assign(**{time_col: encode_timestamps(df[time_col])})
+
+
+def get_sort_keys(df, key, time_col='endpoint_ts'):
+    """
+    Gets the arrays to sort the rows of a data frame by a key column and then by time
+
+    The keys are sorted by their compact codes (see codec.py), which sort in the same order as
+    the keys themselves but are much cheaper to compare than strings.
+    :param df: The data frame to sort
+    :param key: The key column to sort by, i.e. "user_id" or "post_fullname"
+    :param time_col: The time column to sort by within each key
+    :return: A tuple of the array of the keys' codes (or of the keys if they can't be encoded)
+    and the array of the times
+    """
+    try:
+        codes = encode_keys(df[key], key)
+    except (ValueError, TypeError):
+        logger.debug("Could not encode \"%s\", sorting strings instead" % key)
+        codes = df[key].to_numpy(dtype=object)
+    return codes, df[time_col].to_numpy()
+
+
+def get_sort_order(df, key, time_col='endpoint_ts'):
+    """
+    Finds the (stable) order of the rows of a data frame sorted by a key column and then by time
+
+    :param df: The data frame to sort
+    :param key: The key column to sort by, i.e. "user_id" or "post_fullname"
+    :param time_col: The time column to sort by within each key
+    :return: Array of the positions of the rows in sorted order
+    """
+    codes, times = get_sort_keys(df, key, time_col)
+    try:
+        return np.lexsort((times, codes))
+    except TypeError:
+        # Missing keys or times can't be compared with strings, so let pandas put them last
+        return df[[key, time_col]].reset_index(drop=True).sort_values(by=[key, time_col]).index.to_numpy()
+
+
+def sort_by_key(df, key, time_col='endpoint_ts'):
+    """
+    Sorts a data frame by a key column and then by time
+
+    :param df: The data frame to sort
+    :param key: The key column to sort by, i.e. "user_id" or "post_fullname"
+    :param time_col: The time column to sort by within each key
+    :return: The sorted data frame
+    """
+    return df.iloc[get_sort_order(df, key, time_col)]
+
+
+def sort_by_bucket(df, on, num_splits, sort_rows=False):
+    """
+    Orders the rows of a data frame by the bucket that they are assigned to
+
+    :param df: The data frame to order
+    :param on: The name of the column of df to assign buckets by
+    :param num_splits: The number of buckets
+    :param sort_rows: Also sort the rows of each bucket by the "on" column and then by time (see sort_by_key)
+    :return: A tuple of the (stable) row order and an array of num_splits + 1 boundaries such that
+    the rows of bucket i are df.iloc[order[bounds[i]:bounds[i + 1]]]
+    """
+    buckets = hash_buckets(df[on], num_splits)
+    order = get_sort_order(df, on, get_time_column(df)) if sort_rows else np.arange(len(df))
+    order = order[np.argsort(buckets[order], kind='stable')]
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(buckets, minlength=num_splits))))
+    return order, bounds
+
+
+def split_data_frame(df, on, num_splits, output_file_map, compression=None, append=False, file_format="csv",
+                     sorted_runs=False, parse_times=False, dictionary=None):
     """
     Splits a data frame on a specified column, saving to file
 
+    Rows are assigned to buckets by hashing the "on" column, stably sorted by bucket
+    and each bucket is then written out as one contiguous slice of the data frame. The
+    rows are formatted as CSV all at once, and each file is written a slice of the lines.
     :param df: The data frame to split
     :param on: The name of the column of df to split the data by
-    :param assign_split: A function that assigns elements of the "on"
-    :param output_file_map: A mapping from each of the possible outputs of "assign" to file names to save
-    each part of the data frame that was assigned to the same bucket
-    :param temp_col: Name for the temporary column storing which bucket the row was assigned to by "assign"
-    :param compress: Will compress the file as gzip if True. Saves as txt if false
+    :param num_splits: The number of buckets to split the data frame into
+    :param output_file_map: A mapping from each bucket number to the file name to save
+    the part of the data frame that was assigned to that bucket
+    :param compression: The codec to compress the files with (each chunk appended to a file as a frame of
+    its own), one of compressors.compression_codecs or None. Files in the columnar format aren't compressed.
+    :param append: Append the rows (without a header) to the output files instead of
+    overwriting them. Used to split a file one chunk at a time.
+    :param file_format: Format of the output files, one of columnar.intermediate_formats
+    :param sorted_runs: Sort the rows of each bucket by the "on" column and then by time, so that each
+    chunk appended to a file is a sorted run that the merge can merge without sorting (see sort_by_bucket)
+    :param parse_times: Store the time column as milliseconds since the epoch (see parse_time_column)
+    :param dictionary: If given, the ValueDictionary to encode the low-cardinality string columns with
     :return: None
     """
-    df[temp_col] = df[on].apply(assign_split)
+    if parse_times:
+        df = parse_time_column(df)
+    if dictionary is not None:
+        df = dictionary.encode(df)
+    order, bounds = sort_by_bucket(df, on, num_splits, sort_rows=sorted_runs)
+    df = df.iloc[order]
+    if file_format == "npz":
+        for i in output_file_map:
+            write_columnar(df.iloc[bounds[i]:bounds[i + 1]], output_file_map[i], append=append)
+        return
+
+    rows = format_rows(df)
+    header = "" if append else format_header(df.columns)
     for i in output_file_map:
-        df_out = df[df[temp_col] == i].drop(temp_col, axis=1)  # select rows and drop temporary column
-        df_out.to_csv(output_file_map[i], index=False, compression='gzip' if compress else None)
+        write_data(output_file_map[i], header + join_rows(rows[bounds[i]:bounds[i + 1]]), append=append,
+                   compression=compression)
 
 
 def create_split_directories(output_directory, num_splits):
@@ -328,3 +921,347 @@ def create_split_directories(output_directory, num_splits):
 
     return target_directories
 
+
+def create_data_set_targets(output_directory, data_set_name, num_splits, spill=False):
+    """
+    Creates the directories that a data set is split into
+
+    :param output_directory: The output directory of the split
+    :param data_set_name: Name of the data set's sub-directory
+    :param num_splits: The number of splits
+    :param spill: Whether the data set is written to spill files rather than a file per split
+    :return: The targets to pass to split_file: the data set's spill directory if spill is True,
+    otherwise a map from each split number to the data set's sub-directory in that split
+    """
+    if spill:
+        spill_directory = os.path.join(output_directory, data_set_name)
+        mkdir(spill_directory)
+        return spill_directory
+
+    targets = {i: os.path.join(output_directory, "%05d" % i, data_set_name) for i in range(num_splits)}
+    for i in targets:
+        mkdir(targets[i])
+    return targets
+
+
+
+def get_spill_files(spill_directory):
+    """
+    Gets the spill file and spill index file that this process writes to in a directory
+
+    :param spill_directory: The directory of a data set's spill files
+    :return: A tuple of the paths to the spill file and its index
+    """
+    worker = "%s-%d" % (socket.gethostname(), os.getpid())
+    return os.path.join(spill_directory, "%s.spill" % worker), os.path.join(spill_directory, "%s.idx" % worker)
+
+
+def spill_data_frame(df, on, num_splits, spill_directory, source, chunk_number=0, compression=None,
+                     file_format="csv", sorted_runs=False, parse_times=False, dictionary=None):
+    """
+    Splits a data frame on a specified column, appending the buckets to this worker's spill file
+
+    Instead of writing a file for every bucket, each worker appends the rows of a data frame to a
+    single spill file per data set, grouped into one contiguous segment (CSV without a header) per
+    bucket. The byte range of each segment is then appended to the spill file's index, which starts
+    with the CSV header of the data set. The segments are written in the given format (a segment of
+    the columnar format is self-contained, see columnar.py).
+    :param df: The data frame to split
+    :param on: The name of the column of df to split the data by
+    :param num_splits: The number of buckets to split the data frame into
+    :param spill_directory: The directory to write this data set's spill files to
+    :param source: Name of the input file that the data frame was read from
+    :param chunk_number: Which chunk of the input file the data frame is
+    :param compression: The codec to compress each segment with, one of compressors.compression_codecs or None
+    :param file_format: Format of the segments, one of columnar.intermediate_formats
+    :param sorted_runs: Sort the rows of each segment by the "on" column and then by time (see sort_by_bucket)
+    :param parse_times: Store the time column as milliseconds since the epoch (see parse_time_column)
+    :param dictionary: If given, the ValueDictionary to encode the low-cardinality string columns with
+    :return: None
+    """
+    if parse_times:
+        df = parse_time_column(df)
+    if dictionary is not None:
+        df = dictionary.encode(df)
+    spill_file, index_file = get_spill_files(spill_directory)
+    order, bounds = sort_by_bucket(df, on, num_splits, sort_rows=sorted_runs)
+    df = df.iloc[order]
+    rows = None if file_format == "npz" else format_rows(df)
+
+    index_lines = []
+    with open(spill_file, 'ab') as f:
+        offset = f.tell()
+        for i in range(num_splits):
+            if bounds[i] == bounds[i + 1]:
+                continue
+            if file_format == "npz":
+                data = data_frame_to_columnar(df.iloc[bounds[i]:bounds[i + 1]])
+            else:
+                data = join_rows(rows[bounds[i]:bounds[i + 1]]).encode()
+            data = compress(data, compression)
+            f.write(data)
+            index_lines.append("%d\t%d\t%d\t%s\t%d\n" % (i, offset, len(data), source, chunk_number))
+            offset += len(data)
+
+    # The index is only written once the segments are, so that it never points to missing data
+    new_index = not os.path.exists(index_file)
+    with open(index_file, 'a') as f:
+        if new_index:
+            f.write(",".join(df.columns) + "\n")
+        f.writelines(index_lines)
+
+
+def read_spill_index(index_file):
+    """
+    Reads the index of a spill file
+
+    If an input file was split more than once into the same spill file, only the segments that were
+    written last for each (input file, chunk, bucket) are kept.
+    :param index_file: Path to the spill index file
+    :return: A tuple of the columns of the data set and a data frame of the segments in the spill file
+    """
+    with open(index_file, 'r') as f:
+        columns = f.readline().strip().split(",")
+    segments = pd.read_csv(index_file, sep="\t", skiprows=1, header=None,
+                           names=['bucket', 'offset', 'length', 'source', 'chunk'],
+                           dtype={'source': str})
+    segments.drop_duplicates(['source', 'chunk', 'bucket'], keep='last', inplace=True)
+    return columns, segments
+
+
+def get_spill_segments(data_set_directory, manifest=None):
+    """
+    Gathers the segments of every spill file of a data set by bucket
+
+    :param data_set_directory: Directory containing the spill files of a data set
+    :param manifest: The manifest of the split (see load_manifest). If given, the segments of each input
+    file that was split more than once (i.e. by a resumed split) are only read from the spill file
+    of the split that finished.
+    :return: A dictionary mapping each bucket number to a tuple of the data set's columns and
+    a list of (spill file, offset, length) tuples for the segments of that bucket
+    """
+    finished = {}
+    if manifest is not None:
+        prefix = "split:%s/" % os.path.split(os.path.normpath(data_set_directory))[1]
+        finished = {task[len(prefix):]: entry['index'] for task, entry in manifest.items()
+                    if task.startswith(prefix) and 'index' in entry}
+
+    segments_by_bucket = {}
+    for index_file in listdir(data_set_directory):
+        if not index_file.endswith(".idx"):
+            continue
+        spill_file = os.path.splitext(index_file)[0] + ".spill"
+        columns, segments = read_spill_index(index_file)
+        if finished:
+            index_name = os.path.split(index_file)[1]
+            superseded = segments.source.map(finished).fillna(index_name) != index_name
+            segments = segments[~superseded]
+        for bucket, group in segments.groupby('bucket'):
+            entry = segments_by_bucket.setdefault(int(bucket), (columns, []))
+            entry[1].extend((spill_file, int(o), int(l)) for o, l in zip(group.offset, group.length))
+    return segments_by_bucket
+
+
+def read_spill_segments(columns, segments, usecols=None, dtype=None):
+    """
+    Reads the segments of spill files that belong to one bucket into a single data frame
+
+    :param columns: The columns of the data set stored in the segments
+    :param segments: List of (spill file, offset, length) tuples to read
+    :param usecols: The columns to read. If None, all columns are read.
+    :param dtype: Map from columns to the dtypes to read the CSV segments with (see schema.get_dtypes)
+    :return: A data frame containing the rows of all of the segments
+    """
+    selected = columns if usecols is None else [c for c in columns if c in usecols]
+    data, frames = [], []
+    for spill_file, file_segments in itertools.groupby(sorted(segments), key=lambda s: s[0]):
+        with open(spill_file, 'rb') as f:
+            for _, offset, length in file_segments:
+                f.seek(offset)
+                segment = decompress(f.read(length))  # by the magic number of its codec, if it's compressed
+                if is_columnar(segment):
+                    frames.append(read_columnar(io.BytesIO(segment), selected))
+                else:
+                    data.append(segment)
+
+    if data:
+        frames.append(pd.read_csv(io.BytesIO(b''.join(data)), header=None, names=columns, usecols=selected,
+                                  dtype=dtype))
+    if not frames:
+        return pd.DataFrame(columns=selected)
+    return pd.concat(frames, ignore_index=True)
+
+
+def save_split_info(output_directory, **info):
+    """
+    Records how a data set was split, so that the merge knows how to read it
+
+    :param output_directory: The output directory of the split
+    :param info: Attributes of the split, for instance "layout" and "num_splits"
+    :return: None
+    """
+    with open(os.path.join(output_directory, "split-info.json"), 'w') as f:
+        json.dump(info, f, indent=2)
+
+
+def load_split_info(directory):
+    """
+    Loads the attributes that a split was recorded with
+
+    :param directory: The output directory of a split
+    :return: Dictionary of attributes of the split. Empty if the split did not record any.
+    """
+    try:
+        with open(os.path.join(directory, "split-info.json"), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def split_task_name(file_path):
+    """
+    Names the task of splitting an input file, for the manifest of a split
+
+    :param file_path: Path to the input file, in its data set's directory
+    :return: The name of the task: "split:<data set>/<file name>"
+    """
+    data_set_directory, file_name = os.path.split(file_path)
+    return "split:%s/%s" % (os.path.split(data_set_directory)[1], file_name)
+
+
+def temporary_paths(file_map):
+    """
+    Gets the temporary names to write a map of output files under until they are complete
+
+    :param file_map: A mapping from each bucket number to an output file
+    :return: A mapping from each bucket number to the temporary name of its output file
+    """
+    return {i: file_map[i] + ".tmp" for i in file_map}
+
+
+def commit_outputs(file_paths):
+    """
+    Moves output files that were written under temporary names (see temporary_paths) into place
+
+    :param file_paths: The (final) paths of the output files
+    :return: List of the paths of the output files
+    """
+    file_paths = list(file_paths)
+    for file_path in file_paths:
+        os.replace(file_path + ".tmp", file_path)
+    return file_paths
+
+
+def discard_outputs(file_paths):
+    """
+    Deletes the temporary files of outputs that could not be written completely (see temporary_paths)
+
+    :param file_paths: The (final) paths of the output files
+    :return: None
+    """
+    for file_path in file_paths:
+        if os.path.isfile(file_path + ".tmp"):
+            os.remove(file_path + ".tmp")
+
+
+def finish_split_task(manifest_directory, file_path, num_rows, targets, spill=False):
+    """
+    Moves the split files of an input file into place and records the split in the manifest
+
+    :param manifest_directory: The output directory of the split
+    :param file_path: Path to the input file that was split
+    :param num_rows: The number of rows that were split
+    :param targets: A mapping from each bucket number to the file that it was split into, or if spill
+    is True, the directory of the data set's spill files
+    :param spill: The file was split into this worker's spill file
+    :return: None
+    """
+    if spill:
+        # The spill files are shared by every file that this worker splits, so they can only grow
+        outputs = [f for f in get_spill_files(targets) if os.path.exists(f)]
+        record_task(manifest_directory, split_task_name(file_path), num_rows, outputs, appended=True,
+                    index=os.path.split(get_spill_files(targets)[1])[1])
+    else:
+        record_task(manifest_directory, split_task_name(file_path), num_rows, commit_outputs(targets.values()))
+
+
+def record_task(directory, task, num_rows, outputs, appended=False, **info):
+    """
+    Records a finished task in the manifest of an output directory
+
+    The manifest ("manifest.jsonl") has one line for each finished task, with the size of each
+    of the task's output files. Each line is appended in a single write while holding a lock on
+    the manifest, so that the workers of a pool may record their tasks at the same time.
+    :param directory: The output directory
+    :param task: Name of the task, e.g. "split:<data set>/<file name>" or "merge:<split number>"
+    :param num_rows: The number of rows that the task wrote
+    :param outputs: Paths of the task's output files
+    :param appended: The task appended to its output files, so they may since have grown
+    :param info: Other attributes of the task to record
+    :return: None
+    """
+    entry = dict(task=task, rows=int(num_rows), appended=appended,
+                 outputs={os.path.relpath(f, directory): os.path.getsize(f) for f in outputs}, **info)
+    with open(os.path.join(directory, "manifest.jsonl"), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_manifest(directory):
+    """
+    Loads the tasks that were recorded in the manifest of an output directory
+
+    :param directory: The output directory
+    :return: Dictionary mapping each recorded task to its latest entry. Empty if there is no manifest.
+    """
+    manifest = {}
+    try:
+        with open(os.path.join(directory, "manifest.jsonl"), 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash
+                manifest[entry['task']] = entry
+    except FileNotFoundError:
+        pass
+    return manifest
+
+
+def task_complete(directory, entry):
+    """
+    Checks whether a task recorded in a manifest is complete, i.e. all of its output files are intact
+
+    :param directory: The output directory of the manifest
+    :param entry: The task's entry in the manifest (see load_manifest), or None if it has none
+    :return: True if each of the task's output files exists with the size that was recorded
+    """
+    if entry is None:
+        return False
+    for output, size in entry['outputs'].items():
+        path = os.path.join(directory, output)
+        if not os.path.isfile(path):
+            return False
+        actual_size = os.path.getsize(path)
+        if actual_size < size or (actual_size != size and not entry.get('appended')):
+            return False
+    return True
+
+
+def unfinished_tasks(directory, args_list, task_name):
+    """
+    Drops the tasks that are complete (see task_complete) from a list of tasks, to resume a run
+
+    :param directory: The output directory of the manifest
+    :param args_list: List of the arguments of each task
+    :param task_name: Function that names the task of a tuple of arguments
+    :return: List of the arguments of the tasks that aren't complete
+    """
+    manifest = load_manifest(directory)
+    remaining = [args for args in args_list if not task_complete(directory, manifest.get(task_name(args)))]
+    logger.info("Resuming: %d of %d tasks are already complete" % (len(args_list) - len(remaining), len(args_list)))
+    return remaining
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+File: redis-mass-insert.py
+
+Writes the {comment --> submission} map in the Redis protocol, for bulk loading
+into Redis with "redis-cli --pipe" before splitting by submission
+
+The comment tables (or the pickled dictionaries of a --map-cache) are streamed straight
+into one protocol file per table by a pool of workers, without building a dictionary or
+making a round trip to Redis for any of them. Load the map and save a snapshot with:
+
+    cat <output>/*.resp | redis-cli --pipe
+    redis-cli save
+
+(with --shards, load each shard's sub-directory into its own instance)
+
+and then run split-submissions.py with --map-loaded (and --compact-map if written with --compact).
+"""
+
+import os
+import log
+import argparse
+import multiprocessing as mp
+import pandas as pd
+
+from reddit import *
+from bloom import BloomFilter, open_bloom_filter
+
+map_columns = ['comment_fullname', 'post_fullname']
+bloom_filter = None
+bloom_lock = None
+
+
+def write_protocol_file(table_file, output_directory, memory_budget=None, compact=False, num_shards=1):
+    """
+    Writes the commands that store the {comment --> submission} pairs of one table to a protocol file,
+    or to one protocol file for each shard of a sharded database
+
+    :param table_file: Path to a comment table (CSV) or a pickled dictionary of the map
+    :param output_directory: Directory to write the protocol file into
+    :param memory_budget: Memory budget (bytes) for streaming the table in chunks
+    :param compact: Write HSET commands for the compact layout (see reddit.compact_map_entries) instead
+    :param num_shards: The number of shards (see reddit.shard_keys). With more than one, the commands
+    for each shard are written to the shard's sub-directory, "shard-<number>"
+    :return: Name of the protocol file(s)
+    """
+    name = os.path.splitext(os.path.split(table_file)[1])[0]
+    if num_shards == 1:
+        resp_files = [os.path.join(output_directory, "%s.resp" % name)]
+    else:
+        resp_files = [os.path.join(output_directory, "shard-%02d" % i, "%s.resp" % name) for i in range(num_shards)]
+    logger.debug("Writing: %s.resp" % name)
+
+    if table_file.endswith(".csv"):
+        chunks = read_csv_chunks(table_file, memory_budget, usecols=map_columns)
+    else:
+        d = load_dict(table_file)
+        chunks = [pd.DataFrame({map_columns[0]: list(d.keys()), map_columns[1]: list(d.values())})]
+
+    # Written under temporary names so that a partial file is never loaded
+    num_keys = 0
+    files = [open(f + ".tmp", 'wb') for f in resp_files]
+    try:
+        for df in chunks:
+            df = df.dropna()
+            if bloom_filter is not None:
+                open_bloom_filter(bloom_filter, mode='r+').add(df[map_columns[0]], lock=bloom_lock)
+            shards = shard_keys(df[map_columns[0]], num_shards, compact=compact)
+            for shard, f in enumerate(files):
+                shard_df = df[shards == shard]
+                if compact:
+                    entries = compact_map_entries(shard_df[map_columns[0]], shard_df[map_columns[1]])
+                    f.write(redis_protocol("HSET", *entries))
+                    num_keys += len(entries[0])
+                else:
+                    f.write(redis_protocol("SET", shard_df[map_columns[0]], shard_df[map_columns[1]]))
+                    num_keys += len(shard_df)
+    finally:
+        for f in files:
+            f.close()
+    for f in resp_files:
+        os.replace(f + ".tmp", f)
+    logger.debug("Wrote %d keys: %s.resp" % (num_keys, name))
+    return "%s.resp" % name
+
+
+def unpack_write_protocol_file(args):
+    return write_protocol_file(*args)
+
+
+def parse_args():
+    """
+    Parse the command line options for this file
+
+    :return: An argparse object containing parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Write the comment map in the Redis protocol for mass insertion",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    io_options_group = parser.add_argument_group("I/O Options")
+    io_options_group.add_argument('-in', "--input", help="Top level Reddit directory")
+    io_options_group.add_argument('--map-cache', help="Cache of mapping in pickled dictionaries to read instead")
+    io_options_group.add_argument('-out', "--output", required=True, help="Output directory for the protocol files")
+
+    options_group = parser.add_argument_group("Options")
+    options_group.add_argument('--bloom-filter',
+                               help="Also make a Bloom filter of the comments (for split-submissions.py --bloom-filter)")
+    options_group.add_argument('--shards', type=int, default=1,
+                               help="Number of Redis instances that the map will be sharded over")
+    options_group.add_argument('--compact', action='store_true',
+                               help="Write the map in the compact layout (for split-submissions.py --compact-map)")
+    options_group.add_argument('-p', '--pool-size', type=int, default=64, help="Thread-pool size")
+    options_group.add_argument('-m', '--memory-budget', type=int,
+                               help="Per-worker memory budget (MB) for streaming input files in chunks")
+
+    console_options_group = parser.add_argument_group("Console Options")
+    console_options_group.add_argument('-v', '--verbose', action='store_true', help='verbose output')
+    console_options_group.add_argument('--debug', action='store_true', help='Debug Console')
+    console_options_group.add_argument('-log', '--log', nargs='?', default='None', help="Logging file")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    global logger
+    logger = log.init_logger_argparse(args)
+
+    if args.map_cache is not None:
+        table_files = listdir(os.path.expanduser(args.map_cache))
+    elif args.input is not None:
+        table_files = listdir(os.path.join(os.path.expanduser(args.input), "stanford_comment_data"))
+    else:
+        logger.error("One of --input or --map-cache is required")
+        raise Exception()
+
+    output_directory = os.path.expanduser(args.output)
+    os.makedirs(output_directory, exist_ok=True)
+    if args.shards > 1:
+        for shard in range(args.shards):
+            os.makedirs(os.path.join(output_directory, "shard-%02d" % shard), exist_ok=True)
+    memory_budget = None if args.memory_budget is None else args.memory_budget * 2 ** 20
+
+    if args.bloom_filter is not None:
+        global bloom_filter, bloom_lock
+        bloom_filter = os.path.expanduser(args.bloom_filter)
+        capacity = int(1.2 * estimate_num_rows(table_files)) if args.map_cache is None \
+            else sum(len(load_dict(f)) for f in table_files)
+        logger.info("Creating Bloom filter for %d comments: %s" % (capacity, bloom_filter))
+        BloomFilter.create(bloom_filter, capacity)
+        bloom_lock = mp.Lock()  # created before the pool of workers so that they share it
+
+    # Largest tables first, for load-balancing
+    table_files.sort(key=os.path.getsize, reverse=True)
+    logger.info("Writing protocol files for %d tables..." % len(table_files))
+    args_list = [(f, output_directory, memory_budget, args.compact, args.shards) for f in table_files]
+    pool = mp.Pool(args.pool_size)
+    try:
+        for i, resp_file in enumerate(pool.imap_unordered(unpack_write_protocol_file, args_list)):
+            logger.info("Wrote %s (%d/%d files)" % (resp_file, i + 1, len(table_files)))
+    finally:
+        pool.close()
+        pool.join()
+    if args.shards == 1:
+        logger.info("Load with: cat %s/*.resp | redis-cli --pipe" % output_directory)
+    else:
+        logger.info("Load shard <n> with: cat %s/shard-<n>/*.resp | redis-cli -s <socket> --pipe" % output_directory)
+
+
+if __name__ == "__main__":
+    main()
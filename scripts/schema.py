@@ -0,0 +1,179 @@
+"""
+File: schema.py
+
+The schema of each of the tables of the Reddit data-set
+
+Each type of table is declared once here: its columns (in the order of the headers of its files),
+the dtype that each column is read with, its time column, the event type of its rows, and the
+columns that become the "param_<i>" columns of the output when it's merged on each key. The split
+and the merge read the tables with these dtypes, so that pandas doesn't infer the type of every
+column of every chunk, and only read the columns that they use.
+"""
+
+import os
+import numpy as np
+
+from enum import Enum
+from collections import OrderedDict
+
+
+class DataType(Enum):
+    """
+    Enumeration for all the types of data found in the reddit data set
+    """
+    users = 1
+    votes = 2
+    comments = 3
+    submissions = 4
+    subscriptions = 5
+    removals = 6
+    reports = 7
+    unknown = 8
+
+
+def get_data_type(directory):
+    """
+    Returns the data type of a reddit data-set subdirectory
+
+    :param directory: Path to some reddit sub-directory
+    :return: The type of data stored in that directory
+    """
+    dir = os.path.split(directory)[1]
+    if not dir:
+        dir = os.path.split(os.path.split(directory)[0])[1]
+
+    if "user" in dir: return DataType.users
+    if "vote" in dir: return DataType.votes
+    if "comment" in dir: return DataType.comments
+    if "submission" in dir: return DataType.submissions
+    if "subscription" in dir: return DataType.subscriptions
+    if "removal" in dir: return DataType.removals
+    if "report" in dir: return DataType.reports
+    return DataType.unknown
+
+
+# The low-cardinality string columns, which the split may dictionary encode (see dictionary.py)
+dictionary_columns = ['sr_name', 'event_type', 'target_type', 'vote_direction', 'post_type', 'user_type',
+                      'process_notes', 'registration_country_code']
+
+
+class TableSchema(object):
+    """
+    The columns of one type of table, and how it's merged
+    """
+
+    def __init__(self, columns, time_column='endpoint_ts', event_type=None, params=None):
+        """
+        :param columns: Map from each column of the table (in the order of the header) to its dtype
+        :param time_column: The column of the time of each row
+        :param event_type: The event type of the rows (None if the table has an event_type column of its own)
+        :param params: Map from each key that the table is merged on to the columns of the table that
+        become the "param_<i>" columns of the output
+        """
+        self.columns = OrderedDict(columns)
+        self.time_column = time_column
+        self.event_type = event_type
+        self.params = params or {}
+
+    def get_dtypes(self, parsed_times=False, encoded=False):
+        """
+        Gets the dtype to read each column of the table with
+
+        :param parsed_times: The time column was stored as milliseconds since the epoch (see reddit.parse_time_column)
+        :param encoded: The dictionary columns were stored as their ids (see dictionary.py)
+        :return: Map from each column of the table to its dtype
+        """
+        dtypes = OrderedDict(self.columns)
+        if parsed_times:
+            dtypes[self.time_column] = np.int64
+        if encoded:
+            dtypes.update((column, np.int32) for column in dtypes if column in dictionary_columns)
+        return dtypes
+
+    def get_merge_columns(self, key):
+        """
+        Gets the columns of the table that are needed to merge it on a key
+
+        :param key: The key column of the merge ("user_id" or "post_fullname")
+        :return: List of the columns that the merge uses, or None if the table isn't merged on the key
+        """
+        if key not in self.params:
+            return None
+        columns = [key, self.time_column] + self.params[key]
+        if self.event_type is None:
+            columns.append('event_type')
+        return columns
+
+
+schemas = {
+    DataType.users: TableSchema(
+        [('registration_dt', str), ('user_id', str), ('registration_country_code', str), ('is_suspended', 'boolean')],
+        time_column='registration_dt', event_type='create',
+        params={'user_id': ['registration_country_code', 'is_suspended']}),
+
+    DataType.votes: TableSchema(
+        [('endpoint_ts', str), ('user_id', str), ('sr_name', str), ('target_fullname', str), ('target_type', str),
+         ('vote_direction', str)],
+        event_type='vote',
+        params={'user_id': ['sr_name', 'target_fullname', 'target_type', 'vote_direction'],
+                'post_fullname': ['user_id', 'sr_name', 'target_fullname', 'target_type', 'vote_direction']}),
+
+    DataType.comments: TableSchema(
+        [('endpoint_ts', str), ('user_id', str), ('sr_name', str), ('comment_fullname', str), ('comment_body', str),
+         ('parent_fullname', str), ('post_fullname', str)],
+        event_type='comment',
+        params={'user_id': ['sr_name', 'comment_fullname', 'comment_body', 'parent_fullname', 'post_fullname'],
+                'post_fullname': ['user_id', 'sr_name', 'comment_fullname', 'parent_fullname', 'comment_body']}),
+
+    DataType.submissions: TableSchema(
+        [('endpoint_ts', str), ('user_id', str), ('sr_name', str), ('post_fullname', str), ('post_type', str),
+         ('post_title', str), ('post_target_url', str), ('post_body', str)],
+        event_type='submission',
+        params={'user_id': ['sr_name', 'post_fullname', 'post_type', 'post_title', 'post_target_url', 'post_body'],
+                'post_fullname': ['user_id', 'sr_name', 'post_type', 'post_title', 'post_target_url', 'post_body']}),
+
+    DataType.subscriptions: TableSchema(
+        [('endpoint_ts', str), ('user_id', str), ('sr_name', str), ('event_type', str)],
+        params={'user_id': ['sr_name']}),
+
+    DataType.removals: TableSchema(
+        [('endpoint_ts', str), ('user_id', str), ('sr_name', str), ('event_type', str), ('target_fullname', str),
+         ('target_type', str), ('user_type', str)],
+        params={'user_id': ['sr_name', 'target_fullname', 'target_type', 'user_type'],
+                'post_fullname': ['user_id', 'sr_name', 'target_fullname', 'target_type', 'user_type']}),
+
+    DataType.reports: TableSchema(
+        [('endpoint_ts', str), ('user_id', str), ('sr_name', str), ('target_fullname', str), ('target_type', str),
+         ('process_notes', str), ('details_text', str)],
+        event_type='report',
+        params={'user_id': ['sr_name', 'target_fullname', 'target_type', 'process_notes', 'details_text'],
+                'post_fullname': ['user_id', 'sr_name', 'target_fullname', 'target_type', 'process_notes',
+                                  'details_text']})
+}
+
+
+def get_dtypes(data_type, parsed_times=False, encoded=False):
+    """
+    Gets the dtype to read each column of a type of table with (see TableSchema.get_dtypes)
+
+    :param data_type: The type of the table
+    :param parsed_times: The time column was stored as milliseconds since the epoch
+    :param encoded: The dictionary columns were stored as their ids
+    :return: Map from each column to its dtype, or None for an unknown table (whose dtypes are inferred)
+    """
+    if data_type not in schemas:
+        return None
+    return schemas[data_type].get_dtypes(parsed_times=parsed_times, encoded=encoded)
+
+
+def get_merge_columns(data_type, key):
+    """
+    Gets the columns of a type of table that are needed to merge it on a key, so that only those are read
+
+    :param data_type: The type of the table
+    :param key: The key column of the merge ("user_id" or "post_fullname")
+    :return: List of the columns that the merge uses, or None if the table isn't merged on the key
+    """
+    if data_type not in schemas:
+        return None
+    return schemas[data_type].get_merge_columns(key)
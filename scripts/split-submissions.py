@@ -11,20 +11,72 @@ import sys
 import log
 import argparse
 import multiprocessing as mp
+import numpy as np
 import pandas as pd
 import psutil
 import random
+import shutil
+import itertools
 
 from reddit import *
-import redis
+from comment_index import index_exists, build_comment_index, open_comment_index
+from bloom import BloomFilter, bloom_filter_exists, open_bloom_filter
+from mapstore import map_store_types, create_map_store
+from columnar import intermediate_formats, intermediate_file_name
+from dictionary import ValueDictionary
+from readers import installed_csv_readers, default_csv_reader
+from compressors import installed_codecs, fastest_codec
+
+# Data sets that are split by the submission of the comment or submission that they target
+mapped_data_sets = ["stanford_report_data", "stanford_removal_data", "stanford_vote_data"]
+
+# Each worker's cache of the submissions of the comments that it has recently looked up
+lookup_cache = None
+
+# Only split the files that the manifest of the output doesn't record as complete
+resume = False
+
+# Format of the split files (see columnar.py)
+file_format = "csv"
+
+# Sort the rows of each split file by submission and time (see reddit.sort_by_bucket)
+sorted_runs = False
+
+# Store the times as milliseconds since the epoch (see reddit.parse_time_column)
+parse_times = True
+
+# The ids of the values of the low-cardinality string columns (see dictionary.py), or None to keep the strings
+value_dictionary = None
+
+# The CSV reader that the input is parsed with (see readers.py)
+csv_reader = "pandas"
+
+# The codec that the split files are compressed with (see compressors.py)
+compression = "none"
 
 
 def load_log(fname):
     d = load_dict(fname)
     logger.debug("Loaded: %s" % os.path.split(fname)[1])
-    redis_db = redis.StrictRedis(connection_pool=redis_pool)
-    dump_dict_to_redis(redis_db, d)
-    logger.debug("Dumped %s into Redis" % os.path.split(fname)[1])
+    map_store.put_many(list(d.keys()), list(d.values()))
+    if bloom_filter is not None:
+        open_bloom_filter(bloom_filter, mode='r+').add(list(d.keys()), lock=bloom_lock)
+    logger.debug("Dumped %s into map store" % os.path.split(fname)[1])
+
+
+def create_bloom_filter(reddit_directory):
+    """
+    Creates an empty Bloom filter for the comments, which the workers add to as they load the comment map
+
+    :param reddit_directory: The top level reddit directory
+    :return: None
+    """
+    global bloom_lock
+    comment_files = listdir(os.path.join(reddit_directory, "stanford_comment_data"))
+    capacity = int(1.2 * estimate_num_rows(comment_files))  # with room for error in the estimate
+    logger.debug("Creating Bloom filter for %d comments: %s" % (capacity, bloom_filter))
+    BloomFilter.create(bloom_filter, capacity)
+    bloom_lock = mp.Lock()  # created before the pool of workers so that they share it
 
 
 def load_dict_cache_into_db(directory):
@@ -32,7 +84,8 @@ def load_dict_cache_into_db(directory):
     pool.map(load_log, listdir(directory))
 
 
-def split_by_submission(reddit_directory, output_directory, num_splits, cached=False, map_cache=None):
+def split_by_submission(reddit_directory, output_directory, num_splits, cached=False, map_cache=None,
+                        memory_budget=None, map_index=None, shuffle_directory=None, map_loaded=False):
     """
     Splits the reddit dataset by submission ID
 
@@ -40,47 +93,245 @@ def split_by_submission(reddit_directory, output_directory, num_splits, cached=F
     :param output_directory: Output directory to write independent sub-datasets
     :param num_splits: The number of segments to split the data into
     :param cached: Directory to store a serialized dictionary of
-    :param compress: Compress intermediate files (The output of this script)
+    :param memory_budget: Per-worker memory budget (bytes) for streaming input files in chunks
+    :param map_index: Directory of an on-disk index of the {comment --> submission} map to use
+    instead of Redis. The index is built if the directory doesn't contain one.
+    :param shuffle_directory: If given, the submission of each vote/report/removal is found by a shuffle
+    join (see shuffle_join) using this scratch directory, instead of by looking up each one in a map
+    :param map_loaded: The Redis database already holds the {comment --> submission} map (e.g. it was
+    bulk-loaded from the output of redis-mass-insert.py), so the comment tables are split without storing it
     :return: None
     """
-    logger.debug("Creating target directories...")
-    global target_directories
-    target_directories = create_split_directories(output_directory, num_splits)
-    logger.debug("Target directories created.")
-
-    logger.debug("Connecting to Redis database...")
-    global redis_pool
-    redis_pool = redis.ConnectionPool(host="localhost", port=6379, db=0)
-
-    if not cached:
-        # The comment data must be loaded and read so that we have the mapping
-        # from comment full-name to base (submission) full-name, which is required for the splitting
-        # of the other data sets
-        logger.info("No database of {comment --> submission} map cached.")
-        logger.info("Processing comment tables...")
-        split_data_set(reddit_directory, "stanford_comment_data", "post_fullname", num_splits, target_directories,
-                       map_columns=("comment_fullname", "post_fullname"))
-
-    elif map_cache is not None and os.path.isdir(map_cache) and os.listdir(map_cache):
-        logger.debug("Loading dictionaries from cache into Redis...")
-        load_dict_cache_into_db(map_cache)
+    global bloom_filter
+    if not spill:
+        logger.debug("Creating target directories...")
+        create_split_directories(output_directory, num_splits)
+        logger.debug("Target directories created.")
+    save_split_info(output_directory, layout="spill" if spill else "directories", num_splits=num_splits,
+                    on="post_fullname", format=file_format, sorted_runs=sorted_runs,
+                    times="epoch_ms" if parse_times else "string", dictionary=value_dictionary is not None,
+                    compression=compression)
+
+    if shuffle_directory is not None or map_index is not None or map_loaded:
+        if not cached:
+            logger.info("Processing comment tables...")
+            split_data_set(reddit_directory, "stanford_comment_data", "post_fullname", num_splits, output_directory,
+                           memory_budget=memory_budget)
+
+    if shuffle_directory is not None:
+        logger.info("Resolving submissions with a shuffle join in: %s" % shuffle_directory)
+
+    elif map_index is not None:
+        if index_exists(map_index):
+            logger.debug("Index of {comment --> submission} map exists: %s" % map_index)
+        else:
+            logger.info("Building index of {comment --> submission} map: %s" % map_index)
+            mkdir(map_index)
+            comment_files = listdir(os.path.join(reddit_directory, "stanford_comment_data"))
+            build_comment_index(comment_files, map_index, pool_size=pool_size,
+                                memory_budget=memory_budget or 2 ** 32)
+        logger.debug("Index has: %d comments" % len(open_comment_index(map_index)))
 
     else:
-        logger.debug("Redis Database cache exists. Skipping comment splitting.")
-
-    redis_db = redis.StrictRedis(connection_pool=redis_pool)
-    logger.debug("Redis database has: %d keys" % redis_db.info()['db0']['keys'])
+        global map_store
+        comment_files = listdir(os.path.join(reddit_directory, "stanford_comment_data"))
+        logger.debug("Opening %s map store..." % map_store_type)
+        map_store = create_map_store(map_store_type, path=map_store_path,
+                                     capacity=int(1.2 * estimate_num_rows(comment_files)),
+                                     redis_addresses=redis_addresses, compact=compact_map)
+
+        if map_loaded:
+            logger.debug("Map store was loaded with the {comment --> submission} map.")
+
+        elif not cached:
+            # The comment data must be loaded and read so that we have the mapping
+            # from comment full-name to base (submission) full-name, which is required for the splitting
+            # of the other data sets
+            logger.info("No database of {comment --> submission} map cached.")
+            if bloom_filter is not None:
+                create_bloom_filter(reddit_directory)
+            logger.info("Processing comment tables...")
+            split_data_set(reddit_directory, "stanford_comment_data", "post_fullname", num_splits, output_directory,
+                           map_columns=("comment_fullname", "post_fullname"), memory_budget=memory_budget)
+
+        elif map_cache is not None and os.path.isdir(map_cache) and os.listdir(map_cache):
+            logger.debug("Loading dictionaries from cache into map store...")
+            if bloom_filter is not None:
+                create_bloom_filter(reddit_directory)
+            load_dict_cache_into_db(map_cache)
+
+        else:
+            logger.debug("Map store cache exists. Skipping comment splitting.")
+
+        logger.debug("Map store has: %d keys" % len(map_store))
+
+    if bloom_filter is not None and shuffle_directory is None and not bloom_filter_exists(bloom_filter):
+        if map_index is not None:
+            logger.info("Building Bloom filter of comments from the index: %s" % bloom_filter)
+            keys = open_comment_index(map_index).keys
+            BloomFilter.create(bloom_filter, len(keys)).add_codes(keys)
+        else:
+            logger.warning("No Bloom filter of comments: %s. Looking up every comment." % bloom_filter)
+            bloom_filter = None
 
     # Now split the rest of the data while adding a column using the mapping that we have
-    for data_set_name in ["stanford_report_data", "stanford_removal_data", "stanford_vote_data"]:
-        mapped_split(reddit_directory, data_set_name, 'target_fullname', 'post_fullname', num_splits)
+    if shuffle_directory is not None:
+        shuffle_join(reddit_directory, output_directory, num_splits, shuffle_directory, memory_budget=memory_budget)
+    else:
+        for data_set_name in mapped_data_sets:
+            mapped_split(reddit_directory, data_set_name, 'target_fullname', 'post_fullname', num_splits,
+                         output_directory, memory_budget=memory_budget)
 
     # Split the submission tables (they don't need to be mapped using the database)
     logger.info("Processing submission tables...")
-    split_data_set(reddit_directory, "stanford_submission_data", "post_fullname", num_splits, target_directories)
+    split_data_set(reddit_directory, "stanford_submission_data", "post_fullname", num_splits, output_directory,
+                   memory_budget=memory_budget)
+
+
+def shuffle_join(reddit_directory, output_directory, num_splits, shuffle_directory, memory_budget=None):
+    """
+    Splits the votes, reports and removals by submission using a shuffle join
+
+    Instead of looking up the submission of every target in a map, the comment map (comment_fullname,
+    post_fullname) is co-partitioned by comment_fullname and the votes, reports and removals by
+    target_fullname into the same buckets. Each bucket then holds every comment that its rows may
+    target, so the submissions are found with a local join before the rows are split by post_fullname.
+    :param reddit_directory: Top level reddit directory
+    :param output_directory: Output directory of the split
+    :param num_splits: The number of ways to split the data (and the number of buckets of the shuffle)
+    :param shuffle_directory: Scratch directory to co-partition the data in. Deleted afterwards.
+    :param memory_budget: Per-worker memory budget (bytes) for streaming the tables in chunks
+    :return: None
+    """
+    os.makedirs(shuffle_directory, exist_ok=True)
+    if not spill:
+        create_split_directories(shuffle_directory, num_splits)
+
+    logger.info("Co-partitioning comment map by comment_fullname...")
+    shuffle_data_set(reddit_directory, "stanford_comment_data", "comment_fullname", num_splits, shuffle_directory,
+                     usecols=['comment_fullname', 'post_fullname'], memory_budget=memory_budget)
+    for data_set_name in mapped_data_sets:
+        logger.info("Co-partitioning %s by target_fullname..." % data_set_name)
+        shuffle_data_set(reddit_directory, data_set_name, "target_fullname", num_splits, shuffle_directory,
+                         memory_budget=memory_budget)
+
+    targets = {d: create_data_set_targets(output_directory, d, num_splits, spill=spill) for d in mapped_data_sets}
+    if spill:
+        segments = {d: get_spill_segments(os.path.join(shuffle_directory, d))
+                    for d in ["stanford_comment_data"] + mapped_data_sets}
+        bucket_segments = [{d: segments[d][i] for d in segments if i in segments[d]} for i in range(num_splits)]
+    else:
+        bucket_segments = [None] * num_splits
+
+    logger.info("Joining %d buckets..." % num_splits)
+    args_list = [(i, shuffle_directory, targets, num_splits, memory_budget, bucket_segments[i])
+                 for i in range(num_splits)]
+    pool = mp.Pool(pool_size)
+    try:
+        pool.map(unpack_join_bucket, args_list)
+    finally:
+        pool.close()
+        pool.join()
+
+    logger.debug("Removing shuffle directory: %s" % shuffle_directory)
+    shutil.rmtree(shuffle_directory)
 
 
-def mapped_split(reddit_directory, data_set_name, mapped_col, result_col, num_splits):
+def shuffle_data_set(reddit_directory, data_set_name, on, num_splits, shuffle_directory, usecols=None,
+                     memory_budget=None):
+    """
+    Partitions a data set into the buckets of the shuffle join
+
+    :param reddit_directory: Top level reddit directory
+    :param data_set_name: Name of the data set to partition
+    :param on: The column to partition the data set on
+    :param num_splits: The number of buckets
+    :param shuffle_directory: Scratch directory of the shuffle
+    :param usecols: The columns of the data set to keep
+    :param memory_budget: Per-worker memory budget (bytes) for streaming the tables in chunks
+    :return: None
+    """
+    targets = create_data_set_targets(shuffle_directory, data_set_name, num_splits, spill=spill)
+    data_files = listdir(os.path.join(reddit_directory, data_set_name))
+    args_list = [(on, f, targets, num_splits, memory_budget, spill, usecols, None, "csv", False, False, None,
+                  csv_reader) for f in data_files]
+
+    pool = mp.Pool(pool_size)
+    try:
+        pool.map(unpack_split_file, args_list)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def unpack_join_bucket(args):
+    join_bucket(*args)
+
+
+def join_bucket(bucket, shuffle_directory, targets, num_splits, memory_budget=None, spill_segments=None):
+    """
+    Finds the submission of the votes, reports and removals in one bucket of the shuffle and splits them
+
+    :param bucket: The bucket of the shuffle to join
+    :param shuffle_directory: Scratch directory of the shuffle
+    :param targets: Map from each mapped data set name to its targets in the output (see create_data_set_targets)
+    :param num_splits: The number of ways to split the data
+    :param memory_budget: Memory budget (bytes) for streaming the bucket in chunks
+    :param spill_segments: If the shuffle was written to spill files, a map from data set name
+    to the columns and spill file segments of this bucket (see get_spill_segments)
+    :return: None
+    """
+    logger.debug("Joining bucket: %d" % bucket)
+    comments = list(read_shuffle_bucket(shuffle_directory, "stanford_comment_data", bucket,
+                                        spill_segments=spill_segments))
+    comments = pd.concat(comments) if comments else pd.DataFrame(columns=['comment_fullname', 'post_fullname'])
+    comment_map = pd.Series(comments.post_fullname.values, index=comments.comment_fullname.values)
+    comment_map = comment_map[~comment_map.index.duplicated()]
+
+    for data_set_name in mapped_data_sets:
+        source = "shuffle-%05d.csv" % bucket
+        output_name = intermediate_file_name(source, file_format, compression)
+        output_file_map = None if spill else {i: os.path.join(targets[data_set_name][i], output_name)
+                                              for i in targets[data_set_name]}
+        chunks = read_shuffle_bucket(shuffle_directory, data_set_name, bucket, memory_budget, spill_segments)
+        for chunk_number, df in enumerate(chunks):
+            df['post_fullname'] = df.target_fullname.map(comment_map).fillna(df.target_fullname)
+            if spill:
+                spill_data_frame(df, 'post_fullname', num_splits, targets[data_set_name], source,
+                                 chunk_number=chunk_number, compression=compression, file_format=file_format,
+                                 sorted_runs=sorted_runs, parse_times=parse_times, dictionary=value_dictionary)
+            else:
+                split_data_frame(df, 'post_fullname', num_splits, output_file_map, compression=compression,
+                                 append=chunk_number > 0, file_format=file_format, sorted_runs=sorted_runs,
+                                 parse_times=parse_times, dictionary=value_dictionary)
+
+
+def read_shuffle_bucket(shuffle_directory, data_set_name, bucket, memory_budget=None, spill_segments=None):
+    """
+    Reads the rows of a data set in one bucket of the shuffle
+
+    :param shuffle_directory: Scratch directory of the shuffle
+    :param data_set_name: Name of the data set to read
+    :param bucket: The bucket to read
+    :param memory_budget: Memory budget (bytes) for streaming the bucket in chunks
+    :param spill_segments: If the shuffle was written to spill files, a map from data set name
+    to the columns and spill file segments of this bucket
+    :return: A generator yielding data frames of the rows in the bucket
+    """
+    dtype = get_dtypes(get_data_type(data_set_name))
+    if spill_segments is None:
+        for table_file in listdir(os.path.join(shuffle_directory, "%05d" % bucket, data_set_name)):
+            for df in read_csv_chunks(table_file, memory_budget, csv_reader, dtype=dtype):
+                yield df
+
+    elif data_set_name in spill_segments:
+        columns, segments = spill_segments[data_set_name]
+        for _, file_segments in itertools.groupby(sorted(segments), key=lambda s: s[0]):
+            yield read_spill_segments(columns, list(file_segments), dtype=dtype)
+
+
+def mapped_split(reddit_directory, data_set_name, mapped_col, result_col, num_splits, output_directory,
+                 memory_budget=None):
     """
     Splits a Reddit dataset on a column after retrieving that column from the
     Redis database
@@ -90,14 +341,21 @@ def mapped_split(reddit_directory, data_set_name, mapped_col, result_col, num_sp
     :param mapped_col: The column which must be mapped to the split column
     :param result_col: The column that the "mapped_col" is mapped to, and then split on
     :param num_splits: The number of ways to split the
+    :param output_directory: Output directory of the split
+    :param memory_budget: Per-worker memory budget (bytes) for streaming the tables in chunks
     :return: None
     """
+    targets = create_data_set_targets(output_directory, data_set_name, num_splits, spill=spill)
 
     table_files = os.listdir(os.path.join(reddit_directory, data_set_name))
     args_list = [
-        (reddit_directory, data_set_name, table_fname, mapped_col, result_col, num_splits)
+        (reddit_directory, data_set_name, table_fname, mapped_col, result_col, num_splits, targets, memory_budget,
+         output_directory)
         for table_fname in table_files
     ]
+    if resume:
+        args_list = unfinished_tasks(output_directory, args_list,
+                                     lambda args: split_task_name(os.path.join(*args[:3])))
 
     pool = mp.Pool(pool_size)
     pool.map(unpack_mapped_split_core, args_list)
@@ -107,7 +365,8 @@ def unpack_mapped_split_core(args):
     mapped_split_core(*args)
 
 
-def mapped_split_core(reddit_directory, data_set_name, table_fname, mapped_col, result_col, num_splits):
+def mapped_split_core(reddit_directory, data_set_name, table_fname, mapped_col, result_col, num_splits, targets,
+                      memory_budget=None, manifest_directory=None):
     """
     Core routine of the mapped_split routine.
     Splits a single table file
@@ -117,31 +376,102 @@ def mapped_split_core(reddit_directory, data_set_name, table_fname, mapped_col,
     :param mapped_col: Column that is mapped to result_col and then split on
     :param result_col: Column that mapped_col is mapped to. Data is split on this column's value
     :param num_splits: Number of ways to split the file
+    :param targets: Map from split number to the data set's directory in that split, or the
+    data set's spill directory if splitting to spill files
+    :param memory_budget: Memory budget (bytes) for streaming the file in chunks. If None, the
+    whole file is read at once. Up to four chunks (one in each stage and one waiting between each) are held at once.
+    :param manifest_directory: If given, the split is written under temporary names and recorded in the
+    manifest of this directory once it's complete (see reddit.split_file)
     :return: None
     """
 
     table_file_path = os.path.join(reddit_directory, data_set_name, table_fname)
+    store = map_store if map_index is None else open_comment_index(map_index)
+
+    # Make a map of output files for each of the splits
+    output_name = intermediate_file_name(table_fname, file_format, compression)
+    output_file_map = None if spill else {i: os.path.join(targets[i], output_name) for i in targets}
+    write_map = output_file_map if spill or manifest_directory is None else temporary_paths(output_file_map)
+    num_rows = [0]
+
+    def resolve(chunk):
+        chunk_number, df = chunk
+        # Only comments are in the map: everything else (i.e. submissions) is its own submission,
+        # as are the comments that the Bloom filter rules out
+        lookup = np.array(df[mapped_col].str.startswith("t1_", na=False), dtype=bool)
+        num_comments = lookup.sum()
+        if bloom_filter is not None:
+            lookup[lookup] = open_bloom_filter(bloom_filter).contains(df[mapped_col][lookup])
+        logger.debug("Looking up %d of %d targets (%d comments)" % (lookup.sum(), len(df), num_comments))
+
+        df[result_col] = df[mapped_col]
+        values = lookup_submissions(df[mapped_col][lookup], store)
+        df.loc[lookup, result_col] = pd.Series(values, index=df.index[lookup], dtype=object)
+        df[result_col] = df[result_col].fillna(df[mapped_col])
+        return chunk_number, df
+
+    def write(chunk):
+        chunk_number, df = chunk
+        logger.debug("Splitting: %s" % table_fname)
+        num_rows[0] += len(df)
+        if spill:
+            spill_data_frame(df, result_col, num_splits, targets, table_fname, chunk_number=chunk_number,
+                             compression=compression, file_format=file_format, sorted_runs=sorted_runs,
+                             parse_times=parse_times, dictionary=value_dictionary)
+        else:
+            split_data_frame(df, result_col, num_splits, write_map, compression=compression, append=chunk_number > 0,
+                             file_format=file_format, sorted_runs=sorted_runs, parse_times=parse_times,
+                             dictionary=value_dictionary)
+
+    # The worker's cache outlives the file, so its hits and misses on this file are counted from here
+    cache_counts = (0, 0) if lookup_cache is None else (lookup_cache.hits, lookup_cache.misses)
+
+    # Each chunk is read, resolved and written by its own thread, so that a worker can parse
+    # one chunk while it waits on the lookups of the previous one
     logger.debug("Loading: %s" % table_fname)
-    df = pd.read_csv(table_file_path, engine='python')
+    dtype = get_dtypes(get_data_type(data_set_name))
+    chunks = enumerate(read_csv_chunks(table_file_path, memory_budget, csv_reader, dtype=dtype))
+    times = run_pipeline(chunks, [resolve, write], names=["read", "resolve", "write"])
+    logger.debug("Stage times of %s: %s" % (table_fname, ", ".join("%s %.1fs busy/%.1fs idle" % t for t in times)))
+    if manifest_directory is not None:
+        finish_split_task(manifest_directory, table_file_path, num_rows[0],
+                          targets if spill else output_file_map, spill=spill)
+
+    if lookup_cache is not None:
+        hits, misses = lookup_cache.hits - cache_counts[0], lookup_cache.misses - cache_counts[1]
+        logger.debug("Lookup cache of %s: %d hits, %d misses (%.1f%% hit rate, %d cached)" %
+                     (table_fname, hits, misses, 100 * hits / max(hits + misses, 1), len(lookup_cache)))
+
 
-    logger.debug("Mapping column \"%s\" from Redis ..." % mapped_col)
-    redis_db = get_redis_db(redis_pool)
-    df[result_col] = get_values_from_redis(redis_db, df[mapped_col], num_chunks=7)
-    df[result_col].fillna(df[mapped_col], inplace=True)
+def lookup_submissions(comments, store):
+    """
+    Looks up the submission of each of a column of comments in the {comment --> submission} map
+
+    Each distinct comment is only looked up once, and the comments that this worker has
+    looked up recently are taken from its cache instead of the map.
+    :param comments: Column of comment full-names
+    :param store: The map store (see mapstore.py) or comment index to look the comments up in
+    :return: Array of the submission of each comment, or None for comments that aren't in the map
+    """
+    global lookup_cache
+    if lookup_cache is None:
+        lookup_cache = LRUCache(lookup_cache_size)
 
-    # Make a map of output files for each of the splits as well as creating the
-    # directories that they belong in
-    output_file_map = {}
-    for i in target_directories:
-        target_sub_dir = os.path.join(target_directories[i], data_set_name)
-        mkdir(target_sub_dir)
-        output_file_map[i] = os.path.join(target_sub_dir, table_fname)
+    codes, uniques = pd.factorize(comments)
+    values, found = lookup_cache.get_many(uniques)
+    values = np.array(values, dtype=object)
 
-    logger.debug("Splitting: %s" % table_fname)
-    split_data_frame(df, result_col, lambda s: hash(s) % num_splits, output_file_map)
+    missing = uniques[~found]
+    if len(missing) > 0:
+        logger.debug("Mapping %d comments ..." % len(missing))
+        missing_values = store.get_many(missing)
+        values[~found] = missing_values
+        lookup_cache.put_many(missing, missing_values)
+    return values[codes]
 
 
-def split_data_set(reddit_path, data_set_name, on, num_splits, target_directories, map_columns=None):
+def split_data_set(reddit_path, data_set_name, on, num_splits, output_directory, map_columns=None,
+                   memory_budget=None):
     """
     Splits a Reddit Dataset
 
@@ -149,19 +479,26 @@ def split_data_set(reddit_path, data_set_name, on, num_splits, target_directorie
     :param data_set_name: Name of the sub-directory containing the data-set to split
     :param on: The column to split the data set on
     :param num_splits: The number of ways to split the dataset
-    :param target_directories: Map of target directories for each split
+    :param output_directory: Output directory of the split
     :param map_columns: Tuple of columns to store a mapping between in the database
-    :param redis_pool: Pool of Redis database connections to dump the column mapping in
+    :param memory_budget: Per-worker memory budget (bytes) for streaming the tables in chunks
     :return: None
     """
-    targets = {}
-    for i in range(num_splits):
-        targets[i] = os.path.join(target_directories[i], data_set_name)
-        mkdir(targets[i])
+    targets = create_data_set_targets(output_directory, data_set_name, num_splits, spill=spill)
 
     full_sub_data_path = os.path.join(reddit_path, data_set_name)
     data_files = map(lambda f: os.path.join(full_sub_data_path, f), os.listdir(full_sub_data_path))
-    args_list = [(on, table_file, targets, num_splits, map_columns) for table_file in data_files]
+    args_list = [(on, table_file, targets, num_splits, map_columns, memory_budget, output_directory)
+                 for table_file in data_files]
+    if resume and map_columns is None:
+        args_list = unfinished_tasks(output_directory, args_list, lambda args: split_task_name(args[1]))
+    elif resume:
+        # The map must still be stored from every comment table, but the complete ones aren't split again
+        manifest = load_manifest(output_directory)
+        args_list = [args + (task_complete(output_directory, manifest.get(split_task_name(args[1]))),)
+                     for args in args_list]
+        num_split = sum(args[-1] for args in args_list)
+        logger.info("Resuming: %d of %d tables are already split" % (num_split, len(args_list)))
 
     pool = mp.Pool(pool_size)
     pool.map(unpack_split_file_with_map, args_list)
@@ -171,42 +508,66 @@ def unpack_split_file_with_map(args):
     split_file_with_map(*args)
 
 
-def split_file_with_map(on, file_path, targets, num_splits, map_columns=None):
+def split_file_with_map(on, file_path, targets, num_splits, map_columns=None, memory_budget=None,
+                        manifest_directory=None, map_only=False):
     """
     Splits the rows of a data frame stored in a file on a specified column
 
     :param on: The column of the data frame to split the input on
     :param file_path: Path to the file containing the data frame (in CSV)
-    :param targets:
+    :param targets: Map from split number to the data set's directory in that split, or the
+    data set's spill directory if splitting to spill files
     :param num_splits: The number of buckets to split the data frame up into
     :param map_columns: A tuple specifying two columns of the data frame that need to be
     zipped together into a python dictionary and saved to file. Must pass maps_dir as well.
-    :param redis_pool: Pool of redis database connections to dup the mapping into
+    :param memory_budget: Memory budget (bytes) for streaming the file in chunks. If None, the
+    whole file is read at once.
+    :param manifest_directory: If given, the split is written under temporary names and recorded in the
+    manifest of this directory once it's complete (see reddit.split_file)
+    :param map_only: Only store the map of the file, which was already split
     :return: None
     """
     file_name = os.path.split(file_path)[1]
+    output_name = intermediate_file_name(file_name, file_format, compression)
+    file_targets = None if spill else {i: os.path.join(targets[i], output_name) for i in targets}
+    write_targets = file_targets if spill or manifest_directory is None else temporary_paths(file_targets)
     logger.debug("Loading: %s" % file_name)
-    df = pd.read_csv(file_path)
-
-    def split():
-        logger.debug("Splitting: %s" % file_name)
-        file_targets = {i: os.path.join(targets[i], file_name) for i in targets}
-        split_data_frame(df, on, lambda x: hash(x) % num_splits, file_targets)
-
-    def dump():
-        if map_columns is not None:
-            logger.debug("Dumping col. map \"%s\" to Redis: %s" % (map_columns[0], file_name))
-            redis_db = redis.StrictRedis(connection_pool=redis_pool)
-            d = dict(zip(df[map_columns[0]], df[map_columns[1]]))
-            dump_dict_to_redis(redis_db, d)
-
-    # do these two tasks in a random order for load-balancing
-    if random.randint(0, 1):
-        split()
-        dump()
-    else:
-        dump()
-        split()
+
+    num_rows = 0
+    dtype = get_dtypes(get_data_type(os.path.dirname(file_path)))
+    for chunk_number, df in enumerate(read_csv_chunks(file_path, memory_budget, csv_reader, dtype=dtype)):
+        num_rows += len(df)
+
+        def split():
+            if map_only:
+                return
+            logger.debug("Splitting: %s" % file_name)
+            if spill:
+                spill_data_frame(df, on, num_splits, targets, file_name, chunk_number=chunk_number,
+                                 compression=compression, file_format=file_format, sorted_runs=sorted_runs,
+                                 parse_times=parse_times, dictionary=value_dictionary)
+            else:
+                split_data_frame(df, on, num_splits, write_targets, compression=compression, append=chunk_number > 0,
+                                 file_format=file_format, sorted_runs=sorted_runs, parse_times=parse_times,
+                                 dictionary=value_dictionary)
+
+        def dump():
+            if map_columns is not None:
+                logger.debug("Dumping col. map \"%s\" to map store: %s" % (map_columns[0], file_name))
+                map_store.put_many(df[map_columns[0]], df[map_columns[1]])
+                if bloom_filter is not None:
+                    open_bloom_filter(bloom_filter, mode='r+').add(df[map_columns[0]], lock=bloom_lock)
+
+        # do these two tasks in a random order for load-balancing
+        if random.randint(0, 1):
+            split()
+            dump()
+        else:
+            dump()
+            split()
+
+    if manifest_directory is not None and not map_only:
+        finish_split_task(manifest_directory, file_path, num_rows, targets if spill else file_targets, spill=spill)
 
 
 def parse_args():
@@ -221,13 +582,54 @@ def parse_args():
     io_options_group = parser.add_argument_group("I/O Options")
     io_options_group.add_argument('-in', "--input", help="Input directory")
     io_options_group.add_argument('-out', "--output", help="Output directory")
-    io_options_group.add_argument('-c', '--compress', action='store_true', help='Compress output')
+    io_options_group.add_argument('-c', '--compress', nargs='?', choices=installed_codecs(), default="none",
+                                  const=fastest_codec(),
+                                  help="Compress the split files with a codec (the fastest installed one if not given)")
+    io_options_group.add_argument('--spill', action='store_true',
+                                  help="Write one indexed spill file per worker and data set instead of a file per split")
+    io_options_group.add_argument('--format', choices=intermediate_formats, default="csv",
+                                  help="Format of the split files: CSV, or a typed columnar binary format")
+    io_options_group.add_argument('--sorted-runs', action='store_true',
+                                  help="Sort the rows of each split file, so that they can be merged without sorting")
+    io_options_group.add_argument('--raw-times', action='store_true',
+                                  help="Keep the times as strings instead of parsing them into milliseconds since the epoch")
+    io_options_group.add_argument('--no-dictionary', action='store_true',
+                                  help="Keep the low-cardinality columns as strings instead of encoding them as ids")
     io_options_group.add_argument('--cached', action='store_true', help="Don't re-create the Redis cache")
     io_options_group.add_argument('--map-cache', help="Cache of mapping in pickled dictionaries")
+    io_options_group.add_argument('--shuffle-join', action='store_true',
+                                  help="Find the submissions of votes, reports and removals with a shuffle join "
+                                       "instead of looking up every one in a map")
+    io_options_group.add_argument('--scratch', help="Scratch directory for the shuffle join")
+    io_options_group.add_argument('--map-index',
+                                  help="Directory of an on-disk index of the comment map to use instead of Redis")
+    io_options_group.add_argument('--map-store', choices=map_store_types, default="redis",
+                                  help="Store for the comment map")
+    io_options_group.add_argument('--map-store-path',
+                                  help="File of the dbm, sqlite or shmht comment map store "
+                                       "(default: comment-map.<store> next to the output directory)")
+    io_options_group.add_argument('--redis', nargs='+', default=["localhost:6379"],
+                                  help="Addresses (host:port or Unix socket path) of the Redis instances to "
+                                       "shard the comment map over")
+    io_options_group.add_argument('--compact-map', action='store_true',
+                                  help="Store the comment map in Redis in a memory-compact layout of small hashes")
+    io_options_group.add_argument('--bloom-filter',
+                                  help="File of a Bloom filter of the comments, made while the comment map is loaded, "
+                                       "to skip looking up comments that aren't in the map")
+    io_options_group.add_argument('--map-loaded', action='store_true',
+                                  help="Redis was already loaded with the comment map (see redis-mass-insert.py)")
+    io_options_group.add_argument('--resume', action='store_true',
+                                  help="Only split the files that the manifest of the output doesn't record as complete")
 
     options_group = parser.add_argument_group("Options")
     options_group.add_argument('-n', '--num-splits', type=int, default=1024, help="Number of ways to split data set")
     options_group.add_argument('-p', '--pool-size', type=int, default=64,    help="Thread-pool size")
+    options_group.add_argument('-m', '--memory-budget', type=int,
+                               help="Per-worker memory budget (MB) for streaming input files in chunks")
+    options_group.add_argument('--lookup-cache', type=int, default=2 ** 18,
+                               help="Number of comment lookups for each worker to cache (0 for none)")
+    options_group.add_argument('--reader', choices=installed_csv_readers(), default=default_csv_reader(),
+                               help="CSV reader to parse the input with: pandas, or pyarrow's multithreaded reader")
 
     console_options_group = parser.add_argument_group("Console Options")
     console_options_group.add_argument('-v', '--verbose', action='store_true', help='verbose output')
@@ -248,9 +650,25 @@ def main():
     global logger
     logger = log.init_logger_argparse(args)
 
-    global pool_size, compress
+    global pool_size, compression, spill, map_index, compact_map, bloom_filter, lookup_cache_size, redis_addresses
+    global map_store_type, map_store_path, resume, file_format, sorted_runs, parse_times, value_dictionary
+    global csv_reader
     pool_size = args.pool_size
-    compress = args.compress
+    compression = args.compress
+    spill = args.spill
+    map_index = None if args.map_index is None else os.path.expanduser(args.map_index)
+    compact_map = args.compact_map
+    redis_addresses = args.redis
+    map_store_type = args.map_store
+    lookup_cache_size = args.lookup_cache
+    resume = args.resume
+    file_format = args.format
+    sorted_runs = args.sorted_runs
+    parse_times = not args.raw_times
+    csv_reader = args.reader
+    if file_format == "npz" and compression != "none" and not spill:
+        logger.warning("Split files in the columnar format are appended to, so they're not compressed")
+    bloom_filter = None if args.bloom_filter is None else os.path.expanduser(args.bloom_filter)
 
     input_directory = os.path.expanduser(args.input)
     output_directory = os.path.expanduser(args.output)
@@ -265,9 +683,21 @@ def main():
         os.makedirs(output_directory)
     else:
         logger.debug("Output directory: %s" % output_directory)
+    value_dictionary = None if args.no_dictionary else ValueDictionary(output_directory)
+
+    memory_budget = None if args.memory_budget is None else args.memory_budget * 2 ** 20
+    map_store_path = os.path.join(os.path.dirname(os.path.normpath(output_directory)), "comment-map.%s" % map_store_type)
+    if args.map_store_path is not None:
+        map_store_path = os.path.expanduser(args.map_store_path)
+
+    shuffle_directory = None
+    if args.shuffle_join:
+        scratch = args.scratch or os.path.dirname(os.path.normpath(output_directory))
+        shuffle_directory = os.path.join(os.path.expanduser(scratch), "shuffle-%d" % os.getpid())
 
     split_by_submission(input_directory, output_directory, args.num_splits,
-                        cached=args.cached, map_cache=args.map_cache)
+                        cached=args.cached, map_cache=args.map_cache, memory_budget=memory_budget,
+                        map_index=map_index, shuffle_directory=shuffle_directory, map_loaded=args.map_loaded)
 
 
 if __name__ == "__main__":
@@ -11,13 +11,25 @@ import argparse
 import multiprocessing as mp
 import pandas as pd
 from reddit import *
+from columnar import intermediate_formats
+from dictionary import ValueDictionary
+from readers import installed_csv_readers, default_csv_reader
+from compressors import installed_codecs, fastest_codec
 
 input_directory = ""
 output_directory = ""
 num_splits = 1024
 pool_size = 20
 target_directories = {}
-compress = False
+compression = "none"
+memory_budget = None
+spill = False
+resume = False
+file_format = "csv"
+sorted_runs = False
+parse_times = True
+value_dictionary = None
+csv_reader = "pandas"
 
 
 def get_bucket(s):
@@ -25,30 +37,53 @@ def get_bucket(s):
 
 
 def split_all_data_sets(on, include=None, exclude=None):
-    logger.debug("Creating target directories...")
-    create_target_directories()
-    logger.debug("Target directories created.")
-
+    if not spill:
+        logger.debug("Creating target directories...")
+        create_target_directories()
+        logger.debug("Target directories created.")
+    save_split_info(output_directory, layout="spill" if spill else "directories", num_splits=num_splits, on=on,
+                    format=file_format, sorted_runs=sorted_runs, times="epoch_ms" if parse_times else "string",
+                    dictionary=value_dictionary is not None, compression=compression)
+
+    args_list = []
     data_sets = os.listdir(input_directory)
     for data_set in data_sets:
         if include and data_set not in include: continue
         if exclude and data_set in exclude: continue
         data_set_dir = os.path.join(input_directory, data_set)
         if not os.path.isdir(data_set_dir): continue
-        logger.info("Splitting data-set: %s" % data_set)
-        split_data_set(on, data_set_dir, data_set)
+        args_list.extend(get_split_tasks(on, data_set_dir, data_set))
+
+    # One pool works through the files of every data set, largest first, so that
+    # the pool isn't left waiting on one huge file at the end of each data set
+    args_list.sort(key=lambda args: os.path.getsize(args[1]), reverse=True)
+    if resume:
+        args_list = unfinished_tasks(output_directory, args_list, lambda args: split_task_name(args[1]))
+    logger.info("Splitting %d files" % len(args_list))
 
+    pool = mp.Pool(pool_size)
+    try:
+        for num_done, file_name in enumerate(pool.imap_unordered(unpack_split_file, args_list), 1):
+            logger.info("Split %s (%d/%d files)" % (file_name, num_done, len(args_list)))
+    finally:
+        pool.close()
+        pool.join()
 
-def split_data_set(on, data_set_path, sub_dir_name):
-    targets = {}
-    for i in range(num_splits):
-        targets[i] = os.path.join(target_directories[i], sub_dir_name)
-        mkdir(targets[i])
+
+def get_split_tasks(on, data_set_path, sub_dir_name):
+    """
+    Creates the target directories of a data set and gets the arguments to split each of its files
+
+    :param on: The column to split the data set on
+    :param data_set_path: Path to the data set's directory
+    :param sub_dir_name: Name of the data set's sub-directory in the output
+    :return: List of tuples of arguments to split_file, one for each file in the data set
+    """
+    targets = create_data_set_targets(output_directory, sub_dir_name, num_splits, spill=spill)
 
     data_files = map(lambda f: os.path.join(data_set_path, f), os.listdir(data_set_path))
-    args_list = [(on, file, targets, num_splits) for file in data_files]
-    pool = mp.Pool(pool_size)
-    pool.map(unpack_split_file, args_list)
+    return [(on, file, targets, num_splits, memory_budget, spill, None, output_directory, file_format, sorted_runs,
+             parse_times, value_dictionary, csv_reader, compression) for file in data_files]
 
 
 def create_target_directories():
@@ -73,16 +108,34 @@ def parse_args():
     io_options_group = parser.add_argument_group("I/O Options")
     io_options_group.add_argument('-in', "--input", help="Input directory")
     io_options_group.add_argument('-out', "--output", help="Output directory")
-    io_options_group.add_argument('-i', "--include", narge='+',help="Sub-Directory to process")
+    io_options_group.add_argument('-i', "--include", nargs='+', help="Sub-Directory to process")
     io_options_group.add_argument('-x', '--exclude', nargs='+', help="Exclude part of the data set")
-    io_options_group.add_argument('-c', '--compress', action='store_true', help='Compress output')
-
-    io_options_group.add_argument('--submissions', action='store_true', hel='Split by submission')
+    io_options_group.add_argument('-c', '--compress', nargs='?', choices=installed_codecs(), default="none",
+                                  const=fastest_codec(),
+                                  help="Compress the split files with a codec (the fastest installed one if not given)")
+    io_options_group.add_argument('--spill', action='store_true',
+                                  help="Write one indexed spill file per worker and data set instead of a file per split")
+    io_options_group.add_argument('--format', choices=intermediate_formats, default="csv",
+                                  help="Format of the split files: CSV, or a typed columnar binary format")
+    io_options_group.add_argument('--sorted-runs', action='store_true',
+                                  help="Sort the rows of each split file, so that they can be merged without sorting")
+    io_options_group.add_argument('--raw-times', action='store_true',
+                                  help="Keep the times as strings instead of parsing them into milliseconds since the epoch")
+    io_options_group.add_argument('--no-dictionary', action='store_true',
+                                  help="Keep the low-cardinality columns as strings instead of encoding them as ids")
+    io_options_group.add_argument('--resume', action='store_true',
+                                  help="Only split the files that the manifest of the output doesn't record as complete")
+
+    io_options_group.add_argument('--submissions', action='store_true', help='Split by submission')
 
     options_group = parser.add_argument_group("Options")
     options_group.add_argument('-n', '--num-splits', type=int, default=1024, help="Number of ways to split data set")
     options_group.add_argument('-p', '--pool-size', type=int, default=20, help="Thread-pool size")
+    options_group.add_argument('-m', '--memory-budget', type=int,
+                               help="Per-worker memory budget (MB) for streaming input files in chunks")
     options_group.add_argument('-on', '--on', type=str, default="user_id", help="Field to split on")
+    options_group.add_argument('--reader', choices=installed_csv_readers(), default=default_csv_reader(),
+                               help="CSV reader to parse the input with: pandas, or pyarrow's multithreaded reader")
 
     console_options_group = parser.add_argument_group("Console Options")
     console_options_group.add_argument('-v', '--verbose', action='store_true', help='verbose output')
@@ -98,12 +151,22 @@ def main():
     global logger
     logger = log.init_logger_argparse(args)
 
-    global input_directory, output_directory, num_splits, pool_size, compress
+    global input_directory, output_directory, num_splits, pool_size, compression, memory_budget, spill, resume
+    global file_format, sorted_runs, parse_times, value_dictionary, csv_reader
     input_directory = os.path.expanduser(args.input)
     output_directory = os.path.expanduser(args.output)
     num_splits = args.num_splits
     pool_size = args.pool_size
-    compress = args.compress
+    compression = args.compress
+    memory_budget = None if args.memory_budget is None else args.memory_budget * 2 ** 20
+    spill = args.spill
+    resume = args.resume
+    file_format = args.format
+    sorted_runs = args.sorted_runs
+    parse_times = not args.raw_times
+    csv_reader = args.reader
+    if file_format == "npz" and compression != "none" and not spill:
+        logger.warning("Split files in the columnar format are appended to, so they're not compressed")
 
     logger.debug("Input directory: %s" % input_directory)
     if os.path.isfile(input_directory)or not os.path.isdir(input_directory):
@@ -115,6 +178,7 @@ def main():
         os.makedirs(output_directory)
     else:
         logger.debug("Output directory: %s" % output_directory)
+    value_dictionary = None if args.no_dictionary else ValueDictionary(output_directory)
 
     split_all_data_sets(args.on, include=args.include, exclude=args.exclude)
 
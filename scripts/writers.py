@@ -0,0 +1,228 @@
+"""
+File: writers.py
+
+Fast writing of data frames as CSV (or TSV), byte for byte as pandas.DataFrame.to_csv writes them
+
+Instead of formatting a data frame one row at a time, as to_csv does, each column is formatted
+as strings at once, the values that need quotes are quoted with vectorized string operations,
+and the rows are only joined at the end. A data frame that is split into many files (see
+reddit.split_data_frame) is formatted once, and the lines of each file are sliced out of it.
+The formatted blocks are written through large buffers, optionally by a thread of their own
+so that the next block can be formatted while the last one is written, and may be compressed
+with any of the codecs of compressors.py.
+"""
+
+import io
+import os
+import re
+import csv
+import queue
+import functools
+import threading
+import numpy as np
+import pandas as pd
+
+from compressors import compress, open_file
+
+# Size of the buffers that the files are written through
+buffer_size = 2 ** 22
+
+# The line terminator that pandas writes
+line_terminator = os.linesep
+
+
+@functools.lru_cache(maxsize=None)
+def get_quoted_characters(sep):
+    """
+    Finds the characters that make the csv module (which pandas writes with) quote a value
+
+    The characters that are quoted differ between versions of Python, so they're found by writing
+    a value with each character that may be quoted.
+    :param sep: The delimiter
+    :return: String of the characters that a value is quoted for
+    """
+    quoted = ""
+    for c in sorted(set(sep + '"\r\n' + line_terminator)):
+        buffer = io.StringIO()
+        csv.writer(buffer, delimiter=sep, lineterminator=line_terminator).writerow(["a%sb" % c, "c"])
+        if buffer.getvalue().startswith('"'):
+            quoted += c
+    return quoted
+
+
+def quote_values(values, sep):
+    """
+    Quotes the values that the csv module would quote, as it quotes them
+
+    :param values: Array of strings, as objects
+    :param sep: The delimiter
+    :return: Array of the (possibly quoted) values, as objects
+    """
+    quoted = get_quoted_characters(sep)
+    text = "".join(values)
+    if not any(c in text for c in quoted):
+        return values  # the usual case of a column without any value to quote
+
+    pattern = get_quote_pattern(quoted)
+    return np.array(['"%s"' % v.replace('"', '""') if pattern.search(v) else v for v in values], dtype=object)
+
+
+@functools.lru_cache(maxsize=None)
+def get_quote_pattern(quoted):
+    return re.compile("[%s]" % re.escape(quoted))
+
+
+def is_formatted_as_strings(dtype):
+    # Whether to_csv writes the values of a dtype as the values' strings
+    if isinstance(dtype, pd.CategoricalDtype):
+        dtype = dtype.categories.dtype
+    return (pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype) or
+            pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype))
+
+
+def format_column(column, sep=","):
+    """
+    Formats the values of a column as to_csv writes them
+
+    :param column: The column (a Series)
+    :param sep: The delimiter
+    :return: Array of the formatted value of each row, as objects
+    """
+    if not is_formatted_as_strings(column.dtype):
+        # Floats, times, etc. are formatted by pandas, one per line. They're never quoted, but an
+        # empty value of the only column of a row is written as "".
+        lines = column.to_frame().to_csv(index=False, header=False, sep=sep, lineterminator="\n").split("\n")[:-1]
+        return np.array(['' if line == '""' else line for line in lines], dtype=object)
+
+    values = column.astype(str).to_numpy(dtype=object, copy=True)
+    values[column.isnull().to_numpy(dtype=bool)] = ''
+    return quote_values(values, sep)
+
+
+def format_rows(df, sep=","):
+    """
+    Formats the rows of a data frame as to_csv(index=False, header=False) writes them
+
+    :param df: The data frame
+    :param sep: The delimiter
+    :return: List of the line of each row, without its line terminator (see join_rows)
+    """
+    if len(df.columns) == 1:
+        # An empty value of a row of one column is quoted, so that the row isn't empty
+        return [v if v else '""' for v in format_column(df.iloc[:, 0], sep)]
+    columns = [format_column(df.iloc[:, i], sep) for i in range(len(df.columns))]
+    return list(map(sep.join, zip(*columns)))
+
+
+def join_rows(rows):
+    """
+    Joins formatted rows (see format_rows) into the lines that they're written as
+
+    :param rows: List of formatted rows
+    :return: The lines of the rows, as a string
+    """
+    return line_terminator.join(rows) + line_terminator if rows else ""
+
+
+def format_header(columns, sep=","):
+    """
+    Formats the header of a data frame as to_csv writes it
+
+    :param columns: The names of the columns
+    :param sep: The delimiter
+    :return: The header line, with its line terminator
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer, delimiter=sep, lineterminator=line_terminator).writerow(list(columns))
+    return buffer.getvalue()
+
+
+def format_csv(df, sep=",", header=True):
+    """
+    Formats a data frame as df.to_csv(index=False, sep=sep, header=header) does
+
+    :param df: The data frame
+    :param sep: The delimiter
+    :param header: Include the header line
+    :return: The CSV, as a string
+    """
+    return (format_header(df.columns, sep) if header else "") + join_rows(format_rows(df, sep))
+
+
+def write_data(path, data, append=False, compression=None):
+    """
+    Writes a formatted block to a file
+
+    :param path: Path to the file
+    :param data: The formatted block (a string)
+    :param append: Append the block to the file instead of overwriting it
+    :param compression: The codec to compress the block with (as a frame of its own, if appended), one of
+    compressors.compression_codecs or None
+    :return: None
+    """
+    data = compress(data.encode(), compression)
+    with open(path, 'ab' if append else 'wb', buffering=buffer_size) as f:
+        f.write(data)
+
+
+class TableWriter(object):
+    """
+    Writes a table to a file one block of rows at a time, as to_csv would write all of them at once
+    """
+
+    def __init__(self, path, columns, sep=",", threaded=False, queue_size=2, compression=None):
+        """
+        :param path: Path to the file to write
+        :param columns: The columns of the table, for its header
+        :param sep: The delimiter
+        :param threaded: Write the blocks to the file from a thread of their own, while the next ones are formatted
+        :param queue_size: The number of formatted blocks that may wait to be written, if threaded
+        :param compression: The codec to compress the file with, one of compressors.compression_codecs or None
+        """
+        self.file = open_file(path, 'wb', compression, buffering=buffer_size)
+        self.sep = sep
+        self.num_rows = 0
+        self.thread = None
+        self.error = None
+        if threaded:
+            self.queue = queue.Queue(queue_size)
+            self.thread = threading.Thread(target=self._write_blocks, daemon=True)
+            self.thread.start()
+        self._write(format_header(columns, sep))
+
+    def _write_blocks(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            if self.error is None:
+                try:
+                    self.file.write(data.encode())
+                except Exception as e:
+                    self.error = e
+
+    def _write(self, data):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self.file.write(data.encode())
+        else:
+            self.queue.put(data)
+
+    def write(self, df):
+        """
+        Writes a block of rows
+
+        :param df: Data frame of the rows, with the columns of the table
+        :return: None
+        """
+        self._write(join_rows(format_rows(df, self.sep)))
+        self.num_rows += len(df)
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+        self.file.close()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+File: bloom_test.py
+
+Tests for the Bloom filter of full-names
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from bloom import *
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "comments.bloom")
+        self.added = ["t1_%s" % np.base_repr(i, 36).lower() for i in range(0, 20000, 2)]
+        self.others = ["t1_%s" % np.base_repr(i, 36).lower() for i in range(1, 20000, 2)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_membership(self):
+        bloom = BloomFilter.create(self.path, len(self.added), error_rate=0.01)
+        bloom.add(self.added[:5000])
+        bloom.add(self.added[5000:] + [None, "[deleted]"])
+
+        bloom = BloomFilter(self.path)
+        self.assertTrue(bloom.contains(self.added).all())
+        self.assertLess(bloom.contains(self.others).mean(), 0.02)
+        self.assertEqual(list(bloom.contains([None, "[deleted]"])), [False, False])
+
+    def test_add_codes(self):
+        bloom = BloomFilter.create(self.path, len(self.added))
+        bloom.add_codes(encode_fullnames(self.added))
+        self.assertTrue(bloom_filter_exists(self.path))
+        self.assertTrue(open_bloom_filter(self.path).contains(self.added).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+File: codec_test.py
+
+Tests for the compact encodings of full-names, user ids and timestamps
+"""
+
+import os
+import unittest
+import numpy as np
+import pandas as pd
+
+from codec import *
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+
+class CodecTest(unittest.TestCase):
+
+    def setUp(self):
+        self.comments = pd.read_csv(os.path.join(test_data, "comments", "comments.csv"))
+        self.votes = pd.read_csv(os.path.join(test_data, "votes", "votes.csv"))
+
+    def test_fullnames(self):
+        fullnames = list(self.comments.comment_fullname) + list(self.votes.target_fullname) + \
+                    ["t3_0", "t3_00", "t3_z", "t5_2qh1i", "t1_zzzzzzzzzzz"]
+        codes = encode_fullnames(fullnames)
+        self.assertEqual(list(decode_fullnames(codes)), fullnames)
+        self.assertEqual(list(np.argsort(codes, kind='stable')),
+                         list(np.argsort(np.array(fullnames), kind='stable')))
+
+    def test_invalid_fullnames(self):
+        codes = encode_fullnames([None, "[deleted]", "t1_ABC", "t1_zzzzzzzzzzzz"])
+        self.assertEqual(list(codes), [-1] * 4)
+        self.assertEqual(list(decode_fullnames(codes)), [None] * 4)
+        self.assertRaises(ValueError, encode_keys, ["t3_54tr0w", "[deleted]"], "post_fullname")
+
+    def test_fullname_numbers(self):
+        tags, numbers = encode_fullname_numbers(["t1_0", "t1_z", "t1_10", "t3_54tr0w", "t1_01", None])
+        self.assertEqual(list(tags), [1, 1, 1, 3, -1, -1])
+        self.assertEqual(list(numbers), [0, 35, 36, int("54tr0w", 36), -1, -1])
+
+    def test_user_ids(self):
+        user_ids = list(self.comments.user_id) + list(self.votes.user_id)
+        codes = encode_user_ids(user_ids)
+        self.assertEqual(codes.dtype, np.dtype("S20"))
+        self.assertEqual(list(decode_user_ids(codes)), user_ids)
+        self.assertEqual(list(np.argsort(codes, kind='stable')),
+                         list(np.argsort(np.array(user_ids), kind='stable')))
+
+    def test_missing_user_ids(self):
+        self.assertEqual(list(decode_user_ids(encode_user_ids([None, "zr8jOCw0n6t/2QIHvwWUy1J1Xy0="]))),
+                         [None, "zr8jOCw0n6t/2QIHvwWUy1J1Xy0="])
+        self.assertRaises(ValueError, encode_user_ids, ["not a user id"])
+
+    def test_missing_keys(self):
+        # Missing keys sort last, as they do when sorting strings
+        user_ids = [None] + list(self.votes.user_id) + [None]
+        fullnames = [None] + list(self.votes.target_fullname) + [None]
+        for column, keys in [("user_id", user_ids), ("post_fullname", fullnames)]:
+            codes = encode_keys(keys, column)
+            self.assertEqual(list(decode_keys(codes, column)), keys)
+            self.assertEqual(list(np.argsort(codes, kind='stable')),
+                             list(pd.Series(keys).sort_values(kind='stable').index))
+
+    def test_timestamps(self):
+        timestamps = list(self.comments.endpoint_ts) + list(self.votes.endpoint_ts) + \
+                     ["2017-01-01 00:00:00 UTC", "2017-01-01 00:00:00.1 UTC", "2017-01-01 00:00:00.01 UTC", None]
+        codes = encode_timestamps(timestamps)
+        self.assertEqual(codes[0], pd.Timestamp(timestamps[0].replace(" UTC", "")).value // 10 ** 6)
+        self.assertEqual(list(decode_timestamps(codes)), timestamps)
+        self.assertEqual(list(np.argsort(codes, kind='stable')),
+                         list(pd.Series(timestamps).sort_values(kind='stable').index))
+
+    def test_dates(self):
+        codes = encode_timestamps(["2014-03-06", "2014-03-06 00:00:00.001 UTC"])
+        self.assertEqual(codes[1] - codes[0], 1)
+        self.assertEqual(decode_timestamps(codes)[0], "2014-03-06 00:00:00 UTC")
+        self.assertRaises(ValueError, encode_timestamps, ["2014-03-06T00:00:00"])
+
+
+if __name__ == "__main__":
+    unittest.main()
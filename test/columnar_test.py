@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+File: columnar_test.py
+
+Tests for the columnar format of the intermediate files
+"""
+
+import io
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from columnar import *
+from reddit import split_data_frame, spill_data_frame, get_spill_segments, read_spill_segments
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+
+class ColumnarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.comments = pd.read_csv(os.path.join(test_data, "comments", "comments.csv"))
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_round_trip(self):
+        path = os.path.join(self.output_dir, "comments.npz")
+        write_columnar(self.comments[:10], path)
+        write_columnar(self.comments[10:], path, append=True)
+
+        df = read_columnar(path)
+        self.assertEqual(list(df.dtypes), list(self.comments.dtypes))
+        pd.testing.assert_frame_equal(df, self.comments, check_dtype=False)
+
+        columns = ['post_fullname', 'endpoint_ts']
+        df = read_columnar(path, columns=columns)
+        self.assertEqual(list(df.columns), ['endpoint_ts', 'post_fullname'])
+        self.assertEqual(df.post_fullname.tolist(), self.comments.post_fullname.tolist())
+
+    def test_column_types(self):
+        # Every column is stored without pickling objects, including missing and non-ASCII strings
+        df = pd.DataFrame({'text': ['caf\u00e9', None, '', 'a\nb', '\U0001f600'],
+                           'time': np.arange(5, dtype=np.int64),
+                           'id': np.arange(5, dtype=np.int32),
+                           'boolean': pd.array([True, None, False, True, None], dtype='boolean'),
+                           'category': pd.Categorical(['u', 'v', None, 'u', 'v'])})
+        path = os.path.join(self.output_dir, "types.npz")
+        write_columnar(df, path)
+        write_columnar(df.iloc[:0], path, append=True)
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                self.assertNotEqual(np.load(io.BytesIO(archive.read(name)), allow_pickle=False).dtype, object)
+
+        result = read_columnar(path)
+        self.assertEqual(result.time.dtype, np.int64)
+        self.assertEqual(result.id.dtype, np.int32)
+        self.assertEqual(result.boolean.dtype, 'boolean')
+        self.assertEqual(result.astype(object).where(result.notnull(), None).values.tolist(),
+                         df.astype(object).where(df.notnull(), None).values.tolist())
+        self.assertRaises(TypeError, write_columnar, pd.DataFrame({'mixed': ['a', 1]}), path)
+
+    def test_split_formats_match(self):
+        num_splits = 4
+        csv_map = {i: os.path.join(self.output_dir, "%05d.csv" % i) for i in range(num_splits)}
+        npz_map = {i: os.path.join(self.output_dir, "%05d.npz" % i) for i in range(num_splits)}
+        split_data_frame(self.comments, 'user_id', num_splits, csv_map)
+        split_data_frame(self.comments, 'user_id', num_splits, npz_map, file_format="npz")
+
+        spill_dir = os.path.join(self.output_dir, "spill")
+        os.mkdir(spill_dir)
+        spill_data_frame(self.comments, 'user_id', num_splits, spill_dir, "comments.csv", file_format="npz")
+        segments = get_spill_segments(spill_dir)
+
+        for i in range(num_splits):
+            expected = pd.read_csv(csv_map[i])
+            self.assertEqual(read_columnar(npz_map[i]).values.tolist(), expected.values.tolist())
+            if i in segments:
+                df = read_spill_segments(*segments[i], usecols=['user_id'])
+                self.assertEqual(df.user_id.tolist(), expected.user_id.tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
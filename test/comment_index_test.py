@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+File: comment_index_test.py
+
+Tests for the on-disk index of the {comment --> submission} map
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+
+from comment_index import *
+
+comments_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data", "comments", "comments.csv")
+
+
+class CommentIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index_directory = tempfile.mkdtemp()
+        self.comments = pd.read_csv(comments_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.index_directory)
+
+    def test_build_and_lookup(self):
+        self.assertFalse(index_exists(self.index_directory))
+        build_comment_index([comments_file], self.index_directory, pool_size=2, memory_budget=256)
+        self.assertTrue(index_exists(self.index_directory))
+
+        index = CommentIndex(self.index_directory)
+        self.assertEqual(len(index), len(self.comments))
+
+        lookups = list(self.comments.comment_fullname) + ["t1_zzzzzzz", "t3_54tr0w", None]
+        expected = list(self.comments.post_fullname) + [None, None, None]
+        self.assertEqual(index.get_many(pd.Series(lookups)), expected)
+
+    def test_tags(self):
+        # A submission's full-name isn't found as the comment with the same id
+        build_comment_index([comments_file], self.index_directory, pool_size=2)
+        comment = self.comments.comment_fullname[0]
+        lookups = [comment, "t3_" + comment[3:], "t5_" + comment[3:]]
+        self.assertEqual(CommentIndex(self.index_directory).get_many(lookups),
+                         [self.comments.post_fullname[0], None, None])
+
+    def test_format_version(self):
+        build_comment_index([comments_file], self.index_directory, pool_size=2)
+        format_file = os.path.join(self.index_directory, format_file_name)
+        with open(format_file, 'w') as f:
+            json.dump({"version": index_format_version - 1}, f)
+        self.assertFalse(index_exists(self.index_directory))
+        os.remove(format_file)  # an index built before the format was recorded
+        self.assertFalse(index_exists(self.index_directory))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+File: compressors_test.py
+
+Tests for the compression codecs of the split files and the merge output
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+
+from compressors import *
+from columnar import intermediate_file_name
+from readers import read_csv, installed_csv_readers
+from writers import format_csv, write_data, TableWriter
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+
+class CompressorsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.votes = pd.read_csv(os.path.join(test_data, "votes", "votes.csv"), dtype=str)
+        self.codecs = installed_codecs()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_file_names(self):
+        self.assertEqual(intermediate_file_name("votes.csv", "csv", "zstd"), "votes.csv.zst")
+        self.assertEqual(intermediate_file_name("votes.csv.gz", "csv", "lz4"), "votes.csv.lz4")
+        self.assertEqual(intermediate_file_name("votes.csv.gz", "csv", "none"), "votes.csv")
+        self.assertEqual(intermediate_file_name("votes.csv.gz", "npz", "gzip"), "votes.npz")
+        for codec in compression_codecs:
+            self.assertEqual(get_file_codec(compressed_file_name("00000.tsv", codec)), get_codec(codec))
+
+    def test_segments(self):
+        data = format_csv(self.votes).encode()
+        for codec in self.codecs:
+            self.assertEqual(decompress(compress(data, codec)), data)
+
+    def test_appended_frames(self):
+        # A file that is split in chunks is read as one file, whichever the codec and the reader
+        halves = [self.votes.iloc[:5], self.votes.iloc[5:]]
+        for codec in self.codecs:
+            path = os.path.join(self.directory, compressed_file_name("votes.csv", codec))
+            for i, df in enumerate(halves):
+                write_data(path, format_csv(df, header=i == 0), append=i > 0, compression=codec)
+            dtype = {column: str for column in self.votes.columns}
+            for reader in installed_csv_readers():
+                df = read_csv(path, reader, dtype=dtype)
+                self.assertTrue(df.equals(self.votes), "%s %s" % (codec, reader))
+                chunks = list(read_csv(path, reader, chunksize=4, dtype=dtype))
+                self.assertTrue(pd.concat(chunks).equals(self.votes), "%s %s" % (codec, reader))
+
+    def test_table_writer(self):
+        for codec in self.codecs:
+            path = os.path.join(self.directory, compressed_file_name("votes.tsv", codec))
+            writer = TableWriter(path, self.votes.columns, sep="\t", threaded=True, compression=codec)
+            writer.write(self.votes.iloc[:5])
+            writer.write(self.votes.iloc[5:])
+            writer.close()
+            with open_file(path) as f:
+                self.assertEqual(f.read().decode(), format_csv(self.votes, sep="\t"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+File: dictionary_test.py
+
+Tests for the dictionary encoding of the low-cardinality string columns
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing as mp
+import pandas as pd
+
+from dictionary import *
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+
+class ValueDictionaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.votes = pd.read_csv(os.path.join(test_data, "votes", "votes.csv"))
+        self.removals = pd.read_csv(os.path.join(test_data, "removal", "removal.csv"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_encode_decode(self):
+        votes = self.votes.copy()
+        votes.loc[3, 'sr_name'] = None
+        encoded = ValueDictionary(self.directory).encode(votes)
+        self.assertEqual(encoded.sr_name.dtype, np.int32)
+        self.assertEqual(encoded.sr_name[3], -1)
+        self.assertEqual(list(encoded.user_id), list(votes.user_id))
+
+        decoded = ValueDictionary(self.directory).decode(encoded)
+        self.assertTrue(isinstance(decoded.sr_name.dtype, pd.CategoricalDtype))
+        self.assertEqual(decoded.to_csv(index=False), votes.to_csv(index=False))
+
+    def test_shared_ids(self):
+        # Workers that encode at the same time give each value the same id
+        workers = [mp.Process(target=ValueDictionary(self.directory).encode, args=(df,))
+                   for df in [self.votes, self.removals, self.votes, self.removals]]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        dictionary = ValueDictionary(self.directory)
+        sr_names = dictionary.categories('sr_name')
+        self.assertEqual(len(sr_names), len(set(sr_names)))
+        self.assertEqual(set(sr_names), set(self.votes.sr_name) | set(self.removals.sr_name))
+        encoded = dictionary.encode(self.removals)
+        self.assertEqual([sr_names[i] for i in encoded.sr_name], list(self.removals.sr_name))
+
+
+if __name__ == "__main__":
+    unittest.main()
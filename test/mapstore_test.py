@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+File: mapstore_test.py
+
+Tests for the stores of the {comment --> submission} map that need no server
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing as mp
+import pandas as pd
+
+from mapstore import *
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+
+class MapStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        comments = pd.read_csv(os.path.join(test_data, "comments", "comments.csv"))
+        self.keys = list(comments.comment_fullname)
+        self.values = list(comments.post_fullname)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def stores(self):
+        yield create_map_store("dbm", path=os.path.join(self.directory, "map.dbm"))
+        yield create_map_store("sqlite", path=os.path.join(self.directory, "map.sqlite"))
+        yield create_map_store("shm", capacity=len(self.keys))
+        try:
+            yield create_map_store("shmht", path=os.path.join(self.directory, "map.shmht"), capacity=len(self.keys))
+        except ImportError:
+            pass
+
+    def test_put_get(self):
+        for store in self.stores():
+            store.put_many(self.keys, self.values)
+            self.assertEqual(len(store), len(set(self.keys)))
+            self.assertEqual(store.get_many(["t1_missing", None] + self.keys), [None, None] + self.values)
+
+    def test_overwrite(self):
+        for store in self.stores():
+            # The last value of a key is kept, within a batch and between batches
+            store.put_many(["t1_a", "t1_b", "t1_a"], ["t3_1", "t3_2", "t3_3"])
+            store.put_many(["t1_b"], ["t3_4"])
+            self.assertEqual(len(store), 2)
+            self.assertEqual(store.get_many(["t1_a", "t1_b"]), ["t3_3", "t3_4"])
+
+    def test_shared_memory_full(self):
+        store = create_map_store("shm", capacity=len(self.keys))
+        store.put_many(self.keys, self.values)
+        self.assertEqual(store.get_many(self.keys), self.values)
+        more = ["t1_%d" % i for i in range(store.capacity)]
+        self.assertRaises(MemoryError, store.put_many, more, more)
+        self.assertRaises(TypeError, MapStore)
+
+    def test_workers(self):
+        half = len(self.keys) // 2
+        for store in self.stores():
+            # The workers inherit the store, as the workers of split-submissions.py do
+            workers = [mp.Process(target=store.put_many, args=(self.keys[:half], self.values[:half])),
+                       mp.Process(target=store.put_many, args=(self.keys[half:], self.values[half:]))]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.assertEqual(store.get_many(self.keys), self.values)
+
+
+if __name__ == "__main__":
+    unittest.main()
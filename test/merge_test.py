@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+File: merge_test.py
+
+Tests for sorting the merged splits within a memory budget and merging sorted runs
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import importlib
+import unittest
+import pandas as pd
+
+from reddit import save_split_info, create_split_directories, create_data_set_targets, split_file, listdir
+
+merge = importlib.import_module("merge-reddit")
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+
+class MergeTest(unittest.TestCase):
+
+    def setUp(self):
+        votes = pd.read_csv(os.path.join(test_data, "votes", "votes.csv"))
+        # Copies of the votes, which tie with each other, in an order that a stable sort must keep
+        self.votes = pd.concat([votes.assign(copy=i) for i in range(20)], ignore_index=True)
+        self.scratch = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def test_sorted_runs(self):
+        self.assert_sorted_runs(self.votes)
+
+    def test_sorted_runs_missing_keys(self):
+        # Missing keys are sorted last in every run, and stay together when the runs are merged
+        votes = self.votes.copy()
+        votes.loc[::7, 'user_id'] = None
+        max_merge_streams = merge.max_merge_streams
+        try:
+            for merge.max_merge_streams in [64, 2]:  # with passes that merge the runs into runs of their own
+                self.assert_sorted_runs(votes)
+        finally:
+            merge.max_merge_streams = max_merge_streams
+
+    def assert_sorted_runs(self, votes):
+        expected_file = os.path.join(self.scratch, "expected.tsv")
+        merge.sort_by_key(votes, 'user_id').to_csv(expected_file, index=False, sep="\t")
+
+        for memory_budget in [2 ** 30, 100000, 20000]:
+            output_file = os.path.join(self.scratch, "merged.tsv")
+            runs = merge.SortedRuns(self.scratch, 'user_id', list(votes.columns), memory_budget)
+            for start in range(0, len(votes), 37):
+                runs.add(votes[start:start + 37])
+            writer = merge.BlockWriter(output_file, list(votes.columns))
+            runs.merge(writer.write)
+            writer.close()
+
+            self.assertEqual(writer.num_rows, len(votes))
+            self.assertEqual(len(runs.run_files) > 1, memory_budget < 2 ** 30)
+            with open(output_file) as f1, open(expected_file) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_merge_sorted_streams(self):
+        # Sorted runs of the votes, each read in blocks
+        runs = [merge.sort_by_key(self.votes[i:i + 20], 'user_id') for i in range(0, len(self.votes), 20)]
+        streams = [[run[i:i + 7] for i in range(0, len(run), 7)] for run in runs]
+        expected = merge.sort_by_key(pd.concat(runs), 'user_id').reset_index(drop=True)
+
+        max_merge_streams = merge.max_merge_streams
+        try:
+            for merge.max_merge_streams in [len(streams), 4]:
+                blocks = []
+                merge.merge_streams(streams, 'user_id', list(self.votes.columns), blocks.append, 20000, self.scratch)
+                merged = pd.concat(blocks, ignore_index=True)
+                pd.testing.assert_frame_equal(merged.astype(str), expected.astype(str))
+        finally:
+            merge.max_merge_streams = max_merge_streams
+
+    def test_run_lengths(self):
+        runs = pd.concat([merge.sort_by_key(self.votes[i:i + 50], 'user_id') for i in range(0, 200, 50)])
+        blocks = [runs[i:i + 30] for i in range(0, len(runs), 30)]
+        self.assertEqual(merge.get_run_lengths(blocks, 'user_id'), [50, 50, 50, 50])
+
+
+class SplitMergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.num_splits = 64  # more than the users, so that some splits are missing data sets or are empty
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def split(self, layout):
+        split_directory = os.path.join(self.directory, layout)
+        spill = layout == "spill"
+        os.mkdir(split_directory)
+        if not spill:
+            create_split_directories(split_directory, self.num_splits)
+        save_split_info(split_directory, layout=layout, num_splits=self.num_splits, on='user_id')
+        for data_set in sorted(os.listdir(test_data)):
+            targets = create_data_set_targets(split_directory, data_set, self.num_splits, spill=spill)
+            for file_path in listdir(os.path.join(test_data, data_set)):
+                split_file('user_id', file_path, targets, self.num_splits, spill=spill)
+        return split_directory
+
+    def merge(self, split_directory, memory_budget=None, output_directory=None, resume=False):
+        output_directory = output_directory or tempfile.mkdtemp(dir=self.directory)
+        merge.merge_dataset(split_directory, output_directory, merge.MergeType.user, sequential=True, resume=resume,
+                            memory_budget=memory_budget, scratch_directory=self.directory)
+        outputs = {}
+        for i in range(self.num_splits):
+            with open(merge.get_aggregate_file(output_directory, "%05d" % i)) as f:
+                outputs[i] = f.read()
+        return outputs
+
+    def test_spill_layout(self):
+        expected = self.merge(self.split("directories"))
+        self.assertTrue(any(output.count("\n") == 1 for output in expected.values()))  # an empty split
+        spill_directory = self.split("spill")
+        self.assertEqual(self.merge(spill_directory), expected)
+        self.assertEqual(self.merge(spill_directory, memory_budget=2 ** 20), expected)
+
+    def test_new_scratch_directory(self):
+        split_directory = self.split("directories")
+        scratch_directory = os.path.join(self.directory, "scratch", "merge")
+        output_directory = tempfile.mkdtemp(dir=self.directory)
+        merge.merge_dataset(split_directory, output_directory, merge.MergeType.user, sequential=True,
+                            memory_budget=2 ** 20, scratch_directory=scratch_directory)
+        self.assertEqual(len(listdir(output_directory)), self.num_splits + 1)  # and the manifest
+        self.assertEqual(os.listdir(scratch_directory), [])
+
+    def test_resume(self):
+        split_directory = self.split("directories")
+        output_directory = tempfile.mkdtemp(dir=self.directory)
+        expected = self.merge(split_directory, output_directory=output_directory)
+
+        # Only the splits whose output is missing or was changed since it was recorded are merged again
+        manifest_file = os.path.join(output_directory, "manifest.jsonl")
+        os.remove(merge.get_aggregate_file(output_directory, "%05d" % 3))
+        with open(merge.get_aggregate_file(output_directory, "%05d" % 5), 'a') as f:
+            f.write("corrupt\n")
+        with open(manifest_file) as f:
+            num_recorded = len(f.readlines())
+        self.assertEqual(self.merge(split_directory, output_directory=output_directory, resume=True), expected)
+        with open(manifest_file) as f:
+            resumed = [json.loads(line)['task'] for line in f.readlines()[num_recorded:]]
+        self.assertEqual(sorted(resumed), ["merge:00003", "merge:00005"])
+
+    def test_failed_output(self):
+        # The temporary files of a merge that can't be written are deleted, and the merge isn't recorded
+        output_directory = tempfile.mkdtemp(dir=self.directory)
+        split_directory = os.path.join(self.directory, "%05d" % 0)
+        votes = pd.read_csv(os.path.join(test_data, "votes", "votes.csv"))
+        df = votes.assign(post_fullname=votes.target_fullname)
+        os.mkdir(merge.get_aggregate_file(output_directory, split_directory) + ".tmp")  # which can't be written
+        merge.save_final_merge(df, output_directory, split_directory, merge.MergeType.submission)
+
+        missing_file = merge.get_missing_file(output_directory, split_directory)
+        self.assertEqual(os.listdir(os.path.dirname(missing_file)), [])
+        self.assertFalse(os.path.exists(os.path.join(output_directory, "manifest.jsonl")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+File: readers_test.py
+
+Tests for the CSV readers
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+
+from readers import *
+from schema import get_data_type, get_dtypes
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+
+class ReadersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # Comment bodies that are quoted over several lines
+        comments = pd.read_csv(os.path.join(test_data, "comments", "comments.csv"))
+        comments.loc[0, 'comment_body'] = 'A body\nover "three"\nlines'
+        comments.loc[1, 'comment_body'] = None
+        self.comments_file = os.path.join(self.directory, "comments.csv")
+        comments.to_csv(self.comments_file, index=False)
+        self.dtype = get_dtypes(get_data_type("comments"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assert_same_frames(self, reader, **kwargs):
+        expected = pd.read_csv(self.comments_file, **kwargs)
+        df = read_csv(self.comments_file, reader, **kwargs)
+        self.assertEqual(list(df.columns), list(expected.columns))
+        self.assertEqual(df.to_csv(), expected.to_csv())
+
+        chunks = list(read_csv(self.comments_file, reader, chunksize=7, **kwargs))
+        self.assertEqual([len(c) for c in chunks], [len(c) for c in pd.read_csv(self.comments_file, chunksize=7)])
+        self.assertEqual(pd.concat(chunks).to_csv(), expected.to_csv())
+
+    def test_pandas(self):
+        self.assert_same_frames("pandas", dtype=self.dtype)
+        self.assertEqual(read_csv(self.comments_file, "pandas", dtype=self.dtype).comment_body[0],
+                         'A body\nover "three"\nlines')
+
+    @unittest.skipUnless(arrow_installed(), "pyarrow isn't installed")
+    def test_arrow(self):
+        self.assert_same_frames("arrow", dtype=self.dtype)
+        self.assert_same_frames("arrow", dtype=self.dtype, usecols=lambda c: c in ['comment_body', 'user_id'])
+        self.assert_same_frames("arrow", dtype=self.dtype, keep_default_na=False)
+        self.assert_same_frames("arrow")  # undeclared dtypes are inferred by pandas
+
+    @unittest.skipUnless(arrow_installed(), "pyarrow isn't installed")
+    def test_arrow_blocks(self):
+        # Chunks are parsed in blocks that end only at the ends of rows, not within quoted values
+        import readers
+        default_block_size = readers.arrow_block_size
+        for block_size in [1, 64, 1000]:
+            readers.arrow_block_size = block_size
+            try:
+                self.assert_same_frames("arrow", dtype=self.dtype)
+            finally:
+                readers.arrow_block_size = default_block_size
+
+    def test_row_blocks(self):
+        with open(self.comments_file, 'rb') as f:
+            data = f.read()
+        with open(self.comments_file, 'rb') as f:
+            blocks = list(read_row_blocks(f, 100))
+        self.assertEqual(b''.join(blocks), data)
+        for block in blocks:
+            self.assertEqual(block.count(b'"') % 2, 0)
+            self.assertTrue(block.endswith(b'\n'))
+
+
+if __name__ == "__main__":
+    unittest.main()
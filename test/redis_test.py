@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+File: redis_test.py
+
+Tests for the batched transport to and from Redis, against an in-memory stand-in
+for the database that can be made to drop connections
+"""
+
+import fnmatch
+import unittest
+import redis
+import numpy as np
+import pandas as pd
+
+from reddit import *
+
+
+class MemoryPipeline(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.commands = []
+
+    def mset(self, mapping):
+        self.commands.append(('mset', mapping))
+
+    def mget(self, keys):
+        self.commands.append(('mget', keys))
+
+    def hset(self, name, mapping):
+        self.commands.append(('hset', (name, mapping)))
+
+    def hmget(self, name, keys):
+        self.commands.append(('hmget', (name, keys)))
+
+    def hlen(self, name):
+        self.commands.append(('hlen', name))
+
+    def __len__(self):
+        return len(self.commands)
+
+    def execute(self, raise_on_error=True):
+        self.db.executed.append(len(self.commands))
+        if len(self.db.executed) - 1 in self.db.failing:
+            raise redis.exceptions.ConnectionError("Connection reset by peer")
+        if self.db.failures > 0:
+            self.db.failures -= 1
+            raise redis.exceptions.ConnectionError("Connection reset by peer")
+        replies = []
+        for name, arg in self.commands:
+            if name == 'mset':
+                self.db.data.update({k: v if isinstance(v, bytes) else str(v).encode() for k, v in arg.items()})
+                replies.append(True)
+            elif name == 'mget':
+                replies.append([self.db.data.get(key) for key in arg])
+            elif name == 'hset':
+                self.db.data.setdefault(arg[0], {}).update({str(k): str(v).encode() for k, v in arg[1].items()})
+                replies.append(len(arg[1]))
+            elif name == 'hlen':
+                replies.append(len(self.db.data.get(arg, {})))
+            else:
+                replies.append([self.db.data.get(arg[0], {}).get(str(key)) for key in arg[1]])
+        return replies
+
+
+class MemoryRedis(object):
+
+    def __init__(self, failures=0, failing=()):
+        self.data = {}
+        self.failures = failures
+        self.failing = set(failing)  # the numbers of the pipelines that fail
+        self.executed = []
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def info(self):
+        return {'db0': {'keys': len(self.data)}} if self.data else {}
+
+    def scan_iter(self, match=None, count=None):
+        return iter([key for key in self.data if match is None or fnmatch.fnmatchcase(key, match)])
+
+
+class RedisTransportTest(unittest.TestCase):
+
+    def test_iter_batches(self):
+        self.assertEqual(list(iter_batches(range(7), 3)), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(list(iter_batches([], 3)), [])
+
+    def test_redis_protocol(self):
+        keys, values = pd.Series(["t1_a", "t1_bc"]), pd.Series(["t3_x", "t3_yz"])
+        self.assertEqual(redis_protocol("SET", keys, values),
+                         b"*3\r\n$3\r\nSET\r\n$4\r\nt1_a\r\n$4\r\nt3_x\r\n"
+                         b"*3\r\n$3\r\nSET\r\n$5\r\nt1_bc\r\n$5\r\nt3_yz\r\n")
+        self.assertEqual(redis_protocol("SET", keys[:0], values[:0]), b"")
+
+    def test_round_trip(self):
+        db = MemoryRedis()
+        d = {"t1_%d" % i: ("t3_%d" % i).encode() for i in range(1000)}
+        self.assertEqual(dump_dict_to_redis(db, d, batch_size=64, batches_in_flight=4), 1000)
+        self.assertEqual(db.executed[0], 4)
+        keys = list(d) + ["t1_missing"]
+        self.assertEqual(get_values_from_redis(db, keys, batch_size=64),
+                         [v.decode() for v in d.values()] + [None])
+
+    def test_compact_layout(self):
+        db = MemoryRedis()
+        d = {"t1_%s" % np.base_repr(i, 36).lower(): "t3_%s" % np.base_repr(i // 7, 36).lower() for i in range(1000)}
+        dump_dict_to_redis(db, d, batch_size=100, compact=True)
+        self.assertLess(len(db.data), 20)
+        self.assertEqual(count_redis_keys(db), len(db.data))
+        self.assertEqual(count_redis_keys([db, MemoryRedis()], compact=True), 1000)  # the comments, not the hashes
+        self.assertTrue(all(len(fields) <= 2 ** compact_bucket_bits for fields in db.data.values()))
+        keys = ["t1_missing", None] + list(d)[::-1]
+        self.assertEqual(get_values_from_redis(db, keys, batch_size=64, compact=True),
+                         [None, None] + list(d.values())[::-1])
+
+    def test_shards(self):
+        d = {"t1_%s" % np.base_repr(i, 36).lower(): "t3_%d" % i for i in range(1000)}
+        for compact in [False, True]:
+            shards = [MemoryRedis() for _ in range(3)]
+            self.assertEqual(dump_dict_to_redis(shards, d, batch_size=100, compact=compact), 1000)
+            self.assertTrue(all(len(shard.data) > 0 for shard in shards))
+            keys = list(shard_keys(list(d), 3, compact=compact))
+            self.assertEqual(keys, list(shard_keys(list(d)[:10], 3, compact=compact)) + keys[10:])
+            self.assertEqual(get_values_from_redis(shards, ["t3_0"] + list(d), compact=compact),
+                             [None] + list(d.values()))
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.put_many(["t1_a", "t1_b"], ["t3_a", None])
+        self.assertEqual(cache.get_many(["t1_a", "t1_c"])[0], ["t3_a", None])
+        cache.put_many(["t1_c"], ["t3_c"])  # evicts t1_b, the least recently used
+        values, found = cache.get_many(["t1_a", "t1_b", "t1_c"])
+        self.assertEqual(values, ["t3_a", None, "t3_c"])
+        self.assertEqual(list(found), [True, False, True])
+        self.assertEqual((cache.hits, cache.misses), (3, 2))
+
+    def test_retry_failed_batches(self):
+        db = MemoryRedis(failures=1)
+        d = {"t1_%d" % i: b"t3_0" for i in range(100)}
+        dump_dict_to_redis(db, d, batch_size=10, batches_in_flight=5)
+        self.assertEqual(len(db.data), 100)
+        # The first pipeline failed, so its batches were re-sent one at a time
+        self.assertEqual(db.executed[:6], [5, 1, 1, 1, 1, 1])
+
+        db.failures = 10
+        self.assertRaises(redis.exceptions.ConnectionError, get_values_from_redis, db, list(d), retries=2)
+
+    def test_retries_per_batch(self):
+        batches = [["t1_%d" % i] for i in range(4)]
+
+        def mget(pipe, batch):
+            pipe.mget(batch)
+
+        # Every batch fails twice at most, so none of them runs out of re-tries
+        db = MemoryRedis(failing=[0, 1, 3])
+        db.data = {"t1_%d" % i: b"t3_%d" % i for i in range(4)}
+        self.assertEqual(pipeline_batches(db, batches, mget, retries=2), [[[b"t3_%d" % i]] for i in range(4)])
+        self.assertEqual(db.executed, [4, 1, 1, 1, 1, 1, 1])
+
+        # The last batch fails three times
+        db = MemoryRedis(failing=[0, 1, 2])
+        self.assertRaises(redis.exceptions.ConnectionError, pipeline_batches, db, batches, mget, retries=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+File: schema_test.py
+
+Tests for the schema registry of the tables of the Reddit data-set
+"""
+
+import os
+import unittest
+import numpy as np
+import pandas as pd
+
+from schema import *
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+
+class SchemaTest(unittest.TestCase):
+
+    def test_columns(self):
+        # The declared columns are the headers of the test data, which is read with the declared dtypes
+        for data_set in os.listdir(test_data):
+            data_type = get_data_type(data_set)
+            if data_type not in schemas:
+                continue  # the misspelled "subsciptions"
+            for file_name in os.listdir(os.path.join(test_data, data_set)):
+                file_path = os.path.join(test_data, data_set, file_name)
+                df = pd.read_csv(file_path, dtype=get_dtypes(data_type))
+                self.assertEqual(list(df.columns), list(schemas[data_type].columns))
+                self.assertEqual(df.to_csv(index=False), pd.read_csv(file_path).to_csv(index=False))
+
+    def test_merge_columns(self):
+        self.assertEqual(get_merge_columns(DataType.users, 'user_id'),
+                         ['user_id', 'registration_dt', 'registration_country_code', 'is_suspended'])
+        self.assertEqual(get_merge_columns(DataType.removals, 'post_fullname'),
+                         ['post_fullname', 'endpoint_ts', 'user_id', 'sr_name', 'target_fullname', 'target_type',
+                          'user_type', 'event_type'])
+        self.assertIsNone(get_merge_columns(DataType.subscriptions, 'post_fullname'))
+        self.assertIsNone(get_merge_columns(DataType.unknown, 'user_id'))
+
+    def test_dtypes(self):
+        dtypes = get_dtypes(DataType.votes, parsed_times=True, encoded=True)
+        self.assertEqual(dtypes['endpoint_ts'], np.int64)
+        self.assertEqual(dtypes['sr_name'], np.int32)
+        self.assertEqual(dtypes['user_id'], str)
+        self.assertIsNone(get_dtypes(DataType.unknown))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+File: split_submissions_test.py
+
+Tests for splitting the data sets by submission
+"""
+
+import os
+import shutil
+import tempfile
+import importlib
+import unittest
+import pandas as pd
+
+from reddit import listdir
+
+split = importlib.import_module("split-submissions")
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+# The test data of each data set that split-submissions.py splits
+data_sets = {"stanford_comment_data": "comments", "stanford_submission_data": "submission",
+             "stanford_vote_data": "votes", "stanford_report_data": "reports", "stanford_removal_data": "removal"}
+
+
+class SplitSubmissionsTest(unittest.TestCase):
+
+    num_splits = 8
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.reddit_directory = os.path.join(self.directory, "reddit")
+        for data_set_name, test_directory in data_sets.items():
+            shutil.copytree(os.path.join(test_data, test_directory), os.path.join(self.reddit_directory, data_set_name))
+
+        # Votes on some of the comments, whose submissions are found in the comment map
+        comments = pd.read_csv(os.path.join(test_data, "comments", "comments.csv"))
+        votes = pd.read_csv(os.path.join(test_data, "votes", "votes.csv"))
+        comment_votes = votes[:10].assign(target_fullname=comments.comment_fullname[:10].values, target_type="comment")
+        comment_votes.to_csv(os.path.join(self.reddit_directory, "stanford_vote_data", "comment_votes.csv"), index=False)
+
+        split.pool_size = 2
+        split.spill = False
+        split.map_index = None
+        split.bloom_filter = None
+        split.lookup_cache = None
+        split.lookup_cache_size = 1000
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def split_by_submission(self, name, **kwargs):
+        output_directory = os.path.join(self.directory, name)
+        os.mkdir(output_directory)
+        split.split_by_submission(self.reddit_directory, output_directory, self.num_splits, **kwargs)
+        return output_directory
+
+    def read_bucket(self, output_directory, bucket, data_set_name):
+        # The rows of a data set in a bucket, in a canonical order
+        files = listdir(os.path.join(output_directory, "%05d" % bucket, data_set_name))
+        if not files:
+            return []
+        df = pd.concat([pd.read_csv(f, dtype=str, keep_default_na=False) for f in files])
+        return sorted(df.itertuples(index=False, name=None))
+
+    def test_shuffle_join(self):
+        # A shuffle join finds the same submissions as looking each target up in the comment map
+        split.map_index = os.path.join(self.directory, "index")
+        mapped = self.split_by_submission("mapped", map_index=split.map_index)
+        split.map_index = None
+        joined = self.split_by_submission("joined", shuffle_directory=os.path.join(self.directory, "shuffle"))
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "shuffle")))
+
+        resolved = 0
+        for data_set_name in data_sets:
+            num_rows = 0
+            for bucket in range(self.num_splits):
+                rows = self.read_bucket(mapped, bucket, data_set_name)
+                self.assertEqual(self.read_bucket(joined, bucket, data_set_name), rows)
+                num_rows += len(rows)
+            input_files = listdir(os.path.join(self.reddit_directory, data_set_name))
+            self.assertEqual(num_rows, sum(len(pd.read_csv(f)) for f in input_files))
+
+            if data_set_name in split.mapped_data_sets:
+                df = pd.concat(pd.read_csv(f) for bucket in range(self.num_splits)
+                               for f in listdir(os.path.join(joined, "%05d" % bucket, data_set_name)))
+                resolved += (df.post_fullname != df.target_fullname).sum()
+        self.assertEqual(resolved, 10)
+
+    def test_lookup_submissions(self):
+        store = RecordingStore({"t1_a": "t3_1", "t1_b": "t3_2", "t1_c": "t3_3"})
+        split.lookup_cache_size = 2
+        comments = pd.Series(["t1_a", "t1_b", "t1_a", "t1_missing", "t1_b"])
+        self.assertEqual(list(split.lookup_submissions(comments, store)), ["t3_1", "t3_2", "t3_1", None, "t3_2"])
+        self.assertEqual(store.lookups, [["t1_a", "t1_b", "t1_missing"]])  # each comment is looked up once
+
+        # Comments that aren't in the map are cached too, and the least recently used comment is evicted
+        comments = pd.Series(["t1_missing", "t1_c", "t1_a", "t1_missing"], index=[10, 11, 12, 13])
+        self.assertEqual(list(split.lookup_submissions(comments, store)), [None, "t3_3", "t3_1", None])
+        self.assertEqual(store.lookups[1:], [["t1_c", "t1_a"]])
+        self.assertEqual((split.lookup_cache.hits, split.lookup_cache.misses), (1, 5))
+
+
+class RecordingStore(object):
+    """
+    Map store of a dictionary, which records the keys of each lookup
+    """
+
+    def __init__(self, d):
+        self.d = d
+        self.lookups = []
+
+    def get_many(self, keys):
+        self.lookups.append(list(keys))
+        return [self.d.get(key) for key in keys]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+File: split_test.py
+
+Tests for the bucket assignment and splitting of data frames
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+
+from reddit import *
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+
+class SplitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.votes = pd.read_csv(os.path.join(test_data, "votes", "votes.csv"))
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_hash_buckets_match_hash(self):
+        keys = list(self.votes.user_id) + list(self.votes.target_fullname)
+        for num_splits in [1, 7, 1024, 1000003, 2 ** 40 + 1]:
+            expected = [hash(k) % num_splits for k in keys]
+            self.assertEqual(list(hash_buckets(pd.Series(keys), num_splits)), expected)
+
+    def test_split_data_frame(self):
+        num_splits = 16
+        output_file_map = {i: os.path.join(self.output_dir, "%05d.csv" % i) for i in range(num_splits)}
+        split_data_frame(self.votes, 'user_id', num_splits, output_file_map)
+
+        for i, f in output_file_map.items():
+            df = pd.read_csv(f)
+            expected = self.votes[self.votes.user_id.apply(lambda s: hash(s) % num_splits) == i]
+            self.assertEqual(list(df.columns), list(self.votes.columns))
+            self.assertEqual(df.values.tolist(), expected.values.tolist())
+
+    def test_split_file_in_chunks(self):
+        num_splits = 8
+        file_path = os.path.join(test_data, "comments", "comments.csv")
+        whole_dir = os.path.join(self.output_dir, "whole")
+        chunked_dir = os.path.join(self.output_dir, "chunked")
+        whole = {i: os.path.join(whole_dir, "%05d" % i) for i in range(num_splits)}
+        chunked = {i: os.path.join(chunked_dir, "%05d" % i) for i in range(num_splits)}
+        for d in list(whole.values()) + list(chunked.values()):
+            os.makedirs(d)
+
+        split_file('user_id', file_path, whole, num_splits)
+        split_file('user_id', file_path, chunked, num_splits, memory_budget=2048)
+        self.assertGreater(len(list(read_csv_chunks(file_path, 2048))), 1)
+
+        for i in range(num_splits):
+            with open(os.path.join(whole[i], "comments.csv")) as f1, \
+                    open(os.path.join(chunked[i], "comments.csv")) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_spill_data_frame(self):
+        num_splits = 4
+        spill_data_frame(self.votes, 'user_id', num_splits, self.output_dir, "votes.csv")
+        spill_data_frame(self.votes, 'user_id', num_splits, self.output_dir, "votes.csv")  # re-split
+        segments = get_spill_segments(self.output_dir)
+
+        for i in range(num_splits):
+            expected = self.votes[self.votes.user_id.apply(lambda s: hash(s) % num_splits) == i]
+            if expected.empty:
+                self.assertNotIn(i, segments)
+                continue
+            df = read_spill_segments(*segments[i])
+            self.assertEqual(list(df.columns), list(self.votes.columns))
+            self.assertEqual(df.values.tolist(), expected.values.tolist())
+
+    def test_split_file_manifest(self):
+        num_splits = 4
+        file_path = os.path.join(test_data, "votes", "votes.csv")
+        create_split_directories(self.output_dir, num_splits)
+        targets = create_data_set_targets(self.output_dir, "votes", num_splits)
+        split_file('user_id', file_path, targets, num_splits, memory_budget=2048, manifest_directory=self.output_dir)
+
+        files = [f for d in targets.values() for f in os.listdir(d)]
+        self.assertEqual(files, ["votes.csv"] * num_splits)
+        entry = load_manifest(self.output_dir)[split_task_name(file_path)]
+        self.assertEqual(entry['rows'], len(self.votes))
+        self.assertTrue(task_complete(self.output_dir, entry))
+        self.assertEqual(unfinished_tasks(self.output_dir, [(file_path,)], lambda args: split_task_name(args[0])), [])
+
+        with open(os.path.join(targets[0], "votes.csv"), 'a') as f:
+            f.write("corrupt\n")
+        self.assertFalse(task_complete(self.output_dir, entry))
+        self.assertFalse(task_complete(self.output_dir, None))
+
+    def test_spill_manifest(self):
+        # A split that was resumed after a worker crashed reads each input file's segments once,
+        # from the spill file of the split that the manifest records as finished
+        num_splits = 4
+        file_path = os.path.join(test_data, "votes", "votes.csv")
+        spill_directory = create_data_set_targets(self.output_dir, "votes", num_splits, spill=True)
+        split_file('user_id', file_path, spill_directory, num_splits, spill=True)
+        for spill_file in get_spill_files(spill_directory):
+            os.rename(spill_file, os.path.join(spill_directory, "crashed" + os.path.splitext(spill_file)[1]))
+        split_file('user_id', file_path, spill_directory, num_splits, spill=True, manifest_directory=self.output_dir)
+
+        def num_rows(segments):
+            return sum(len(read_spill_segments(*segments[i])) for i in segments)
+        self.assertEqual(num_rows(get_spill_segments(spill_directory)), 2 * len(self.votes))
+        segments = get_spill_segments(spill_directory, manifest=load_manifest(self.output_dir))
+        self.assertEqual(num_rows(segments), len(self.votes))
+        spill_file = get_spill_files(spill_directory)[0]
+        self.assertTrue(all(s[0] == spill_file for i in segments for s in segments[i][1]))
+
+    def test_sort_missing_keys_last(self):
+        votes = self.votes.assign(post_fullname=self.votes.target_fullname)
+        votes.loc[[0, 7], 'user_id'] = None
+        votes.loc[[3, 9], 'post_fullname'] = None
+        for key in ['user_id', 'post_fullname']:
+            expected = votes.sort_values(by=[key, 'endpoint_ts'], kind='stable')
+            self.assertEqual(list(sort_by_key(votes, key).index), list(expected.index))
+
+    def test_run_pipeline(self):
+        written = []
+        times = run_pipeline(range(20), [lambda x: x * 2, lambda x: x + 1, written.append],
+                             names=["read", "double", "increment", "write"])
+        self.assertEqual(written, [2 * x + 1 for x in range(20)])
+        self.assertEqual([t[0] for t in times], ["read", "double", "increment", "write"])
+
+        def fail(x):
+            if x == 5:
+                raise ValueError("Failed on %d" % x)
+            return x
+        self.assertRaises(ValueError, run_pipeline, range(1000), [fail, written.append])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+File: writers_test.py
+
+Tests that the CSV writers write exactly what pandas.DataFrame.to_csv writes
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from writers import *
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+
+class WritersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.frames = [pd.read_csv(os.path.join(test_data, data_set, file_name))
+                       for data_set in sorted(os.listdir(test_data))
+                       for file_name in os.listdir(os.path.join(test_data, data_set))]
+        # Values that are quoted, missing values and the other types of the columns of the split and the merge
+        df = pd.DataFrame({'text': ['a\rb', 'a\tb', '', None, 'a "quote"', 'a,b', 'a\nb'],
+                           'int': np.arange(7, dtype=np.int32),
+                           'float': [1.5, np.nan, 1e16, 0.1 + 0.2, -0.0, 3.0, 2.0],
+                           'category': pd.Categorical(['u', None, 'v', 'u', 'w', 'x', 'u']),
+                           'boolean': pd.array([True, None, False, True, True, False, False], dtype='boolean'),
+                           'object': [1, 'x', 2.5, None, np.nan, False, pd.NA]})
+        self.frames += [df, df[['text']], df[['float']], df.iloc[:0], df.iloc[2:5]]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_format_csv(self):
+        for df in self.frames:
+            for sep in [",", "\t"]:
+                self.assertEqual(format_csv(df, sep=sep), df.to_csv(index=False, sep=sep))
+                self.assertEqual(format_csv(df, sep=sep, header=False), df.to_csv(index=False, sep=sep, header=False))
+
+    def test_table_writer(self):
+        df = pd.concat(self.frames[-5:], ignore_index=True)
+        path = os.path.join(self.directory, "table.tsv")
+        for threaded in [False, True]:
+            writer = TableWriter(path, df.columns, sep="\t", threaded=threaded)
+            for i in range(0, len(df), 3):
+                writer.write(df.iloc[i:i + 3])
+            writer.close()
+            self.assertEqual(writer.num_rows, len(df))
+            with open(path, newline='') as f:
+                self.assertEqual(f.read(), df.to_csv(index=False, sep="\t"))
+
+
+if __name__ == "__main__":
+    unittest.main()